@@ -1,11 +1,18 @@
 # Note: Be sure to install bcrypt, flask-bcrypt, and flask_wtf (if you haven't already) onto your system.
+import hashlib
+import json
 import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import flask
 import bcrypt
-from collections import Counter
+from asgiref.sync import sync_to_async
 from flask import flash, request, render_template
+from markupsafe import Markup
 from dotenv import find_dotenv, load_dotenv
 from flask_bcrypt import Bcrypt
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from flask_wtf.csrf import CSRFProtect
 from flask_login import (
     LoginManager,
@@ -28,57 +35,117 @@ from models import (
     BookTitleForm,
     Users,
     Favorites,
+    FavoriteThemes,
     Recommendations,
     Review,
     ReviewForm,
+    ReviewStats,
+    REVIEW_RATINGS,
+    BOOK_THEMES,
+    clean_isbn,
 )
 from penguin import (
-    book_suggestions,
-    title_search,
-    all_book_info,
-    basic_book_info,
+    book_suggestions_async,
+    search_titles,
+    all_book_info_async,
+    basic_book_info_many,
+    basic_book_info_many_async,
+    lookup_title_records,
     get_single_book_theme,
+    known_missing,
+    theme_pools,
+    start_background_refresh,
+    rebuild_title_index,
+    TITLE_INDEX_REFRESH,
+    start_cache_warmup,
+    CACHE_WARM_COUNT,
+    CACHE_WARM_RATE,
+    BookRecord,
+    shared_store,
 )
+from cache import TTLCache
+from book_lists import FORMATS, is_isbn13, normalize_isbn, read_isbns, write_rows
+from instrumentation import cache_collector, instrument_app, metrics
 
-app = flask.Flask(__name__)
-load_dotenv(find_dotenv())
-
-app.config["SECRET_KEY"] = os.urandom(32)
-app.config["WTF_CSRF_ENABLED"] = True
-app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL_V2")
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-bcrypt = Bcrypt(app)
+bcrypt = Bcrypt()
 
-# CSRF protection is required to use flask_wtf's functionalities. The randomly generated secret key above is used here.
+# CSRF protection is required to use flask_wtf's functionalities. The randomly generated secret key in create_app() is used here.
 csrf = CSRFProtect()
-csrf.init_app(app)
 
+login_manager = LoginManager()
+login_manager.login_view = "main.login"
+
+# Every page of the app is registered on the "main" blueprint.
+# Views that wait on Penguin are async, so their upstream lookups run concurrently on the view's event loop.
+# Flask runs that loop on a separate thread, so their database work is handed back to the request's own
+# thread (and its database session) with sync_to_async(..., thread_sensitive=True).
+main = flask.Blueprint("main", __name__)
 bp = flask.Blueprint("bp", __name__, template_folder="./static/react",)
 
-db.init_app(app)
-with app.app_context():
-    db.create_all()
-    login_manager = LoginManager()
-    login_manager.login_view = "login"
-    login_manager.init_app(app)
+# The versioned JSON API (see SECTION 3). Its views answer 401 rather than redirecting to the login page.
+api = flask.Blueprint("api", __name__, url_prefix="/api/v1")
+login_manager.blueprint_login_views["api"] = None
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    """Returns the user associated with a specific user ID."""
+    return Users.query.get(int(user_id))
+
+
+def create_app(config=None):
+    """Creates and configures an instance of the app. Any settings in config override the defaults read from the environment."""
+    app = flask.Flask(__name__)
+    load_dotenv(find_dotenv())
+
+    # Every worker must sign sessions with the same key, so SECRET_KEY should be set when running more than one.
+    app.config["SECRET_KEY"] = os.getenv("SECRET_KEY") or os.urandom(32)
+    app.config["WTF_CSRF_ENABLED"] = True
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL_V2")
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # Each request's timings are logged as a line of JSON unless REQUEST_LOG is set to 0.
+    app.config["REQUEST_LOG"] = os.getenv("REQUEST_LOG", "1") != "0"
+    if config is not None:
+        app.config.update(config)
 
-    @login_manager.user_loader
-    def load_user(user_id):
-        """Returns the user associated with a specific user ID."""
-        return Users.query.get(int(user_id))
+    bcrypt.init_app(app)
+    csrf.init_app(app)
+    db.init_app(app)
+    login_manager.init_app(app)
+    instrument_app(app)
+    app.register_blueprint(main)
+    app.register_blueprint(bp)
+    app.register_blueprint(api)
+
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def start_background_jobs(app):
+    """Starts the threads that keep suggestion pools and the title search index fresh (and optionally warm the title cache), so requests never wait on them."""
+    # The rate is only checked when warm-up is on, so scripts and workers that never warm the cache don't depend on it.
+    if CACHE_WARM_COUNT and CACHE_WARM_RATE <= 0:
+        raise ValueError(
+            "PENGUIN_WARM_RATE must be a positive number of requests per second"
+        )
+    theme_pools.start(app)
+    start_background_refresh(app, TITLE_INDEX_REFRESH, rebuild_title_index)
+    if CACHE_WARM_COUNT:
+        start_cache_warmup(app, CACHE_WARM_COUNT, CACHE_WARM_RATE)
 
 
 # =====================================================================
 # SECTION 1: SIGN-UP/LOGIN INFORMATION ROUTES
 # =====================================================================
-@app.route("/", methods=["GET"])
+@main.route("/", methods=["GET"])
 def signup():
     """Returns the basic sign-up page where login information can be inputted to the database."""
     form = SignupForm()
     return flask.render_template("signup.html", form=form)
 
 
-@app.route("/signup_post", methods=["POST"])
+@main.route("/signup_post", methods=["POST"])
 def signup_post():
     """Registers a new user to the database, assuming there is no user with the same username."""
     form = SignupForm()
@@ -94,20 +161,20 @@ def signup_post():
         db.session.commit()
 
         flask.flash("New user successfully registered.")
-        return flask.redirect(flask.url_for("login"))
+        return flask.redirect(flask.url_for("main.login"))
 
     flask.flash("USER ALREADY EXISTS. PLEASE TRY AGAIN.")
-    return flask.redirect(flask.url_for("signup"))
+    return flask.redirect(flask.url_for("main.signup"))
 
 
-@app.route("/login", methods=["GET"])
+@main.route("/login", methods=["GET"])
 def login():
     """Returns the basic login page where login information is checked."""
     form = LoginForm()
     return flask.render_template("login.html", form=form)
 
 
-@app.route("/login_post", methods=["POST"])
+@main.route("/login_post", methods=["POST"])
 def login_post():
     """Checks login credentials; if valid, redirect the user to the homepage. Otherwise, re-render the login page."""
     form = LoginForm()
@@ -116,22 +183,22 @@ def login_post():
         if user:
             if bcrypt.check_password_hash(user.password, form.password.data):
                 login_user(user)
-                return flask.redirect(flask.url_for("homepage"))
+                return flask.redirect(flask.url_for("main.homepage"))
 
     flask.flash("USER DOES NOT EXIST. PLEASE TRY AGAIN.")
-    return flask.redirect(flask.url_for("login"))
+    return flask.redirect(flask.url_for("main.login"))
 
 
-@app.route("/logout", methods=["GET", "POST"])
+@main.route("/logout", methods=["GET", "POST"])
 @login_required
 def logout():
     """Clears the current user's session cookies and redirects you back to the login page."""
     logout_user()
     flask.flash("You have successfully logged out.")
-    return flask.redirect(flask.url_for("login"))
+    return flask.redirect(flask.url_for("main.login"))
 
 
-@app.route("/profile", methods=["GET", "POST"])
+@main.route("/profile", methods=["GET", "POST"])
 @login_required
 def profile():
     """Provides the current user with the ability to update their username and email."""
@@ -176,35 +243,40 @@ def profile():
 # =====================================================================
 # SECTION 2: COMMON ROUTES USED FOR PRIMARY APP FEATURES
 # =====================================================================
-@app.route("/homepage", methods=["GET", "POST"])
+def top_favorite_theme(user_id):
+    """Returns the most common theme among a user's favorites, or None if they have no themed favorites."""
+    # The most common theme is read straight from the maintained histogram.
+    top_theme = (
+        FavoriteThemes.query.filter(
+            FavoriteThemes.user_id == user_id,
+            FavoriteThemes.theme != "None",
+            FavoriteThemes.count > 0,
+        )
+        .order_by(FavoriteThemes.count.desc())
+        .first()
+    )
+    return top_theme.theme if top_theme is not None else None
+
+
+@main.route("/homepage", methods=["GET", "POST"])
 @login_required
-def homepage():
+async def homepage():
     """Renders the basic landing page from which most other HTML pages can be reached."""
     logout_button = LogoutButton()
     bookinfo_form_a = BookInfoFormAdd()
     route_name = "homepage"
     display_number = 1
+    top_theme = await sync_to_async(top_favorite_theme, thread_sensitive=True)(
+        current_user.id
+    )
 
-    all_favorites = Favorites.query.filter_by(email=current_user.email).all()
-    num_books = len(all_favorites)
-
-    favorite_themes = []
-    for i in range(num_books):
-        book_theme = get_single_book_theme(all_favorites[i].bookISBN)
-        favorite_themes.append(book_theme)
-
-    if num_books != 0:
-        occurence_count = Counter(favorite_themes)
-        most_common_theme = occurence_count.most_common(1)[0][0]
-
-        # Grabs the second most common theme if the most common theme is "None".
-        if most_common_theme == "None":
-            most_common_theme = occurence_count.most_common(2)[1][0]
-
-        book_titles, book_urls, book_ISBNs = book_suggestions(
-            most_common_theme, display_number
+    if top_theme is not None:
+        num_books = display_number
+        book_titles, book_urls, book_ISBNs = await book_suggestions_async(
+            top_theme, display_number
         )
     else:
+        num_books = 0
         book_titles = []
         book_urls = []
         book_ISBNs = []
@@ -222,7 +294,7 @@ def homepage():
     )
 
 
-@app.route("/suggestions", methods=["GET", "POST"])
+@main.route("/suggestions", methods=["GET", "POST"])
 @login_required
 def suggestions():
     """Returns the basic suggestions page where books can be suggested to the user based on a chosen theme."""
@@ -237,9 +309,9 @@ def suggestions():
     )
 
 
-@app.route("/handle_theme_suggestions", methods=["GET", "POST"])
+@main.route("/handle_theme_suggestions", methods=["GET", "POST"])
 @login_required
-def handle_theme_suggestions():
+async def handle_theme_suggestions():
     """Based on the theme selected, the titles, ISBNs, and cover images of a random set of books under said theme is returned and rendered on the suggestions page."""
     return_home_button = ReturnHomeButton()
     route_name = "suggestions"
@@ -247,7 +319,7 @@ def handle_theme_suggestions():
     bookinfo_form_a = BookInfoFormAdd()
     display_number = 6
     if theme_form.validate_on_submit():
-        book_titles, book_urls, book_ISBNs = book_suggestions(
+        book_titles, book_urls, book_ISBNs = await book_suggestions_async(
             theme_form.theme.data, display_number
         )
         num_books = len(book_titles)
@@ -264,7 +336,7 @@ def handle_theme_suggestions():
         )
 
 
-@app.route("/search_by_title")
+@main.route("/search_by_title")
 @login_required
 def search_by_title():
     """Returns the basic search_by_title page where books can be directly searched for using a title input."""
@@ -277,7 +349,7 @@ def search_by_title():
     )
 
 
-@app.route("/handle_title_selection", methods=["GET", "POST"])
+@main.route("/handle_title_selection", methods=["GET", "POST"])
 @login_required
 def handle_title_selection():
     """Returns basic information about a single book based on the provided title input."""
@@ -287,18 +359,22 @@ def handle_title_selection():
     bookinfo_form_a = BookInfoFormAdd()
     if title_form.validate_on_submit():
         try:
-            book_ISBN = title_search(title_form.title.data)
-            book_title, book_url = basic_book_info(book_ISBN)
+            search_results = search_titles(title_form.title.data, 10)
+            if not search_results:
+                raise LookupError("No books found for " + title_form.title.data)
+            book_titles = [result[0] for result in search_results]
+            book_urls = [result[1] for result in search_results]
+            book_ISBNs = [result[2] for result in search_results]
             return flask.render_template(
                 "search_by_title.html",
                 return_home_button=return_home_button,
                 route_name=route_name,
                 title_form=title_form,
                 bookinfo_form_a=bookinfo_form_a,
-                book_title=book_title,
-                book_url=book_url,
-                book_ISBN=book_ISBN,
-                num_books=1,
+                book_titles=book_titles,
+                book_urls=book_urls,
+                book_ISBNs=book_ISBNs,
+                num_books=len(search_results),
             )
         except:
             return flask.render_template(
@@ -310,26 +386,50 @@ def handle_title_selection():
             )
 
 
-@app.route("/favorites")
-@login_required
-def favorites():
-    """Displays the current user's favorited books on the 'favorites' page."""
-    return_home_button = ReturnHomeButton()
-    bookinfo_form_srecs = BookInfoFormSendRecs()
-    all_favorites = Favorites.query.filter_by(email=current_user.email).all()
+# Favorites and recommendations are shown a page at a time, so a long list doesn't hold up the first one.
+BOOKS_PER_PAGE = 24
+
 
-    num_books = len(all_favorites)
-    book_titles = []
-    book_urls = []
-    all_favorite_isbns = []
+def book_summaries(isbns, book_info):
+    """Returns the ISBN, title, and cover URL of each book on a page, for the JSON page endpoints."""
+    return [
+        {"isbn": isbn, "title": book.title, "cover": book.cover}
+        for isbn, book in zip(isbns, book_info)
+    ]
 
-    for i in range(num_books):
-        book_title, book_url = basic_book_info(all_favorites[i].bookISBN)
-        book_titles.append(book_title)
-        book_urls.append(book_url)
-        all_favorite_isbns.append(all_favorites[i].bookISBN)
 
-    if num_books == 0:
+def favorite_page(user_id, after=None):
+    """Returns a page of the ISBNs a user has favorited after the favorite ID after, oldest first, along with the cursor for the next page (None on the last page)."""
+    query = Favorites.query.filter_by(user_id=user_id)
+    if after is not None:
+        query = query.filter(Favorites.id > after)
+    # One extra row is fetched to find out whether there is another page.
+    favorites = query.order_by(Favorites.id).limit(BOOKS_PER_PAGE + 1).all()
+    next_cursor = None
+    if len(favorites) > BOOKS_PER_PAGE:
+        favorites = favorites[:BOOKS_PER_PAGE]
+        next_cursor = favorites[-1].id
+    return [favorite.bookISBN for favorite in favorites], next_cursor
+
+
+@main.route("/favorites")
+@login_required
+async def favorites():
+    """Displays a page of the current user's favorited books on the 'favorites' page, starting after the optional "after" cursor."""
+    return_home_button = ReturnHomeButton()
+    bookinfo_form_srecs = BookInfoFormSendRecs()
+    after = flask.request.args.get("after", type=int)
+    favorite_isbns, next_cursor = await sync_to_async(
+        favorite_page, thread_sensitive=True
+    )(current_user.id, after)
+    num_books = len(favorite_isbns)
+
+    # The page's books are looked up concurrently rather than one request at a time.
+    book_info = await basic_book_info_many_async(favorite_isbns)
+    book_titles = [book.title for book in book_info]
+    book_urls = [book.cover for book in book_info]
+
+    if num_books == 0 and after is None:
         return flask.render_template(
             "no_favorites.html", return_home_button=return_home_button,
         )
@@ -340,12 +440,28 @@ def favorites():
             bookinfo_form_srecs=bookinfo_form_srecs,
             book_titles=book_titles,
             book_urls=book_urls,
-            book_ISBNs=all_favorite_isbns,
+            book_ISBNs=favorite_isbns,
             num_books=num_books,
+            next_cursor=next_cursor,
         )
 
 
-@app.route("/handle_dualsubmits_add", methods=["POST"])
+@main.route("/favorites/page")
+@api.route("/favorites")
+@login_required
+async def favorites_page():
+    """Returns the page of the current user's favorited books after the "after" cursor as JSON, for the 'favorites' page to append and for API clients."""
+    after = flask.request.args.get("after", type=int)
+    favorite_isbns, next_cursor = await sync_to_async(
+        favorite_page, thread_sensitive=True
+    )(current_user.id, after)
+    book_info = await basic_book_info_many_async(favorite_isbns)
+    return json_response(
+        {"books": book_summaries(favorite_isbns, book_info), "next": next_cursor}
+    )
+
+
+@main.route("/handle_dualsubmits_add", methods=["POST"])
 @login_required
 def handle_dualsubmits_add():
     """Based on whether the user wants to explore a book or favorite a book, redirect to proper routes accordingly."""
@@ -353,19 +469,19 @@ def handle_dualsubmits_add():
     if bookinfo_form_a.validate_on_submit():
         if bookinfo_form_a.submit_explore.data is True:
             return flask.redirect(
-                flask.url_for("get_book_info", isbn=bookinfo_form_a.isbn.data)
+                flask.url_for("main.get_book_info", isbn=bookinfo_form_a.isbn.data)
             )
         else:
             return flask.redirect(
                 flask.url_for(
-                    "add_favorite",
+                    "main.add_favorite",
                     route=bookinfo_form_a.original_route.data,
                     isbn=bookinfo_form_a.isbn.data,
                 )
             )
 
 
-@app.route("/handle_triple_submits", methods=["POST"])
+@main.route("/handle_triple_submits", methods=["POST"])
 @login_required
 def handle_triple_submits():
     """Based on whether the user wants to explore a book, unfavorite a book, or send a book recommendation, redirect to proper routes accordingly."""
@@ -373,23 +489,23 @@ def handle_triple_submits():
     if bookinfo_form_srecs.validate_on_submit():
         if bookinfo_form_srecs.submit_explore.data is True:
             return flask.redirect(
-                flask.url_for("get_book_info", isbn=bookinfo_form_srecs.isbn.data)
+                flask.url_for("main.get_book_info", isbn=bookinfo_form_srecs.isbn.data)
             )
         elif bookinfo_form_srecs.submit_delete.data is True:
             return flask.redirect(
-                flask.url_for("delete_favorite", isbn=bookinfo_form_srecs.isbn.data,)
+                flask.url_for("main.delete_favorite", isbn=bookinfo_form_srecs.isbn.data,)
             )
         else:
             return flask.redirect(
                 flask.url_for(
-                    "add_recommendations",
+                    "main.add_recommendations",
                     isbn=bookinfo_form_srecs.isbn.data,
                     receiver_username=bookinfo_form_srecs.receiver_username.data,
                 )
             )
 
 
-@app.route("/handle_triplesubmits_recdelete", methods=["POST"])
+@main.route("/handle_triplesubmits_recdelete", methods=["POST"])
 @login_required
 def handle_triplesubmits_recdelete():
     """Based on whether the user wants to explore a book, unfavorite a book, or delete a book recommendation from another, redirect to proper routes accordingly."""
@@ -397,12 +513,12 @@ def handle_triplesubmits_recdelete():
     if bookinfo_form_drecs.validate_on_submit():
         if bookinfo_form_drecs.submit_explore.data is True:
             return flask.redirect(
-                flask.url_for("get_book_info", isbn=bookinfo_form_drecs.isbn.data)
+                flask.url_for("main.get_book_info", isbn=bookinfo_form_drecs.isbn.data)
             )
         elif bookinfo_form_drecs.submit_favorite.data is True:
             return flask.redirect(
                 flask.url_for(
-                    "add_favorite",
+                    "main.add_favorite",
                     isbn=bookinfo_form_drecs.isbn.data,
                     route="recommendations",
                 )
@@ -410,73 +526,109 @@ def handle_triplesubmits_recdelete():
         else:
             return flask.redirect(
                 flask.url_for(
-                    "delete_recommendations",
+                    "main.delete_recommendations",
                     isbn=bookinfo_form_drecs.isbn.data,
                     receiver_username=bookinfo_form_drecs.receiver_username.data,
                 )
             )
 
 
-@app.route("/add_favorite")
+def update_theme_count(user_id, theme, change):
+    """Adjusts how many of a user's favorites fall under a theme. The caller is responsible for committing."""
+    theme_count = FavoriteThemes.query.filter_by(user_id=user_id, theme=theme).first()
+    if theme_count is None:
+        theme_count = FavoriteThemes(user_id=user_id, theme=theme, count=0)
+        db.session.add(theme_count)
+    theme_count.count = max(theme_count.count + change, 0)
+
+
+@main.route("/add_favorite")
 @login_required
 def add_favorite():
     """Adds a valid book ISBN to the favorites list before redirecting the user to the original page from which a book was favorited."""
     original_route = flask.request.args.get("route")
-    favorite_isbn = flask.request.args.get("isbn")
-    existing_favorite = Favorites.query.filter_by(
-        email=current_user.email, bookISBN=favorite_isbn
-    ).first()
+    favorite_isbn = clean_isbn(flask.request.args.get("isbn"))
+    if favorite_isbn is None:
+        flask.flash("THIS IS NOT A VALID ISBN. PLEASE TRY AGAIN.")
+        return flask.redirect(flask.url_for("main." + original_route))
+    # A theme that couldn't be looked up is stored as NULL, for migrations.py to fill in later.
+    book_theme = get_single_book_theme(favorite_isbn)
+    new_favorite = Favorites(
+        user_id=current_user.id, bookISBN=favorite_isbn, theme=book_theme
+    )
 
-    if existing_favorite:
+    # Duplicate favorites are rejected by the unique (user_id, bookISBN) index.
+    try:
+        db.session.add(new_favorite)
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
         flask.flash("THIS BOOK HAS BEEN FAVORITED ALREADY. PLEASE TRY AGAIN.")
-        return flask.redirect(flask.url_for(original_route))
+        return flask.redirect(flask.url_for("main." + original_route))
 
-    else:
-        new_favorite = Favorites(email=current_user.email, bookISBN=favorite_isbn)
-        db.session.add(new_favorite)
-        db.session.commit()
-        flask.flash("Book has been favorited.")
-        return flask.redirect(flask.url_for(original_route))
+    if book_theme is not None:
+        update_theme_count(current_user.id, book_theme, 1)
+    db.session.commit()
+    flask.flash("Book has been favorited.")
+    return flask.redirect(flask.url_for("main." + original_route))
 
 
-@app.route("/delete_favorite")
+@main.route("/delete_favorite")
 @login_required
 def delete_favorite():
     """If found, removes a book from the favorites list before returning the user back to the favorites page."""
     isbn = flask.request.args.get("isbn")
     deleted_book = Favorites.query.filter_by(
-        email=current_user.email, bookISBN=isbn
+        user_id=current_user.id, bookISBN=isbn
     ).first()
     db.session.delete(deleted_book)
+    if deleted_book.theme is not None:
+        update_theme_count(current_user.id, deleted_book.theme, -1)
     db.session.commit()
     flask.flash("Book has been unfavorited.")
-    return flask.redirect(flask.url_for("favorites"))
+    return flask.redirect(flask.url_for("main.favorites"))
 
 
-@app.route("/recommendations")
+def recommendation_page(user_id, after=None):
+    """Returns a page of the ISBNs recommended to a user after the recommendation ID after, oldest first, along with the username of each book's sender and the cursor for the next page (None on the last page)."""
+    query = Recommendations.query.options(joinedload(Recommendations.sender)).filter_by(
+        receiver_id=user_id
+    )
+    if after is not None:
+        query = query.filter(Recommendations.id > after)
+    # One extra row is fetched to find out whether there is another page.
+    recommendations = query.order_by(Recommendations.id).limit(BOOKS_PER_PAGE + 1).all()
+    next_cursor = None
+    if len(recommendations) > BOOKS_PER_PAGE:
+        recommendations = recommendations[:BOOKS_PER_PAGE]
+        next_cursor = recommendations[-1].id
+    recommendation_isbns = [
+        recommendation.bookISBN for recommendation in recommendations
+    ]
+    recommendation_senders = [
+        recommendation.sender.username for recommendation in recommendations
+    ]
+    return recommendation_isbns, recommendation_senders, next_cursor
+
+
+@main.route("/recommendations")
 @login_required
-def recommendations():
-    """Displays recommended books sent by other users to the currnent user on the 'recommendations' page."""
+async def recommendations():
+    """Displays a page of the recommended books sent by other users to the currnent user on the 'recommendations' page, starting after the optional "after" cursor."""
     return_home_button = ReturnHomeButton()
     bookinfo_form_drecs = BookInfoFormDeleteRecs()
-    all_recommendations = Recommendations.query.filter_by(
-        receiverUsername=current_user.username
-    ).all()
-
-    num_books = len(all_recommendations)
-    book_titles = []
-    book_urls = []
-    all_recommendations_isbns = []
-    recommendation_senders = []
-
-    for i in range(num_books):
-        book_title, book_url = basic_book_info(all_recommendations[i].bookISBN)
-        book_titles.append(book_title)
-        book_urls.append(book_url)
-        recommendation_senders.append(all_recommendations[i].senderUsername)
-        all_recommendations_isbns.append(all_recommendations[i].bookISBN)
-
-    if num_books == 0:
+    after = flask.request.args.get("after", type=int)
+    recommendation_isbns, recommendation_senders, next_cursor = await sync_to_async(
+        recommendation_page, thread_sensitive=True
+    )(current_user.id, after)
+    num_books = len(recommendation_isbns)
+
+    # The page's books are looked up concurrently rather than one request at a time.
+    book_info = await basic_book_info_many_async(recommendation_isbns)
+    book_titles = [book.title for book in book_info]
+    book_urls = [book.cover for book in book_info]
+
+    if num_books == 0 and after is None:
         return flask.render_template(
             "no_recommendations.html", return_home_button=return_home_button,
         )
@@ -487,149 +639,623 @@ def recommendations():
             bookinfo_form_drecs=bookinfo_form_drecs,
             book_titles=book_titles,
             book_urls=book_urls,
-            book_ISBNs=all_recommendations_isbns,
+            book_ISBNs=recommendation_isbns,
             recommendation_senders=recommendation_senders,
             num_books=num_books,
+            next_cursor=next_cursor,
+        )
+
+
+@main.route("/recommendations/page")
+@api.route("/recommendations")
+@login_required
+async def recommendations_page():
+    """Returns the page of the current user's recommended books after the "after" cursor as JSON, for the 'recommendations' page to append and for API clients."""
+    after = flask.request.args.get("after", type=int)
+    recommendation_isbns, recommendation_senders, next_cursor = await sync_to_async(
+        recommendation_page, thread_sensitive=True
+    )(current_user.id, after)
+    book_info = await basic_book_info_many_async(recommendation_isbns)
+    books = book_summaries(recommendation_isbns, book_info)
+    for book, sender in zip(books, recommendation_senders):
+        book["sender"] = sender
+    return json_response({"books": books, "next": next_cursor})
+
+
+def recommend_books(sender_id, usernames, isbns):
+    """Recommends every book in isbns to every user in usernames in one transaction, skipping pairs that were already recommended. Returns how many recommendations were added, how many already existed, and the usernames that don't belong to another user."""
+    usernames = list(dict.fromkeys(usernames))
+    isbns = list(dict.fromkeys(isbns))
+    # Receivers are looked up with one IN query, and existing pairs are found with one more, rather than one of each per pair.
+    receivers = dict(
+        db.session.query(Users.username, Users.id).filter(
+            Users.username.in_(usernames), Users.id != sender_id
         )
+    )
+    unknown_usernames = [
+        username for username in usernames if username not in receivers
+    ]
+    if not receivers or not isbns:
+        return 0, 0, unknown_usernames
+
+    existing_pairs = {
+        (receiver_id, isbn)
+        for receiver_id, isbn in db.session.query(
+            Recommendations.receiver_id, Recommendations.bookISBN
+        ).filter(
+            Recommendations.sender_id == sender_id,
+            Recommendations.receiver_id.in_(receivers.values()),
+            Recommendations.bookISBN.in_(isbns),
+        )
+    }
+    new_recommendations = [
+        {"sender_id": sender_id, "receiver_id": receiver_id, "bookISBN": isbn}
+        for receiver_id in receivers.values()
+        for isbn in isbns
+        if (receiver_id, isbn) not in existing_pairs
+    ]
+    # A pair recommended concurrently still trips the unique index, rolling back the whole batch.
+    db.session.bulk_insert_mappings(Recommendations, new_recommendations)
+    db.session.commit()
+    return len(new_recommendations), len(existing_pairs), unknown_usernames
 
 
-@app.route("/add_recommendations")
+@main.route("/add_recommendations")
 @login_required
 def add_recommendations():
     """Adds a valid book ISBN to another user's recommendations list before redirecting the current user to the original page from which a book was recommended."""
-    isbn = flask.request.args.get("isbn")
+    isbn = clean_isbn(flask.request.args.get("isbn"))
     receiver_username = flask.request.args.get("receiver_username")
-    if receiver_username == "":
+    if isbn is None:
+        flask.flash("THIS IS NOT A VALID ISBN. PLEASE TRY AGAIN.")
+        return flask.redirect(flask.url_for("main.favorites"))
+    elif receiver_username == "":
         flask.flash("A USERNAME MUST BE INPUTTED.")
-        return flask.redirect(flask.url_for("favorites"))
+        return flask.redirect(flask.url_for("main.favorites"))
     elif receiver_username == current_user.username:
         flask.flash("YOU CANNOT RECOMMEND BOOKS TO YOURSELF. TRY AGAIN.")
-        return flask.redirect(flask.url_for("favorites"))
-
-    existing_recommendation = Recommendations.query.filter_by(
-        senderUsername=current_user.username,
-        receiverUsername=receiver_username,
-        bookISBN=isbn,
-    ).first()
-    user_exists = Users.query.filter_by(username=receiver_username).first()
+        return flask.redirect(flask.url_for("main.favorites"))
 
-    if existing_recommendation:
-        flask.flash(
-            "THIS BOOK HAS BEEN RECOMMENDED TO THIS PERSON ALREADY. PLEASE TRY AGAIN."
+    try:
+        recommended, _, unknown_usernames = recommend_books(
+            current_user.id, [receiver_username], [isbn]
         )
-        return flask.redirect(flask.url_for("favorites"))
-    elif not user_exists:
+    except IntegrityError:
+        db.session.rollback()
+        recommended, unknown_usernames = 0, []
+    if unknown_usernames:
         flask.flash("THIS USER DOES NOT EXIST. TRY AGAIN.")
-        return flask.redirect(flask.url_for("favorites"))
-    else:
-        new_recommendation = Recommendations(
-            senderUsername=current_user.username,
-            receiverUsername=receiver_username,
-            bookISBN=isbn,
+        return flask.redirect(flask.url_for("main.favorites"))
+    if not recommended:
+        flask.flash(
+            "THIS BOOK HAS BEEN RECOMMENDED TO THIS PERSON ALREADY. PLEASE TRY AGAIN."
         )
-        db.session.add(new_recommendation)
-        db.session.commit()
-        flask.flash("Book has been recommended.")
-        return flask.redirect(flask.url_for("favorites"))
+        return flask.redirect(flask.url_for("main.favorites"))
+
+    flask.flash("Book has been recommended.")
+    return flask.redirect(flask.url_for("main.favorites"))
 
 
-@app.route("/delete_recommendations")
+@main.route("/delete_recommendations")
 @login_required
 def delete_recommendations():
     """If found, removes a book from the current user's recommendations list before returning the user back to the recommendations page."""
     isbn = flask.request.args.get("isbn")
     deleted_book = Recommendations.query.filter_by(
-        receiverUsername=current_user.username, bookISBN=isbn
+        receiver_id=current_user.id, bookISBN=isbn
     ).first()
     db.session.delete(deleted_book)
     db.session.commit()
     flask.flash("Book has been un-recommended.")
-    return flask.redirect(flask.url_for("recommendations"))
-
-
-@app.route("/get_book_info", methods=["GET", "POST"])
+    return flask.redirect(flask.url_for("main.recommendations"))
+
+
+# Book details are the same for every user, so each book's details fragment is rendered once and cached
+# (shared between workers when penguin.shared_store is configured). Bump BOOK_DETAILS_VERSION whenever
+# templates/book_details.html changes, so fragments rendered from the old template aren't served.
+BOOK_DETAILS_VERSION = 1
+book_details_cache = TTLCache(
+    maxsize=int(os.getenv("BOOK_DETAILS_CACHE_SIZE", 1024)),
+    ttl=int(os.getenv("BOOK_DETAILS_CACHE_TTL", 3600)),
+    store=shared_store,
+    encode=list,
+    decode=tuple,
+)
+metrics.add_collector(cache_collector("book_details", book_details_cache.stats))
+# Browsers and proxies may reuse a fragment from /book_details for this many seconds before revalidating it.
+BOOK_DETAILS_MAX_AGE = 300
+
+
+def render_book_details(book):
+    """Returns a book's rendered details fragment along with its ETag."""
+    html = flask.render_template("book_details.html", book=book)
+    return html, hashlib.sha1(html.encode("utf-8")).hexdigest()
+
+
+async def book_details_fragment(isbn):
+    """Returns the rendered details fragment of a book's page along with its ETag, rendering and caching it on a miss. Returns None for a book that can't be found."""
+    key = "book_details:%d:%s" % (BOOK_DETAILS_VERSION, isbn)
+    fragment = book_details_cache.get(key)
+    if fragment is None:
+        book = await all_book_info_async(isbn)
+        # Nothing is cached for a book that couldn't be found, so the next request tries again (unless Penguin
+        # said it has no such title, which penguin.not_found_cache remembers for a while).
+        if not book.found:
+            return None
+        fragment = render_book_details(book)
+        book_details_cache.set(key, fragment)
+    return fragment
+
+
+@main.route("/book_details/<isbn>")
+async def book_details(isbn):
+    """Returns only the details fragment of a book's page. It holds nothing user-specific, so it may be cached publicly and revalidated with its ETag."""
+    # Anyone can request this page, so only well-formed ISBN-13s are ever looked up.
+    if not is_isbn13(isbn):
+        flask.abort(404)
+    fragment = await book_details_fragment(isbn)
+    if fragment is None:
+        # A book Penguin has no title for is a 404; one that couldn't be looked up right now is worth retrying.
+        flask.abort(404 if known_missing([isbn]) else 503)
+    html, etag = fragment
+    response = flask.Response(html, mimetype="text/html")
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = BOOK_DETAILS_MAX_AGE
+    return response.make_conditional(flask.request)
+
+
+@main.route("/get_book_info", methods=["GET", "POST"])
 @login_required
-def get_book_info():
+async def get_book_info():
     """Displays even more specific info about a book in a separate "bookpage" page based on the provided ISBN."""
     review_form = ReviewForm()
     return_home_button = ReturnHomeButton()
     book_isbn = flask.request.args.get("isbn")
     if book_isbn is None:
         book_isbn = review_form.isbn.data
-    isbn_str = str(book_isbn)
-    (
-        author,
-        flapcopy,
-        author_bio,
-        book_isbn,
-        page_num,
-        book_theme,
-        book_cover,
-        book_title,
-    ) = all_book_info(book_isbn)
-    review = Review.query.filter_by(isbn=isbn_str).all()
-    num_review = len(review)
-    if num_review == 0:
-        flask.flash("Be the first to add a comment for this book")
-    if review_form.validate_on_submit():
+    # Only the reviews and review form are rendered per request; the book's details come from the fragment cache.
+    fragment = await book_details_fragment(str(book_isbn))
+    if fragment is None:
+        # Signed-in readers still get the page (and its reviews), with placeholders for the book's details.
+        fragment = render_book_details(BookRecord.missing(str(book_isbn)))
+    html, _ = fragment
+    return await sync_to_async(render_bookpage, thread_sensitive=True)(
+        Markup(html), str(book_isbn), review_form, return_home_button
+    )
+
+
+# Reviews are listed newest first, one page at a time.
+REVIEWS_PER_PAGE = 20
+
+
+def review_page(isbn, before=None):
+    """Returns a page of a book's reviews older than the review ID before, along with the cursor for the next page (None on the last page)."""
+    query = Review.query.options(joinedload(Review.user)).filter(Review.isbn == isbn)
+    if before is not None:
+        query = query.filter(Review.id < before)
+    # One extra row is fetched to find out whether there is another page.
+    reviews = query.order_by(Review.id.desc()).limit(REVIEWS_PER_PAGE + 1).all()
+    if len(reviews) > REVIEWS_PER_PAGE:
+        return reviews[:REVIEWS_PER_PAGE], reviews[REVIEWS_PER_PAGE - 1].id
+    return reviews, None
+
+
+def update_review_stats(isbn, rating):
+    """Adds a new rating to a book's review aggregates. The caller is responsible for committing."""
+    rating_column = getattr(ReviewStats, "rating_%d" % rating)
+
+    def increment():
+        # The counters are incremented inside the database so that concurrent reviews aren't lost.
+        return ReviewStats.query.filter_by(isbn=isbn).update(
+            {
+                ReviewStats.count: ReviewStats.count + 1,
+                ReviewStats.rating_sum: ReviewStats.rating_sum + rating,
+                rating_column: rating_column + 1,
+            },
+            synchronize_session=False,
+        )
+
+    if increment() == 0:
+        review_stats = ReviewStats(isbn=isbn, count=1, rating_sum=rating)
+        setattr(review_stats, rating_column.key, 1)
+        # The first two reviews of a book can race to insert its row. The loser's insert is rolled back to a
+        # savepoint, and its rating is added to the winner's row instead.
         try:
-            isbn_str = str(review_form.isbn.data)
-            new_review = Review(
-                username=current_user.username,
-                isbn=isbn_str,
-                comment=review_form.comment.data,
-                rating=review_form.rating.data,
-            )
-            db.session.add(new_review)
-            db.session.commit()
-            new_review = Review.query.filter_by(isbn=isbn_str).all()
-            new_num_review = len(new_review)
-            return flask.render_template(
-                "bookpage.html",
-                author=author,
-                flapcopy=flapcopy,
-                author_bio=author_bio,
-                book_isbn=book_isbn,
-                page_num=page_num,
-                book_theme=book_theme,
-                book_cover=book_cover,
-                book_title=book_title,
-                review=new_review,
-                num_review=new_num_review,
-                review_form=review_form,
-                return_home_button=return_home_button,
-            )
-        except ValueError:
-            flask.flash("Something went wrong")
-            return flask.render_temlate(
-                "bookpage.html",
-                author=author,
-                flapcopy=flapcopy,
-                author_bio=author_bio,
-                book_isbn=book_isbn,
-                page_num=page_num,
-                book_theme=book_theme,
-                book_cover=book_cover,
-                book_title=book_title,
-                review_form=review_form,
-                return_home_button=return_home_button,
-            )
+            with db.session.begin_nested():
+                db.session.add(review_stats)
+        except IntegrityError:
+            increment()
+
+
+def render_bookpage(book_details, isbn_str, review_form, return_home_button):
+    """Renders the "bookpage" page around a book's details fragment with its review aggregates and a page of its reviews, first saving a new review if one was submitted."""
+    if review_form.validate_on_submit():
+        isbn_str = str(review_form.isbn.data)
+        new_review = Review(
+            user_id=current_user.id,
+            isbn=isbn_str,
+            comment=review_form.comment.data,
+            rating=review_form.rating.data,
+        )
+        db.session.add(new_review)
+        update_review_stats(isbn_str, int(review_form.rating.data))
+        db.session.commit()
+
+    review_stats = ReviewStats.query.get(isbn_str)
+    if review_stats is None:
+        flask.flash("Be the first to add a comment for this book")
+    review, next_cursor = review_page(
+        isbn_str, flask.request.args.get("before", type=int)
+    )
     return flask.render_template(
         "bookpage.html",
-        author=author,
-        flapcopy=flapcopy,
-        author_bio=author_bio,
-        book_isbn=book_isbn,
-        page_num=page_num,
-        book_theme=book_theme,
-        book_cover=book_cover,
-        book_title=book_title,
+        book_details=book_details,
         review=review,
-        num_review=num_review,
+        num_review=len(review),
+        review_stats=review_stats,
+        next_cursor=next_cursor,
+        review_isbn=isbn_str,
         review_form=review_form,
         return_home_button=return_home_button,
     )
 
 
-app.register_blueprint(bp)
-app.run(host=os.getenv("IP", "0.0.0.0"), port=int(os.getenv("PORT", 8080)), debug=True)
+# =====================================================================
+# SECTION 3: JSON API
+# =====================================================================
+# Every response carries a strong ETag of its body, so clients can revalidate with If-None-Match and get an
+# empty 304 back when nothing has changed. The favorites and recommendations pages are also served here.
+# A bulk recommendation may cover at most this many (receiver, book) pairs.
+MAX_BULK_RECOMMENDATIONS = int(os.getenv("MAX_BULK_RECOMMENDATIONS", 500))
+
+
+def json_response(payload):
+    """Returns a compact JSON response with a strong ETag, or an empty 304 if the request's If-None-Match header matches it."""
+    body = json.dumps(payload, separators=(",", ":"))
+    response = flask.Response(body, mimetype="application/json")
+    response.set_etag(hashlib.sha1(body.encode("utf-8")).hexdigest())
+    # Responses are only for the signed-in user, and must be revalidated before they are reused.
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(flask.request)
+
+
+def review_stats_json(review_stats):
+    """Returns the compact JSON form of a book's review aggregates, with the histogram listed from the lowest rating up."""
+    if review_stats is None:
+        return {"count": 0, "average": None, "histogram": [0 for _ in REVIEW_RATINGS]}
+    return {
+        "count": review_stats.count,
+        "average": review_stats.average_rating,
+        "histogram": [review_stats.histogram[rating] for rating in REVIEW_RATINGS],
+    }
+
+
+@api.route("/suggestions")
+@login_required
+async def api_suggestions():
+    """Returns a random set of books under the "theme" argument (one of BOOK_THEMES), up to "count" of them (from 1 to BOOKS_PER_PAGE)."""
+    theme = flask.request.args.get("theme")
+    # Any other theme would be given a suggestion pool that is kept, and rebuilt, for good.
+    if theme not in BOOK_THEMES:
+        flask.abort(400)
+    count = min(flask.request.args.get("count", 6, type=int), BOOKS_PER_PAGE)
+    if count < 1:
+        flask.abort(400)
+    try:
+        book_titles, book_urls, book_ISBNs = await book_suggestions_async(
+            theme, count, placeholder=False
+        )
+    except LookupError:
+        flask.abort(503)
+    return json_response(
+        {
+            "books": [
+                {"isbn": str(isbn), "title": title, "cover": cover}
+                for title, cover, isbn in zip(book_titles, book_urls, book_ISBNs)
+            ]
+        }
+    )
+
+
+@api.route("/search")
+@login_required
+def api_search():
+    """Returns up to "limit" books (from 1 to BOOKS_PER_PAGE) matching the "q" title or author query, ranked by relevance."""
+    query = flask.request.args.get("q")
+    if not query:
+        flask.abort(400)
+    limit = min(flask.request.args.get("limit", 10, type=int), BOOKS_PER_PAGE)
+    if limit < 1:
+        flask.abort(400)
+    return json_response(
+        {
+            "books": [
+                {"isbn": str(isbn), "title": title, "cover": cover}
+                for title, cover, isbn in search_titles(query, limit)
+            ]
+        }
+    )
+
+
+def string_list(value):
+    """Checks if a JSON value is a non-empty list of non-empty strings."""
+    return (
+        isinstance(value, list)
+        and len(value) > 0
+        and all(isinstance(item, str) and item for item in value)
+    )
+
+
+@api.route("/recommendations", methods=["POST"])
+@login_required
+def api_recommend():
+    """Recommends every book in the JSON body's "isbns" list to every user in its "usernames" list (at most MAX_BULK_RECOMMENDATIONS pairs) at once, returning how many were added, how many had been sent before, and the usernames that weren't found."""
+    body = flask.request.get_json(silent=True)
+    if not isinstance(body, dict):
+        flask.abort(400)
+    usernames, isbns = body.get("usernames"), body.get("isbns")
+    if not string_list(usernames) or not string_list(isbns):
+        flask.abort(400)
+    # ISBNs are normalized as they are on import, so ISBN-10s are stored as ISBN-13s.
+    isbns = [normalize_isbn(isbn) for isbn in isbns]
+    if None in isbns:
+        flask.abort(400)
+    if len(usernames) * len(isbns) > MAX_BULK_RECOMMENDATIONS:
+        flask.abort(413)
+    try:
+        recommended, already_recommended, unknown_usernames = recommend_books(
+            current_user.id, usernames, isbns
+        )
+    except IntegrityError:
+        db.session.rollback()
+        flask.abort(409)
+    return flask.jsonify(
+        {
+            "recommended": recommended,
+            "already_recommended": already_recommended,
+            "unknown_usernames": unknown_usernames,
+        }
+    )
+
+
+# Favorites are imported, and every list exported, a line at a time: imports are written in batches of
+# IMPORT_BATCH_SIZE books, and exports are read EXPORT_BATCH_SIZE rows at a time while the response streams.
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 200))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+# Themes that weren't cached or in the catalog when a batch was imported are looked up on this pool, after the
+# import has responded.
+theme_fill_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("THEME_FILL_WORKERS", 1))
+)
+
+
+def fill_favorite_themes(app, user_id, isbns):
+    """Looks up the books of a user's favorites imported without a theme, then stores their themes and adds them to the theme histogram. Books that still can't be found keep a NULL theme for migrations.py to retry."""
+    with app.app_context():
+        isbns_by_theme = {}
+        for book in basic_book_info_many(isbns):
+            if book.primary_theme is not None:
+                isbns_by_theme.setdefault(book.primary_theme, []).append(book.isbn)
+        for theme, theme_isbns in isbns_by_theme.items():
+            # Only rows still without a theme are counted, in case they were deleted or filled in meanwhile.
+            updated = Favorites.query.filter(
+                Favorites.user_id == user_id,
+                Favorites.bookISBN.in_(theme_isbns),
+                Favorites.theme.is_(None),
+            ).update({"theme": theme}, synchronize_session=False)
+            if updated:
+                update_theme_count(user_id, theme, updated)
+        db.session.commit()
+
+
+def add_favorites(user_id, isbns):
+    """Adds a batch of distinct ISBNs to a user's favorites with one query for the ones already there, one bulk insert, and one commit, keeping the theme histogram up to date. Returns how many were added and how many were already favorites."""
+    existing_isbns = {
+        isbn
+        for (isbn,) in db.session.query(Favorites.bookISBN).filter(
+            Favorites.user_id == user_id, Favorites.bookISBN.in_(isbns)
+        )
+    }
+    new_isbns = [isbn for isbn in isbns if isbn not in existing_isbns]
+    if not new_isbns:
+        return 0, len(existing_isbns)
+
+    # Only themes already in the cache or catalog are stored now, so an import never waits on Penguin. The rest
+    # are inserted as NULL and filled in on theme_fill_pool once the batch is committed.
+    records = lookup_title_records(new_isbns)
+    themes = [
+        records[isbn].primary_theme if isbn in records else None for isbn in new_isbns
+    ]
+    db.session.bulk_insert_mappings(
+        Favorites,
+        [
+            {"user_id": user_id, "bookISBN": isbn, "theme": theme}
+            for isbn, theme in zip(new_isbns, themes)
+        ],
+    )
+    theme_changes = Counter(theme for theme in themes if theme is not None)
+    theme_counts = FavoriteThemes.query.filter(
+        FavoriteThemes.user_id == user_id, FavoriteThemes.theme.in_(theme_changes)
+    ).all()
+    for theme_count in theme_counts:
+        theme_count.count += theme_changes.pop(theme_count.theme)
+    for theme, change in theme_changes.items():
+        db.session.add(FavoriteThemes(user_id=user_id, theme=theme, count=change))
+    db.session.commit()
+
+    unknown_isbns = [isbn for isbn in new_isbns if isbn not in records]
+    if unknown_isbns:
+        theme_fill_pool.submit(
+            fill_favorite_themes,
+            flask.current_app._get_current_object(),
+            user_id,
+            unknown_isbns,
+        )
+    return len(new_isbns), len(existing_isbns)
+
+
+def import_favorites(user_id, isbns):
+    """Adds every ISBN yielded by isbns (None standing for an invalid entry) to a user's favorites, IMPORT_BATCH_SIZE at a time. Returns how many were added, how many were already favorites or repeated, and how many were invalid."""
+    added = duplicates = invalid = 0
+    seen = set()
+    batch = []
+    for isbn in isbns:
+        if isbn is None:
+            invalid += 1
+        elif isbn in seen:
+            duplicates += 1
+        else:
+            seen.add(isbn)
+            batch.append(isbn)
+        if len(batch) == IMPORT_BATCH_SIZE:
+            batch_added, batch_duplicates = add_favorites(user_id, batch)
+            added, duplicates = added + batch_added, duplicates + batch_duplicates
+            batch = []
+    if batch:
+        batch_added, batch_duplicates = add_favorites(user_id, batch)
+        added, duplicates = added + batch_added, duplicates + batch_duplicates
+    return added, duplicates, invalid
+
+
+def export_favorites(user_id):
+    """Returns the columns of a favorites export and an iterator over the user's favorites, oldest first."""
+    rows = (
+        db.session.query(Favorites.bookISBN, Favorites.theme)
+        .filter(Favorites.user_id == user_id)
+        .order_by(Favorites.id)
+    )
+    return ["isbn", "theme"], rows.yield_per(EXPORT_BATCH_SIZE)
+
+
+def export_recommendations(user_id):
+    """Returns the columns of a recommendations export and an iterator over the recommendations the user received, oldest first."""
+    rows = (
+        db.session.query(Recommendations.bookISBN, Users.username)
+        .join(Users, Users.id == Recommendations.sender_id)
+        .filter(Recommendations.receiver_id == user_id)
+        .order_by(Recommendations.id)
+    )
+    return ["isbn", "sender"], rows.yield_per(EXPORT_BATCH_SIZE)
+
+
+def export_reviews(user_id):
+    """Returns the columns of a reviews export and an iterator over the reviews the user wrote, oldest first."""
+    rows = (
+        db.session.query(Review.isbn, Review.rating, Review.comment)
+        .filter(Review.user_id == user_id)
+        .order_by(Review.id)
+    )
+    return (
+        ["isbn", "rating", "comment"],
+        (
+            (isbn, int(rating), comment)
+            for isbn, rating, comment in rows.yield_per(EXPORT_BATCH_SIZE)
+        ),
+    )
+
+
+EXPORTS = {
+    "favorites": export_favorites,
+    "recommendations": export_recommendations,
+    "reviews": export_reviews,
+}
+
+
+@api.route("/favorites/import", methods=["POST"])
+@login_required
+def api_import_favorites():
+    """Adds every book listed in an uploaded CSV or JSON Lines "file" to the user's favorites, returning how many were added, how many were already favorites, and how many entries weren't valid ISBNs. The format is read from the "format" argument, or else the file's extension."""
+    upload = flask.request.files.get("file")
+    if upload is None:
+        flask.abort(400)
+    file_format = (
+        flask.request.args.get("format")
+        or os.path.splitext(upload.filename or "")[1].lstrip(".").lower()
+    )
+    if file_format not in FORMATS:
+        flask.abort(400)
+    try:
+        added, duplicates, invalid = import_favorites(
+            current_user.id, read_isbns(upload.stream, file_format)
+        )
+    except UnicodeDecodeError:
+        # Batches read before the bad line are kept; importing the file again skips them as duplicates.
+        db.session.rollback()
+        flask.abort(400)
+    return flask.jsonify({"added": added, "duplicates": duplicates, "invalid": invalid})
+
+
+@api.route("/<any(favorites, recommendations, reviews):kind>/export")
+@login_required
+def api_export(kind):
+    """Streams the user's favorites, received recommendations, or reviews as a CSV (the default) or JSON Lines ("format=jsonl") download."""
+    file_format = flask.request.args.get("format", "csv")
+    if file_format not in FORMATS:
+        flask.abort(400)
+    columns, rows = EXPORTS[kind](current_user.id)
+    response = flask.Response(
+        flask.stream_with_context(write_rows(columns, rows, file_format)),
+        mimetype=FORMATS[file_format],
+    )
+    response.headers["Content-Disposition"] = "attachment; filename=%s.%s" % (
+        kind,
+        file_format,
+    )
+    return response
+
+
+@api.route("/books/<isbn>")
+@login_required
+async def api_book(isbn):
+    """Returns everything the book page shows about a book, along with its review aggregates."""
+    book = await all_book_info_async(isbn)
+    if not book.found:
+        # As with /book_details, a book Penguin has no title for is a 404 and a failed lookup is a 503.
+        flask.abort(404 if known_missing([book.isbn]) else 503)
+    review_stats = await sync_to_async(
+        lambda: ReviewStats.query.get(isbn), thread_sensitive=True
+    )()
+    return json_response(
+        {
+            "isbn": book.isbn,
+            "title": book.title,
+            "cover": book.cover,
+            "author": book.author.strip(),
+            "flapcopy": book.flapcopy,
+            "author_bio": book.author_bio,
+            "pages": book.pages,
+            "themes": list(book.themes),
+            "reviews": review_stats_json(review_stats),
+        }
+    )
+
+
+@api.route("/books/<isbn>/reviews")
+@login_required
+def api_reviews(isbn):
+    """Returns the page of a book's reviews older than the "before" cursor, newest first."""
+    reviews, next_cursor = review_page(isbn, flask.request.args.get("before", type=int))
+    return json_response(
+        {
+            "reviews": [
+                {
+                    "id": review.id,
+                    "username": review.username,
+                    "rating": int(review.rating),
+                    "comment": review.comment,
+                }
+                for review in reviews
+            ],
+            "next": next_cursor,
+        }
+    )
+
+
+if __name__ == "__main__":
+    app = create_app()
+    start_background_jobs(app)
+    app.run(
+        host=os.getenv("IP", "0.0.0.0"), port=int(os.getenv("PORT", 8080)), debug=True
+    )
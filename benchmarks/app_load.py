@@ -0,0 +1,250 @@
+# Drives the app's heaviest pages with synthetic users against the fake Penguin API (fake_penguin.py) and
+# reports each page's latency percentiles, throughput, and how many upstream calls it made per request.
+# The app runs in this process on a throwaway SQLite database; the fake API runs in its own process
+# (unless --penguin-url points at one that's already running) so it doesn't compete with the app for the GIL.
+# Usage: python benchmarks/app_load.py [--users N] [--favorites N] [--requests N] [--concurrency N] [--cold]
+#                                      [--latency MS] [--error-rate P] [--payload-size BYTES] [--penguin-url URL]
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import requests
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+
+def start_fake_penguin(latency, error_rate, payload_size):
+    """Starts fake_penguin.py on a free local port and returns its process and titles URL once it is serving."""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(BENCHMARKS_DIR, "fake_penguin.py"),
+            "--port=%d" % port,
+            "--latency=%s" % latency,
+            "--error-rate=%s" % error_rate,
+            "--payload-size=%d" % payload_size,
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    base_url = "http://127.0.0.1:%d/resources/titles" % port
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            upstream_requests(base_url)
+            return process, base_url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The fake Penguin API didn't start")
+
+
+def upstream_requests(base_url):
+    """Returns how many requests the fake Penguin API has served."""
+    stats_url = base_url.rsplit("/resources/", 1)[0] + "/stats"
+    return requests.get(stats_url, timeout=5).json()["requests"]
+
+
+def percentile(sorted_values, fraction):
+    """Returns the nearest-rank percentile of an already sorted list."""
+    index = max(
+        0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1)
+    )
+    return sorted_values[index]
+
+
+def seed_users(user_count, favorite_count, isbns, themes):
+    """Creates the synthetic users, each with favorite_count favorites and as many recommendations from the next user."""
+    from models import db, Users, Favorites, FavoriteThemes, Recommendations
+
+    users = [
+        Users(
+            username="reader%d" % index,
+            email="reader%d@example.com" % index,
+            password="x",
+        )
+        for index in range(user_count)
+    ]
+    db.session.add_all(users)
+    db.session.commit()
+    for index, user in enumerate(users):
+        sender = users[(index + 1) % user_count]
+        theme_counts = Counter()
+        for position in range(favorite_count):
+            isbn = isbns[(index + position) % len(isbns)]
+            theme = themes[position % len(themes)]
+            theme_counts[theme] += 1
+            db.session.add(Favorites(user_id=user.id, bookISBN=isbn, theme=theme))
+            db.session.add(
+                Recommendations(sender_id=sender.id, receiver_id=user.id, bookISBN=isbn)
+            )
+        for theme, count in theme_counts.items():
+            db.session.add(FavoriteThemes(user_id=user.id, theme=theme, count=count))
+    db.session.commit()
+    return [user.id for user in users]
+
+
+def run_scenario(app, user_ids, request_count, concurrency, send):
+    """Sends request_count requests with send(client) from concurrency threads, each signed in as a synthetic user. Returns the sorted latencies, the number of failed requests, and the elapsed time."""
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+    remaining = [request_count]
+
+    def worker(user_id):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(user_id)
+            session["_fresh"] = True
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            started = time.perf_counter()
+            response = send(client)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code >= 400:
+                    failures.append(response.status_code)
+
+    threads = [
+        threading.Thread(target=worker, args=(user_ids[index % len(user_ids)],))
+        for index in range(concurrency)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), len(failures), time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the app's pages against a fake Penguin API."
+    )
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument(
+        "--favorites",
+        type=int,
+        default=24,
+        help="favorites (and received recommendations) per user",
+    )
+    parser.add_argument(
+        "--requests", type=int, default=200, help="requests sent to each page"
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--cold",
+        action="store_true",
+        help="empty the app's caches before each page's run, rather than filling them first",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=50, help="fake Penguin latency in milliseconds"
+    )
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--payload-size", type=int, default=0)
+    parser.add_argument(
+        "--penguin-url", help="titles URL of a fake Penguin API that's already running"
+    )
+    args = parser.parse_args()
+
+    process = None
+    if args.penguin_url is None:
+        process, args.penguin_url = start_fake_penguin(
+            args.latency, args.error_rate, args.payload_size
+        )
+    # penguin.py reads its settings on import, so they must be in place first.
+    os.environ["PENGUIN_BASE_URL"] = args.penguin_url
+    database_path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+
+    from app import create_app, book_details_cache
+    from models import BOOK_THEMES
+    from penguin import title_cache, theme_pools, lookup_flights
+
+    try:
+        app = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": "sqlite:///" + database_path,
+                "WTF_CSRF_ENABLED": False,
+                "REQUEST_LOG": False,
+            }
+        )
+        with app.app_context():
+            isbns = [str(9780000000000 + index) for index in range(args.favorites * 2)]
+            user_ids = seed_users(args.users, args.favorites, isbns, BOOK_THEMES)
+
+        scenarios = [
+            ("/homepage", lambda client: client.get("/homepage")),
+            ("/favorites", lambda client: client.get("/favorites")),
+            ("/recommendations", lambda client: client.get("/recommendations")),
+            (
+                "/get_book_info",
+                lambda client: client.get("/get_book_info?isbn=" + isbns[0]),
+            ),
+            (
+                "/handle_theme_suggestions",
+                lambda client: client.post(
+                    "/handle_theme_suggestions", data={"theme": BOOK_THEMES[0]}
+                ),
+            ),
+        ]
+
+        print(
+            "%d users x %d favorites, %d requests per page from %d threads, %s caches"
+            % (
+                args.users,
+                args.favorites,
+                args.requests,
+                args.concurrency,
+                "cold" if args.cold else "warm",
+            )
+        )
+        print(
+            "%-26s %8s %8s %8s %8s %8s %10s"
+            % ("page", "p50 ms", "p95 ms", "p99 ms", "req/s", "errors", "upstream/req")
+        )
+        for name, send in scenarios:
+            if args.cold:
+                title_cache.clear()
+                theme_pools.clear()
+                book_details_cache.clear()
+                lookup_flights.clear()
+            else:
+                # One untimed request per user fills the caches first.
+                run_scenario(app, user_ids, len(user_ids), len(user_ids), send)
+            calls_before = upstream_requests(args.penguin_url)
+            latencies, failures, elapsed = run_scenario(
+                app, user_ids, args.requests, args.concurrency, send
+            )
+            upstream_calls = upstream_requests(args.penguin_url) - calls_before
+            print(
+                "%-26s %8.1f %8.1f %8.1f %8.1f %8d %10.2f"
+                % (
+                    name,
+                    percentile(latencies, 0.50) * 1000,
+                    percentile(latencies, 0.95) * 1000,
+                    percentile(latencies, 0.99) * 1000,
+                    len(latencies) / elapsed,
+                    failures,
+                    upstream_calls / len(latencies),
+                )
+            )
+    finally:
+        if process is not None:
+            process.kill()
+
+
+if __name__ == "__main__":
+    main()
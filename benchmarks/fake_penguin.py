@@ -0,0 +1,204 @@
+# A local stand-in for Penguin's titles API (reststop.randomhouse.com/resources/titles), for benchmarks.
+# It serves single titles (/resources/titles/ISBN) and pages of titles (/resources/titles?start=&max=&theme=&search=)
+# with a configurable latency, error rate, and payload size. Titles come from a fixture file, and any other
+# ISBN gets a synthetic record, so every lookup succeeds. GET /stats returns how many requests were served.
+# Point the app at it with PENGUIN_BASE_URL=http://127.0.0.1:PORT/resources/titles.
+# Usage: python benchmarks/fake_penguin.py [--port N] [--latency MS] [--error-rate P] [--payload-size BYTES]
+#                                          [--fixtures PATH]
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), "fixtures", "titles.json")
+TITLES_PATH = "/resources/titles"
+# Theme pages are padded with this many synthetic titles, numbered from SYNTHETIC_ISBN.
+SYNTHETIC_ISBN = 9790000000000
+SYNTHETIC_TITLES = 2000
+
+
+class FakePenguinHandler(BaseHTTPRequestHandler):
+    """Answers titles API requests from the server's fixtures."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/stats":
+            return self.send_json(200, self.server.stats())
+        if not url.path.startswith(TITLES_PATH):
+            return self.send_json(404, {"error": "not found"})
+
+        self.server.count_request()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            return self.send_json(503, {"error": "unavailable"})
+
+        isbn = url.path[len(TITLES_PATH) :].strip("/")
+        if isbn:
+            return self.send_json(200, self.server.title(isbn))
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        titles = self.server.title_page(
+            int(params.get("start", 0)),
+            int(params.get("max", 10)),
+            params.get("theme"),
+            params.get("search"),
+        )
+        # Like Penguin, a page holding a single title is returned as an object rather than a list.
+        return self.send_json(200, {"title": titles[0] if len(titles) == 1 else titles})
+
+    def send_json(self, status, payload):
+        """Writes a JSON response."""
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Keeps the benchmark's output free of per-request log lines."""
+
+
+class FakePenguinServer(ThreadingHTTPServer):
+    """Serves the fake titles API on a local port. Call start() to run it on a daemon thread."""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port=0,
+        latency=0.0,
+        error_rate=0.0,
+        payload_size=0,
+        fixtures_path=FIXTURES_PATH,
+        themes=None,
+    ):
+        super().__init__(("127.0.0.1", port), FakePenguinHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        # Each flapcopy is padded to at least this many bytes, to model larger records.
+        self.payload_size = payload_size
+        with open(fixtures_path) as fixtures_file:
+            self.fixtures = {
+                str(title["isbn"]): title for title in json.load(fixtures_file)
+            }
+        self.themes = themes or sorted(
+            {
+                theme
+                for title in self.fixtures.values()
+                for theme in title.get("themes", {}).get("theme", [])
+            }
+        )
+        self.synthetic_titles = [
+            self.title(str(SYNTHETIC_ISBN + index)) for index in range(SYNTHETIC_TITLES)
+        ]
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def base_url(self):
+        """The URL to use as PENGUIN_BASE_URL."""
+        return "http://127.0.0.1:%d%s" % (self.server_address[1], TITLES_PATH)
+
+    def start(self):
+        """Serves requests on a daemon thread, returning the thread."""
+        thread = threading.Thread(
+            target=self.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+        thread.start()
+        return thread
+
+    def count_request(self):
+        """Counts one request to the titles API."""
+        with self.lock:
+            self.requests += 1
+
+    def stats(self):
+        """Returns how many titles API requests have been served."""
+        with self.lock:
+            return {"requests": self.requests}
+
+    def reset_stats(self):
+        """Resets the request counter."""
+        with self.lock:
+            self.requests = 0
+
+    def title(self, isbn):
+        """Returns the fixture for an ISBN, or a synthetic title record if there isn't one."""
+        title = self.fixtures.get(isbn)
+        if title is None:
+            # Synthetic records are stable, so repeated lookups of one ISBN return the same book.
+            number = int(isbn) if isbn.isdigit() else abs(hash(isbn))
+            title = {
+                "isbn": isbn,
+                "titleweb": "Synthetic Book %s" % isbn,
+                "@uri": "https://example.com/covers/%s.jpg" % isbn,
+                "author": "Author, Synthetic",
+                "flapcopy": "<p>A <b>synthetic</b> book for benchmarks.</p>",
+                "authorbio": "<p>Writes synthetic books.</p>",
+                "pages": 100 + number % 400,
+                "themes": {"theme": [self.themes[number % len(self.themes)]]},
+            }
+        if len(title.get("flapcopy", "")) < self.payload_size:
+            padding = (
+                "<p>" + "x" * (self.payload_size - len(title["flapcopy"])) + "</p>"
+            )
+            title = dict(title, flapcopy=title["flapcopy"] + padding)
+        return title
+
+    def title_page(self, start, max_results, theme=None, search=None):
+        """Returns one page of titles, optionally filtered by theme or by a search term found in their titles."""
+        titles = [self.title(isbn) for isbn in self.fixtures]
+        if theme is not None:
+            # Synthetic titles pad out every theme, so suggestion pools span several pages.
+            titles += self.synthetic_titles
+            titles = [
+                title
+                for title in titles
+                if theme in title.get("themes", {}).get("theme", [])
+            ]
+        if search is not None:
+            titles = [
+                title for title in titles if search.lower() in title["titleweb"].lower()
+            ]
+        return titles[start : start + max_results]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Penguin titles API.")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument(
+        "--latency", type=float, default=50, help="milliseconds added to every request"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0,
+        help="fraction of requests answered with a 503",
+    )
+    parser.add_argument(
+        "--payload-size",
+        type=int,
+        default=0,
+        help="minimum size in bytes of each title's flapcopy",
+    )
+    parser.add_argument("--fixtures", default=FIXTURES_PATH)
+    args = parser.parse_args()
+
+    server = FakePenguinServer(
+        args.port,
+        args.latency / 1000,
+        args.error_rate,
+        args.payload_size,
+        args.fixtures,
+    )
+    print("Serving the fake Penguin API at %s" % server.base_url)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+# Compares the streaming tag stripper with the BeautifulSoup one on a typical flapcopy.
+# Usage: python benchmarks/tag_remove.py [--number N]
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from penguin import tag_remove, tag_remove_soup
+
+# Roughly the size and markup of a Penguin flapcopy.
+SAMPLE_HTML = (
+    "<p><b>A NEW YORK TIMES BESTSELLER</b></p>"
+    + "<p>In a hole in the ground there lived a <i>hobbit</i>. Not a nasty, dirty, "
+    "wet hole &mdash; it was a hobbit-hole, and that means <b>comfort</b>.</p>" * 12
+    + "<p>&ldquo;A glorious account of a magnificent adventure.&rdquo;<br/>"
+    "&mdash;<i>The Times</i></p>"
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark tag_remove() against the BeautifulSoup tag stripper."
+    )
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    assert tag_remove(SAMPLE_HTML) == tag_remove_soup(SAMPLE_HTML)
+    for name, function in [
+        ("html.parser streaming", tag_remove),
+        ("BeautifulSoup", tag_remove_soup),
+    ]:
+        seconds = min(
+            timeit.repeat(lambda: function(SAMPLE_HTML), number=args.number, repeat=5)
+        )
+        print("%-22s %8.1f us/call" % (name, seconds / args.number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# Reads and writes lists of books as CSV or JSON Lines files, for importing favorites and exporting a user's lists.
+# Both directions work a line at a time, so a list of any length is never held in memory whole.
+import codecs
+import csv
+import io
+import itertools
+import json
+
+# Supported file formats and their content types.
+FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+# CSV columns that may hold a book's ISBN, most preferred first. Exports from other reading trackers often leave
+# their ISBN-10 column blank, so a row's ISBN is taken from the first of these columns that holds one.
+ISBN_COLUMNS = ["isbn13", "isbn", "isbn/uid", "isbn10"]
+# Exported files are sent in chunks of about this many characters.
+CHUNK_SIZE = 16384
+
+
+def isbn13_check_digit(stem):
+    """Returns the check digit that completes the first 12 digits of an ISBN-13."""
+    weighted_sum = sum(
+        int(digit) * (3 if position % 2 else 1) for position, digit in enumerate(stem)
+    )
+    return str(-weighted_sum % 10)
+
+
+def is_isbn13(value):
+    """Checks if value is an ISBN-13 written as 13 digits, ending in the right check digit."""
+    return (
+        isinstance(value, str)
+        and len(value) == 13
+        and value.isdigit()
+        and isbn13_check_digit(value[:12]) == value[12]
+    )
+
+
+def normalize_isbn(value):
+    """Returns the ISBN-13 form of an ISBN-10 or ISBN-13, ignoring hyphens, spaces, and spreadsheet quoting (="..."), or None if value isn't one."""
+    if not isinstance(value, (str, int)) or isinstance(value, bool):
+        return None
+    characters = "".join(
+        character
+        for character in str(value).upper()
+        if character.isdigit() or character == "X"
+    )
+    if len(characters) == 13 and characters.isdigit():
+        return characters
+    if len(characters) == 10 and characters[:9].isdigit():
+        # An ISBN-10 becomes an ISBN-13 by prefixing 978 and recomputing the check digit.
+        stem = "978" + characters[:9]
+        return stem + isbn13_check_digit(stem)
+    return None
+
+
+def read_isbns(stream, file_format):
+    """Yields the ISBN-13 of each book listed in an uploaded binary file, or None for each entry that doesn't hold a valid ISBN. JSON Lines files hold an object with an "isbn" key (or a bare ISBN) on each line. CSV files are read from their ISBN_COLUMNS, or as one ISBN per line in the first column if their header names none of them."""
+    lines = codecs.iterdecode(stream, "utf-8-sig")
+    if file_format == "jsonl":
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                yield None
+                continue
+            yield normalize_isbn(item.get("isbn") if isinstance(item, dict) else item)
+        return
+
+    rows = csv.reader(lines)
+    header = next(rows, [])
+    names = [name.strip().lower() for name in header]
+    columns = [names.index(name) for name in ISBN_COLUMNS if name in names]
+    if not columns:
+        columns = [0]
+        rows = itertools.chain([header], rows)
+    for row in rows:
+        if not any(cell.strip() for cell in row):
+            continue
+        isbns = (normalize_isbn(row[column]) for column in columns if column < len(row))
+        yield next((isbn for isbn in isbns if isbn is not None), None)
+
+
+def csv_cell(value):
+    """Returns a CSV cell's value, with text that a spreadsheet would run as a formula prefixed by a quote."""
+    if isinstance(value, str) and value[:1] in ("=", "+", "-", "@"):
+        return "'" + value
+    return value
+
+
+def write_rows(columns, rows, file_format):
+    """Yields the text of a CSV file (with a header row) or a JSON Lines file (an object per row) holding rows, in chunks of about CHUNK_SIZE characters."""
+    buffer = io.StringIO()
+    if file_format == "jsonl":
+        write = lambda row: buffer.write(json.dumps(dict(zip(columns, row))) + "\n")
+    else:
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        write = lambda row: writer.writerow([csv_cell(value) for value in row])
+
+    for row in rows:
+        write(row)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -0,0 +1,624 @@
+import asyncio
+import json
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from urllib.parse import urlparse
+
+# Serialized values longer than this many bytes are compressed.
+COMPRESS_THRESHOLD = 512
+
+# Returned by TTLCache.check_fill() while another worker is still computing a value.
+PENDING = object()
+
+
+def pack(value):
+    """Serializes a JSON-compatible value as compactly as possible. A one-byte marker records whether it was compressed."""
+    data = json.dumps(value, separators=(",", ":")).encode("utf-8")
+    if len(data) > COMPRESS_THRESHOLD:
+        return b"z" + zlib.compress(data)
+    return b"j" + data
+
+
+def unpack(data):
+    """Reverses pack()."""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if data[:1] == b"z":
+        return json.loads(zlib.decompress(data[1:]))
+    if data[:1] == b"j":
+        return json.loads(data[1:])
+    # Values written before pack() existed are plain JSON text.
+    return json.loads(data)
+
+
+class CacheBackend:
+    """The interface shared by every second-tier store behind TTLCache. Stores hold JSON-compatible values with a per-key TTL, and provide short-lived locks that let one process at a time refresh a key."""
+
+    def get(self, key):
+        """Returns the stored value and its expiry time, or None if the key is missing or expired."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        """Stores a value for ttl seconds."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Removes a stored value."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Removes every stored value and lock."""
+        raise NotImplementedError
+
+    def acquire_lock(self, key, ttl):
+        """Takes the lock on a key for at most ttl seconds. Returns a token to release it with, or None if someone else holds it."""
+        raise NotImplementedError
+
+    def release_lock(self, key, token):
+        """Releases a lock taken by acquire_lock(), unless it has already expired and been taken by someone else."""
+        raise NotImplementedError
+
+    def is_locked(self, key):
+        """Checks if anyone currently holds the lock on a key."""
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """A store that lives in the current process, so it is only shared between the threads of one worker."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.locks = {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.values.get(key)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.values[key] = (value, time.time() + ttl)
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+            self.locks.clear()
+
+    def acquire_lock(self, key, ttl):
+        now = time.time()
+        with self.lock:
+            held = self.locks.get(key)
+            if held is not None and held[1] > now:
+                return None
+            token = uuid.uuid4().hex
+            self.locks[key] = (token, now + ttl)
+            return token
+
+    def release_lock(self, key, token):
+        with self.lock:
+            held = self.locks.get(key)
+            if held is not None and held[0] == token:
+                del self.locks[key]
+
+    def is_locked(self, key):
+        with self.lock:
+            held = self.locks.get(key)
+            return held is not None and held[1] > time.time()
+
+
+class SQLiteStore(CacheBackend):
+    """A small on-disk store, shared by every worker process on the same machine."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_locks (key TEXT PRIMARY KEY, token TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return unpack(row[0]), row[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, pack(value), time.time() + ttl),
+            )
+            self.connection.commit()
+
+    def delete(self, key):
+        with self.lock:
+            self.connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM cache")
+            self.connection.execute("DELETE FROM cache_locks")
+            self.connection.commit()
+
+    def acquire_lock(self, key, ttl):
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM cache_locks WHERE key = ? AND expires_at <= ?", (key, now)
+            )
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO cache_locks (key, token, expires_at) VALUES (?, ?, ?)",
+                (key, token, now + ttl),
+            )
+            self.connection.commit()
+        return token if cursor.rowcount == 1 else None
+
+    def release_lock(self, key, token):
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM cache_locks WHERE key = ? AND token = ?", (key, token)
+            )
+            self.connection.commit()
+
+    def is_locked(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM cache_locks WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+        return row is not None
+
+
+class RedisError(Exception):
+    """Raised when a Redis server replies with an error."""
+
+
+class RedisBackend(CacheBackend):
+    """A store kept on a Redis (or Redis-protocol compatible) server and shared by every worker that connects to it. Speaks RESP directly over a socket, with one connection per thread."""
+
+    def __init__(
+        self, host="localhost", port=6379, db=0, prefix="bookbite:", timeout=1
+    ):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.prefix = prefix
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connect(self):
+        """Returns this thread's connection to the server, opening it first if needed."""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+            connection = (sock, sock.makefile("rb"))
+            self.local.connection = connection
+            if self.db:
+                self.execute("SELECT", self.db)
+        return connection
+
+    def disconnect(self):
+        """Closes this thread's connection, if it has one."""
+        connection = getattr(self.local, "connection", None)
+        self.local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def execute(self, *args):
+        """Sends a command and returns the server's reply."""
+        request = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            request.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        sock, reader = self.connect()
+        try:
+            sock.sendall(b"".join(request))
+            return self.read_reply(reader)
+        except OSError:
+            # The connection may be left partway through a reply, so it is never reused after a failure.
+            self.disconnect()
+            raise
+
+    def read_reply(self, reader):
+        """Reads one RESP reply."""
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by the Redis server")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode("utf-8")
+        if kind == b"-":
+            raise RedisError(body.decode("utf-8"))
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            if int(body) < 0:
+                return None
+            return reader.read(int(body) + 2)[:-2]
+        if kind == b"*":
+            if int(body) < 0:
+                return None
+            return [self.read_reply(reader) for item in range(int(body))]
+        raise RedisError("Unexpected reply from the Redis server: %r" % line)
+
+    def get(self, key):
+        data = self.execute("GET", self.prefix + key)
+        if data is None:
+            return None
+        # The expiry time is stored alongside the value, since TTLCache needs it.
+        expires_at, value = unpack(data)
+        return value, expires_at
+
+    def set(self, key, value, ttl):
+        self.execute(
+            "SET",
+            self.prefix + key,
+            pack([time.time() + ttl, value]),
+            "PX",
+            max(int(ttl * 1000), 1),
+        )
+
+    def delete(self, key):
+        self.execute("DEL", self.prefix + key)
+
+    def clear(self):
+        keys = self.execute("KEYS", self.prefix + "*")
+        if keys:
+            self.execute("DEL", *keys)
+
+    def acquire_lock(self, key, ttl):
+        token = uuid.uuid4().hex
+        acquired = self.execute(
+            "SET", self.prefix + "lock:" + key, token, "NX", "PX", int(ttl * 1000)
+        )
+        return token if acquired is not None else None
+
+    def release_lock(self, key, token):
+        # Not atomic, but a lock that expires in between is only released a little early.
+        if self.execute("GET", self.prefix + "lock:" + key) == token.encode("utf-8"):
+            self.execute("DEL", self.prefix + "lock:" + key)
+
+    def is_locked(self, key):
+        return self.execute("EXISTS", self.prefix + "lock:" + key) == 1
+
+
+def backend_from_url(url):
+    """Returns the store described by a URL: memory://, sqlite:///relative/path, sqlite:////absolute/path, or redis://host:port/db."""
+    parsed = urlparse(url)
+    if parsed.scheme == "memory":
+        return MemoryBackend()
+    if parsed.scheme == "sqlite":
+        return SQLiteStore(parsed.path[1:])
+    if parsed.scheme == "redis":
+        return RedisBackend(
+            host=parsed.hostname or "localhost",
+            port=parsed.port or 6379,
+            db=int(parsed.path[1:] or 0),
+        )
+    raise ValueError("Unsupported cache URL: " + url)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key within one process: the first caller does the work and everyone who asks while it is in flight shares its result (or exception)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def join(self, key):
+        """Returns the future for a key's in-flight call, and whether the caller is the leader who must complete it."""
+        with self.lock:
+            self.calls += 1
+            future = self.flights.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            # A thread-safe future lets sync callers and async views on other event loops wait on the same call.
+            future = Future()
+            self.flights[key] = future
+            return future, True
+
+    def land(self, key):
+        """Forgets a key's finished call, so the next caller starts a new one."""
+        with self.lock:
+            self.flights.pop(key, None)
+
+    def do(self, key, function):
+        """Returns function()'s result, sharing a single call among every concurrent caller with the same key."""
+        future, leader = self.join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = function()
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self.land(key)
+
+    async def do_async(self, key, function):
+        """Like do(), for a coroutine function. Waiting on another caller's call doesn't block the event loop."""
+        future, leader = self.join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await function()
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self.land(key)
+
+    def stats(self):
+        """Returns how many calls were made, how many of them were coalesced into another caller's, and how many are in flight."""
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "in_flight": len(self.flights),
+            }
+
+    def clear(self):
+        """Resets the counters."""
+        with self.lock:
+            self.calls = self.coalesced = 0
+
+
+class TTLCache:
+    """A thread-safe, size-bounded LRU cache whose entries expire after a number of seconds, optionally backed by a shared second-tier store."""
+
+    def __init__(
+        self,
+        maxsize=1024,
+        ttl=3600,
+        store=None,
+        encode=None,
+        decode=None,
+        lock_timeout=10,
+        stale_ttl=0,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # For stale_ttl seconds past their TTL, entries can still be served by lookup() while they're refreshed.
+        self.stale_ttl = stale_ttl
+        self.store = store
+        # Values pass through encode() on their way into the store and decode() on their way out.
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda value: value)
+        self.lock_timeout = lock_timeout
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.store_hits = 0
+        self.store_errors = 0
+        self.stale_hits = 0
+
+    def __contains__(self, key):
+        """Checks if a fresh in-memory entry exists for a key without touching the counters or LRU order."""
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[1] > time.time()
+
+    def get(self, key):
+        """Returns the fresh cached value for a key, or None on a miss. Hits refresh the key's LRU position."""
+        value, fresh = self.lookup(key)
+        return value if fresh else None
+
+    def lookup(self, key):
+        """Returns (value, fresh) for a key, or (None, False) on a miss. For stale_ttl seconds after expiring, the value is still returned, marked as stale."""
+        now = time.time()
+        stale = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value, True
+                if expires_at + self.stale_ttl > now:
+                    stale = value
+                else:
+                    # Expired entries are kept (until evicted) for get_stale() and the store's stale copies.
+                    self.expirations += 1
+
+        # The store is consulted outside of the lock since it may touch the disk or network.
+        # A stale entry is checked there too, in case another worker has already refreshed it.
+        stored = self.get_stored(key)
+        if stored is not None and (stale is None or stored[1] > now):
+            value, expires_at = stored
+            fresh = expires_at > now
+            with self.lock:
+                if fresh:
+                    self.hits += 1
+                else:
+                    self.stale_hits += 1
+            return value, fresh
+
+        with self.lock:
+            if stale is not None:
+                self.entries.move_to_end(key)
+                self.stale_hits += 1
+                return stale, False
+            self.misses += 1
+        return None, False
+
+    def get_stored(self, key):
+        """Returns (value, expires_at) for a key from the store (copying it into memory), or None if there is no store, the key is missing, or the store is unreachable."""
+        if self.store is None:
+            return None
+        try:
+            stored = self.store.get(key)
+            if stored is None:
+                return None
+            # The store keeps values through their stale window, so they expire stale_ttl seconds earlier here.
+            value, expires_at = self.decode(stored[0]), stored[1] - self.stale_ttl
+        except Exception:
+            # An unreachable store only costs a cache miss.
+            with self.lock:
+                self.store_errors += 1
+            return None
+        with self.lock:
+            self._insert(key, value, expires_at)
+            self.store_hits += 1
+        return value, expires_at
+
+    def get_stale(self, key):
+        """Returns the in-memory value for a key even if it has expired, as long as it's within stale_ttl seconds of its TTL. Returns None if it's older, was never cached, or has been evicted."""
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or entry[1] + self.stale_ttl <= time.time():
+            return None
+        return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """Caches a value for ttl seconds (by default, the cache's TTL), evicting the least recently used entry if the cache is full."""
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self._insert(key, value, time.time() + ttl)
+        if self.store is not None:
+            try:
+                self.store.set(key, self.encode(value), ttl + self.stale_ttl)
+            except Exception:
+                with self.lock:
+                    self.store_errors += 1
+
+    def _insert(self, key, value, expires_at):
+        """Places an entry at the most recently used end of the cache. The lock must already be held."""
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def acquire_fill_lock(self, key):
+        """Returns the token for the store's lock on a key, None if no lock was needed (there is no reachable store), or PENDING if another worker holds it."""
+        if self.store is None:
+            return None
+        try:
+            token = self.store.acquire_lock(key, self.lock_timeout)
+        except Exception:
+            with self.lock:
+                self.store_errors += 1
+            return None
+        return PENDING if token is None else token
+
+    def release_fill_lock(self, key, token):
+        """Releases a lock taken by acquire_fill_lock()."""
+        if token is None:
+            return
+        try:
+            self.store.release_lock(key, token)
+        except Exception:
+            with self.lock:
+                self.store_errors += 1
+
+    def check_fill(self, key):
+        """Returns a key's value once the worker computing it has stored it, PENDING while that worker still holds the lock, or None if it gave up."""
+        stored = self.get_stored(key)
+        if stored is not None:
+            return stored[0]
+        try:
+            return PENDING if self.store.is_locked(key) else None
+        except Exception:
+            return None
+
+    def fill(self, key, compute, ttl=None, poll_interval=0.05):
+        """Computes, caches, and returns the value for a missing key. With a shared store, only the worker holding the key's lock calls compute() and the others wait for its result."""
+        token = self.acquire_fill_lock(key)
+        if token is PENDING:
+            token = value = None
+            deadline = time.time() + self.lock_timeout
+            while time.time() < deadline:
+                value = self.check_fill(key)
+                if value is not PENDING:
+                    break
+                time.sleep(poll_interval)
+            if value is not None and value is not PENDING:
+                return value
+        try:
+            value = compute()
+            self.set(key, value, ttl)
+            return value
+        finally:
+            self.release_fill_lock(key, token)
+
+    async def fill_async(self, key, compute, ttl=None, poll_interval=0.05):
+        """Like fill(), for a compute() coroutine function. Waiting on another worker doesn't block the event loop."""
+        token = self.acquire_fill_lock(key)
+        if token is PENDING:
+            token = value = None
+            deadline = time.time() + self.lock_timeout
+            while time.time() < deadline:
+                value = self.check_fill(key)
+                if value is not PENDING:
+                    break
+                await asyncio.sleep(poll_interval)
+            if value is not None and value is not PENDING:
+                return value
+        try:
+            value = await compute()
+            self.set(key, value, ttl)
+            return value
+        finally:
+            self.release_fill_lock(key, token)
+
+    def clear(self):
+        """Empties the cache (and its store) and resets every counter."""
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = self.expirations = 0
+            self.store_hits = self.store_errors = self.stale_hits = 0
+        if self.store is not None:
+            self.store.clear()
+
+    def stats(self):
+        """Returns the cache's hit/miss/eviction counters along with its current size."""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "store_hits": self.store_hits,
+                "store_errors": self.store_errors,
+                "stale_hits": self.stale_hits,
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+            }
@@ -1,6 +1,69 @@
+import io
+import os
+import socketserver
+import tempfile
+import threading
+import time
 import unittest
+import flask
+import httpx
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from sqlalchemy import inspect
+from sqlalchemy.orm import Query
 from unittest.mock import MagicMock, patch
-from penguin import tag_remove, get_themes, get_single_book_theme, title_search
+from penguin import (
+    tag_remove,
+    tag_remove_soup,
+    get_themes,
+    get_single_book_theme,
+    title_search,
+    basic_book_info,
+    basic_book_info_many,
+    all_book_info,
+    title_cache,
+    not_found_cache,
+    remember_missing,
+    book_suggestions,
+    theme_pools,
+    ThemePools,
+    title_index,
+    search_titles,
+    PenguinClient,
+    CircuitBreaker,
+    CircuitOpenError,
+    TitleNotFoundError,
+    get_title_record,
+    BookRecord,
+    lookup_flights,
+    popular_isbns,
+    warm_title_cache,
+    TITLES_URL,
+)
+from search_index import TitleIndex, tokenize
+from book_lists import normalize_isbn, read_isbns
+from cache import TTLCache, MemoryBackend, SQLiteStore, RedisBackend, SingleFlight
+from cache import pack, unpack
+from app import create_app, book_details_cache, start_background_jobs
+from models import db, Users, Favorites, FavoriteThemes, Books, Recommendations, Review
+from models import BookThemes, ReviewStats, ISBN_LENGTH
+from migrations import (
+    add_favorite_themes,
+    rebuild_review_stats,
+    rebuild_theme_histogram,
+    shorten_catalog_isbns,
+    strip_long_isbns,
+    use_user_foreign_keys,
+)
+from ingest_catalog import upsert_books
+from instrumentation import Metrics, RequestTimings, RequestTrace, capture_requests
+from instrumentation import current_timings, metrics
+
+# View tests run against an in-memory database.
+app = create_app(
+    {"SQLALCHEMY_DATABASE_URI": "sqlite://", "TESTING": True, "WTF_CSRF_ENABLED": False}
+)
 
 
 class HtmlTagRemovalTests(unittest.TestCase):
@@ -20,6 +83,17 @@ class HtmlTagRemovalTests(unittest.TestCase):
         function_output = tag_remove(test_string)
         self.assertEqual(expected_output, function_output)
 
+    def test_matches_beautifulsoup(self):
+        """Checks if the streaming tag stripper produces the same text as BeautifulSoup."""
+        test_strings = [
+            "<p>A <b>hobbit</b> goes on an <i>adventure</i>.</p><br/>",
+            "Fish &amp; Chips &eacute;t&#233; &lt;3",
+            "<!-- note -->Before<script>var a = 1 < 2;</script><style>p {}</style>after",
+            "1 < 2 and <![CDATA[raw]]> <b>unclosed",
+        ]
+        for test_string in test_strings:
+            self.assertEqual(tag_remove_soup(test_string), tag_remove(test_string))
+
 
 class ThemeListTests(unittest.TestCase):
     """Houses a couple of tests for Penguin.py's get_themes() function."""
@@ -42,6 +116,10 @@ class ThemeListTests(unittest.TestCase):
 class PenguinTests(unittest.TestCase):
     "Houses a couple of tests involving Penguin's major info-grabbing functions."
 
+    def setUp(self):
+        title_cache.clear()
+        not_found_cache.clear()
+
     def test_specific_book_theme(self):
         """Checks if a single theme is being returned, assuming a book only has one theme."""
         mock_response = MagicMock()
@@ -49,7 +127,7 @@ class PenguinTests(unittest.TestCase):
             "themes": {"theme": ["Coming of Age", "Fantasy", "War"]}
         }
 
-        with patch("penguin.requests.get") as mock_get:
+        with patch("penguin.client.session.get") as mock_get:
             mock_get.return_value = mock_response
             self.assertEqual(get_single_book_theme(123456789123), "Coming of Age")
 
@@ -58,10 +136,1546 @@ class PenguinTests(unittest.TestCase):
         mock_response = MagicMock()
         mock_response.json.return_value = {"title": [{"isbn": 1234567890}]}
 
-        with patch("penguin.requests.get") as mock_get:
+        with patch("penguin.client.session.get") as mock_get:
             mock_get.return_value = mock_response
             self.assertEqual(title_search("Sample Title"), 1234567890)
 
+    def test_clean_text_cached(self):
+        """Checks if a book's flapcopy and author bio are only stripped of HTML once while its record is cached."""
+        mock_response = MagicMock()
+        mock_response.json.return_value = {
+            "isbn": "1",
+            "titleweb": "Title",
+            "@uri": "URL",
+            "author": "Author",
+            "flapcopy": "<p>Summary</p>",
+            "authorbio": "<p>Bio</p>",
+            "pages": 1,
+            "themes": None,
+        }
+        with patch("penguin.client.session.get", return_value=mock_response):
+            self.assertEqual(all_book_info("1").flapcopy, "Summary")
+        with patch("penguin.tag_remove") as mock_tag_remove:
+            self.assertEqual(all_book_info("1").author_bio, "Bio")
+            mock_tag_remove.assert_not_called()
+
+    def test_basic_book_info_many_order(self):
+        """Checks if batched lookups keep the order of the ISBNs provided and fetch duplicates once."""
+
+        def fake_get(url, **kwargs):
+            mock_response = MagicMock()
+            isbn = url.rsplit("/", 1)[-1]
+            mock_response.json.return_value = {
+                "titleweb": "Title " + isbn,
+                "@uri": isbn,
+            }
+            return mock_response
+
+        with patch("penguin.client.session.get", side_effect=fake_get) as mock_get:
+            book_info = [
+                (book.title, book.cover)
+                for book in basic_book_info_many(["3", "1", "2", "1"])
+            ]
+            self.assertEqual(mock_get.call_count, 3)
+        self.assertEqual(
+            book_info,
+            [("Title 3", "3"), ("Title 1", "1"), ("Title 2", "2"), ("Title 1", "1")],
+        )
+
+
+class ThemePoolTests(unittest.TestCase):
+    """Houses a couple of tests for the per-theme suggestion pools."""
+
+    def setUp(self):
+        theme_pools.clear()
+        title_index.clear()
+
+    def test_pool_spans_several_pages(self):
+        """Checks if a pool is filled from several pages of results and then served from memory."""
+
+        def fake_get(url, params=None, **kwargs):
+            mock_response = MagicMock()
+            start = params["start"]
+            mock_response.json.return_value = {
+                "title": [
+                    {"isbn": str(isbn), "titleweb": "Title %d" % isbn}
+                    for isbn in range(start, min(start + params["max"], 100))
+                ]
+            }
+            return mock_response
+
+        pools = ThemePools(["War"], pool_size=120)
+        with patch("penguin.client.session.get", side_effect=fake_get) as mock_get:
+            self.assertEqual(len(pools.get("War")), 100)
+            pools.get("War")
+            self.assertEqual(mock_get.call_count, 3)
+
+    def test_empty_pool_rebuilt_on_next_request(self):
+        """Checks if a theme whose pool came back empty is rebuilt on the next request rather than serving the fallback until the next refresh."""
+        pages = [{"title": []}, {"title": [{"isbn": "1", "titleweb": "Title"}]}]
+        pools = ThemePools(["War"], pool_size=120)
+        with patch("penguin.client.session.get") as mock_get:
+            mock_get.return_value.json.side_effect = pages
+            self.assertEqual(pools.get("War"), [])
+            self.assertNotIn("War", pools.pools)
+            self.assertEqual(pools.get("War"), [("Title", TITLES_URL + "/1", "1")])
+            pools.get("War")
+            self.assertEqual(mock_get.call_count, 2)
+
+    def test_suggestions_are_distinct(self):
+        """Checks if suggested books are sampled from the pool without repeats."""
+        theme_pools.pools["War"] = [
+            ("Title %d" % isbn, "URL", str(isbn)) for isbn in range(10)
+        ]
+        with patch("penguin.client.session.get") as mock_get:
+            book_titles, book_urls, book_ISBNs = book_suggestions("War", 6)
+            mock_get.assert_not_called()
+        self.assertEqual(len(set(book_ISBNs)), 6)
+
+
+class PenguinClientTests(unittest.TestCase):
+    """Houses a couple of tests for the pooled Penguin client and its circuit breaker."""
+
+    def setUp(self):
+        title_cache.clear()
+        not_found_cache.clear()
+
+    def test_circuit_opens_after_failures(self):
+        """Checks if the client stops calling Penguin after repeated failures and retries once the reset timeout passes."""
+        client = PenguinClient(breaker=CircuitBreaker(failure_threshold=2))
+        with patch.object(client.session, "get", side_effect=IOError) as mock_get:
+            for attempt in range(2):
+                self.assertRaises(IOError, client.get_json, "/1")
+            self.assertRaises(CircuitOpenError, client.get_json, "/1")
+            self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(client.breaker.state, "open")
+
+        client.breaker.reset_timeout = 0
+        with patch.object(client.session, "get") as mock_get:
+            mock_get.return_value.json.return_value = {"titleweb": "Title"}
+            self.assertEqual(client.get_json("/1"), {"titleweb": "Title"})
+        self.assertEqual(client.breaker.state, "closed")
+
+    def test_not_found_leaves_circuit_closed(self):
+        """Checks if 404s don't count against the circuit breaker and an unknown ISBN isn't refetched while it's remembered."""
+        response = MagicMock(status_code=404)
+        response.raise_for_status.side_effect = requests.HTTPError(response=response)
+        breaker = CircuitBreaker(failure_threshold=2)
+        with patch("penguin.client.breaker", breaker):
+            with patch("penguin.client.session.get", return_value=response) as mock_get:
+                for isbn in ("1", "2", "3"):
+                    self.assertRaises(TitleNotFoundError, get_title_record, isbn)
+                self.assertRaises(TitleNotFoundError, get_title_record, "1")
+                self.assertEqual(mock_get.call_count, 3)
+        self.assertEqual(breaker.state, "closed")
+
+        # 5xx responses still open it.
+        response.status_code = 503
+        with patch("penguin.client.breaker", breaker):
+            with patch("penguin.client.session.get", return_value=response):
+                for isbn in ("4", "5"):
+                    self.assertRaises(requests.HTTPError, get_title_record, isbn)
+        self.assertEqual(breaker.state, "open")
+
+    def test_stale_record_served_on_failure(self):
+        """Checks if a record that expired within the stale window is served when Penguin can't be reached, and an older one isn't."""
+        title_cache.entries["1"] = (BookRecord("1", "Old Title"), time.time() - 1)
+        with patch("penguin.client.session.get", side_effect=IOError):
+            self.assertEqual(get_title_record("1").title, "Old Title")
+
+        # Past the stale window, the failure is no longer papered over.
+        title_cache.entries["1"] = (BookRecord("1", "Old Title"), time.time() - 7200)
+        with patch.object(title_cache, "stale_ttl", 3600):
+            with patch("penguin.client.session.get", side_effect=IOError):
+                self.assertRaises((IOError, CircuitOpenError), get_title_record, "1")
+
+
+class BookRecordTests(unittest.TestCase):
+    """Houses a couple of tests for the BookRecord type returned by Penguin lookups."""
+
+    def test_from_penguin(self):
+        """Checks if a Penguin title record is cleaned up and its derived fields are computed."""
+        book = BookRecord.from_penguin(
+            {
+                "isbn": 1,
+                "titleweb": "Title",
+                "@uri": "URL",
+                "author": "Tolkien, J.R.R.",
+                "flapcopy": "<p>Summary</p>",
+                "pages": "310",
+                "themes": {"theme": "Fantasy"},
+            }
+        )
+        self.assertEqual((book.isbn, book.flapcopy, book.pages), ("1", "Summary", 310))
+        self.assertEqual(book.author, " J.R.R. Tolkien")
+        self.assertEqual(book.theme_text, "Themes: Fantasy")
+        self.assertEqual(book.primary_theme, "Fantasy")
+        self.assertEqual(book.author_bio, BookRecord.MISSING_AUTHOR_BIO)
+        self.assertEqual(BookRecord.from_json(book.to_json()), book)
+        self.assertEqual({BookRecord.from_json(book.to_json()), book}, {book})
+
+    def test_missing_book(self):
+        """Checks if a book that can't be found keeps its ISBN and gets string placeholders."""
+        with patch("penguin.client.session.get", side_effect=IOError):
+            book = basic_book_info("0000000000000")
+        self.assertEqual(book.isbn, "0000000000000")
+        self.assertEqual(book.title, "Book Missing Information")
+        self.assertEqual(book.theme_text, "None")
+        self.assertFalse(hasattr(book, "__dict__"))
+
+
+class TitleCacheTests(unittest.TestCase):
+    """Houses a couple of tests for the title-record cache shared by Penguin.py's lookups."""
+
+    def setUp(self):
+        title_cache.clear()
+        not_found_cache.clear()
+
+    def test_single_fetch_per_isbn(self):
+        """Checks if basic_book_info, all_book_info, and get_single_book_theme share one upstream fetch."""
+        mock_response = MagicMock()
+        mock_response.json.return_value = {
+            "author": "Doe, Jane",
+            "flapcopy": "<p>Summary</p>",
+            "authorbio": "<p>Bio</p>",
+            "isbn": "9780000000001",
+            "pages": 100,
+            "themes": {"theme": ["Fantasy"]},
+            "@uri": "https://example.com/cover.jpg",
+            "titleweb": "Sample Title",
+        }
+
+        with patch("penguin.client.session.get") as mock_get:
+            mock_get.return_value = mock_response
+            basic_book_info(9780000000001)
+            all_book_info(9780000000001)
+            get_single_book_theme(9780000000001)
+            self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(title_cache.stats()["hits"], 2)
+
+    def test_lru_eviction(self):
+        """Checks if the least recently used entry is evicted once the cache is full."""
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_expired_entry(self):
+        """Checks if entries are treated as misses once their TTL has passed."""
+        cache = TTLCache(maxsize=2, ttl=-1)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_stale_window(self):
+        """Checks if expired entries are looked up as stale until their stale TTL has passed, and then as misses."""
+        cache = TTLCache(maxsize=2, ttl=60, stale_ttl=60)
+        cache.set("a", 1)
+        self.assertEqual(cache.lookup("a"), (1, True))
+        cache.set("a", 2, ttl=-1)
+        self.assertEqual(cache.lookup("a"), (2, False))
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", 3, ttl=-61)
+        self.assertEqual(cache.lookup("a"), (None, False))
+        self.assertEqual(cache.stats()["stale_hits"], 2)
+
+    def test_stale_record_refreshed_in_background(self):
+        """Checks if an expired record is served straight away while a fresh copy is fetched in the background."""
+        title_cache.set("1", BookRecord("1", "Old Title"), ttl=-1)
+        fetched = threading.Event()
+
+        def get(*args, **kwargs):
+            fetched.wait(5)
+            response = MagicMock()
+            response.json.return_value = {"titleweb": "New Title"}
+            return response
+
+        with patch("penguin.client.session.get", side_effect=get) as mock_get:
+            self.assertEqual(basic_book_info("1").title, "Old Title")
+            self.assertEqual(basic_book_info("1").title, "Old Title")
+            fetched.set()
+            deadline = time.time() + 5
+            while title_cache.get("1") is None and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(basic_book_info("1").title, "New Title")
+
+
+class SingleFlightTests(unittest.TestCase):
+    """Houses a couple of tests for coalescing concurrent lookups of the same key."""
+
+    def run_concurrently(self, function, count=5):
+        """Calls function() from several threads at once and returns every result."""
+        barrier = threading.Barrier(count)
+        results = [None] * count
+
+        def call(index):
+            barrier.wait()
+            results[index] = function()
+
+        threads = [
+            threading.Thread(target=call, args=(index,)) for index in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_share_one(self):
+        """Checks if concurrent callers with the same key share one call and its result, and are counted as coalesced."""
+        flights = SingleFlight()
+        work = MagicMock(side_effect=lambda: time.sleep(0.2) or "result")
+        results = self.run_concurrently(lambda: flights.do("key", work))
+        self.assertEqual(results, ["result"] * 5)
+        self.assertEqual(work.call_count, 1)
+        self.assertEqual(flights.stats(), {"calls": 5, "coalesced": 4, "in_flight": 0})
+
+        # Once the call has landed, the next caller starts a new one.
+        flights.do("key", work)
+        self.assertEqual(work.call_count, 2)
+
+    def test_concurrent_isbn_lookups(self):
+        """Checks if simultaneous lookups of an uncached ISBN make a single request to Penguin."""
+        title_cache.clear()
+        not_found_cache.clear()
+        lookup_flights.clear()
+        mock_response = MagicMock()
+        mock_response.json.return_value = {
+            "isbn": "1",
+            "titleweb": "Title",
+            "@uri": "URL",
+        }
+
+        def slow_get(url, **kwargs):
+            time.sleep(0.2)
+            return mock_response
+
+        with patch("penguin.client.session.get", side_effect=slow_get) as mock_get:
+            results = self.run_concurrently(lambda: get_title_record("1").title)
+        self.assertEqual(results, ["Title"] * 5)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(lookup_flights.stats()["coalesced"], 4)
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Answers the handful of Redis commands that RedisBackend uses."""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for item in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def reply(self, value):
+        if value is None:
+            self.wfile.write(b"$-1\r\n")
+        elif isinstance(value, int):
+            self.wfile.write(b":%d\r\n" % value)
+        elif isinstance(value, list):
+            self.wfile.write(b"*%d\r\n" % len(value))
+            for item in value:
+                self.reply(item)
+        elif value == b"OK":
+            self.wfile.write(b"+OK\r\n")
+        else:
+            self.wfile.write(b"$%d\r\n%s\r\n" % (len(value), value))
+
+    def handle(self):
+        data = self.server.data
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            command = args[0].upper()
+            with self.server.lock:
+                # Expired keys are dropped before every command.
+                for key in [
+                    key for key, entry in data.items() if entry[1] <= time.time()
+                ]:
+                    del data[key]
+                if command == b"GET":
+                    entry = data.get(args[1])
+                    self.reply(entry[0] if entry else None)
+                elif command == b"SET":
+                    options = [arg.upper() for arg in args[3:]]
+                    if b"NX" in options and args[1] in data:
+                        self.reply(None)
+                        continue
+                    expires_at = float("inf")
+                    if b"PX" in options:
+                        expires_at = (
+                            time.time() + int(args[4 + options.index(b"PX")]) / 1000
+                        )
+                    data[args[1]] = (args[2], expires_at)
+                    self.reply(b"OK")
+                elif command == b"DEL":
+                    self.reply(sum(data.pop(key, None) is not None for key in args[1:]))
+                elif command == b"EXISTS":
+                    self.reply(int(args[1] in data))
+                elif command == b"KEYS":
+                    pattern = args[1].decode()
+                    self.reply(
+                        [key for key in data if fnmatchcase(key.decode(), pattern)]
+                    )
+                else:
+                    self.reply(b"OK")
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """A local, in-memory stand-in for a Redis server, running on a background thread."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeRedisHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class CacheBackendTests(unittest.TestCase):
+    """Houses a couple of tests for the second-tier cache stores and cross-worker single-flight."""
+
+    def setUp(self):
+        self.redis = FakeRedisServer()
+        self.directory = tempfile.TemporaryDirectory()
+        self.backends = [
+            MemoryBackend(),
+            SQLiteStore(os.path.join(self.directory.name, "cache.db")),
+            RedisBackend(port=self.redis.server_address[1]),
+        ]
+
+    def tearDown(self):
+        self.backends[1].connection.close()
+        self.backends[2].disconnect()
+        self.redis.stop()
+        self.directory.cleanup()
+
+    def test_values_and_locks(self):
+        """Checks if every store keeps values for their own TTL and hands a key's lock to one holder at a time."""
+        for backend in self.backends:
+            backend.set("short", {"a": 1}, 0.01)
+            backend.set("long", ["x" * 1000], 60)
+            time.sleep(0.02)
+            self.assertIsNone(backend.get("short"), backend)
+            self.assertEqual(backend.get("long")[0], ["x" * 1000], backend)
+
+            token = backend.acquire_lock("long", 60)
+            self.assertIsNotNone(token)
+            self.assertIsNone(backend.acquire_lock("long", 60))
+            self.assertTrue(backend.is_locked("long"))
+            backend.release_lock("long", token)
+            self.assertFalse(backend.is_locked("long"))
+
+            backend.clear()
+            self.assertIsNone(backend.get("long"))
+
+    def test_compact_serialization(self):
+        """Checks if large values are compressed and everything round-trips."""
+        value = ["9780000000001", "Title", "word " * 500]
+        self.assertLess(len(pack(value)), len(str(value)) / 10)
+        self.assertEqual(unpack(pack(value)), value)
+        self.assertEqual(unpack(pack([1, 2])), [1, 2])
+
+    def test_single_flight_across_workers(self):
+        """Checks if a worker that finds a key locked waits for the lock holder's value instead of computing its own."""
+        store = self.backends[2]
+        first_worker = TTLCache(store=store)
+        second_worker = TTLCache(store=store)
+        token = store.acquire_lock("9780000000001", 10)
+
+        def finish():
+            time.sleep(0.1)
+            first_worker.set("9780000000001", "fetched once")
+            store.release_lock("9780000000001", token)
+
+        threading.Thread(target=finish).start()
+        compute = MagicMock(return_value="fetched twice")
+        self.assertEqual(second_worker.fill("9780000000001", compute), "fetched once")
+        compute.assert_not_called()
+
+        # Once nobody holds the lock, the waiting worker computes the value itself.
+        self.assertEqual(second_worker.fill("9780000000002", compute), "fetched twice")
+        self.assertEqual(first_worker.get("9780000000002"), "fetched twice")
+
+    def test_unreachable_store(self):
+        """Checks if a store that can't be reached only costs cache misses."""
+        store = RedisBackend(port=self.redis.server_address[1])
+        self.redis.stop()
+        cache = TTLCache(store=store)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.fill("a", lambda: 1), 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertGreater(cache.stats()["store_errors"], 0)
+        self.redis = FakeRedisServer()
+
+    def test_shared_theme_pools(self):
+        """Checks if only one worker rebuilds a theme's pool each interval and the others copy it."""
+        store = MemoryBackend()
+        first_worker = ThemePools(["War"], store=store)
+        second_worker = ThemePools(["War"], store=store)
+        pool = [("Title", "URL", "1")]
+        with patch.object(ThemePools, "build", return_value=pool) as mock_build:
+            first_worker.refresh()
+            second_worker.refresh()
+            self.assertEqual(mock_build.call_count, 1)
+        self.assertEqual(second_worker.get("War"), pool)
+
+
+class AppTestCase(unittest.TestCase):
+    """Sets up a fresh database and a logged-in test client for view tests."""
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+        self.user = Users(username="reader", email="reader@example.com", password="x")
+        db.session.add(self.user)
+        db.session.commit()
+        book_details_cache.clear()
+        not_found_cache.clear()
+        self.client = app.test_client()
+        self.login(self.user)
+
+    def login(self, user):
+        """Logs the test client in as a user."""
+        with self.client.session_transaction() as session:
+            session["_user_id"] = str(user.id)
+            session["_fresh"] = True
+        # Flask-Login caches the current user on the app context, which the tests keep pushed.
+        flask.g.pop("_login_user", None)
+
+    def assertWithinBudget(self, path, budget, method="get", **kwargs):
+        """Requests a path and fails with a report of its work if it ran more SQL statements or Penguin calls than budget allows."""
+        flask.g.pop("_login_user", None)
+        with capture_requests() as traces:
+            response = getattr(self.client, method)(path, **kwargs)
+        trace = traces[-1]
+        if trace.over_budget(budget):
+            self.fail(trace.report(budget))
+        return response
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+
+
+class FavoriteThemeTests(AppTestCase):
+    """Houses a couple of tests for the per-user favorite theme histogram."""
+
+    def theme_counts(self):
+        return {
+            theme_count.theme: theme_count.count
+            for theme_count in FavoriteThemes.query.filter_by(user_id=self.user.id)
+        }
+
+    def test_histogram_follows_favorites(self):
+        """Checks if favoriting and unfavoriting books keeps the theme histogram up to date."""
+        with patch("app.get_single_book_theme", side_effect=["War", "War", "Humor"]):
+            for isbn in ["1", "2", "3"]:
+                self.client.get("/add_favorite?route=favorites&isbn=" + isbn)
+        self.assertEqual(self.theme_counts(), {"War": 2, "Humor": 1})
+        self.assertEqual(Favorites.query.filter_by(bookISBN="3").first().theme, "Humor")
+
+        self.client.get("/delete_favorite?isbn=1")
+        self.assertEqual(self.theme_counts(), {"War": 1, "Humor": 1})
+
+    def test_failed_lookup_retried(self):
+        """Checks if a favorite whose theme couldn't be looked up is stored without one and backfilled on the next migration run."""
+        title_cache.clear()
+        with patch("penguin.client.session.get", side_effect=IOError):
+            self.client.get("/add_favorite?route=favorites&isbn=1")
+        self.assertIsNone(Favorites.query.one().theme)
+        self.assertEqual(self.theme_counts(), {})
+
+        with patch("penguin.client.breaker", CircuitBreaker()):
+            with patch("penguin.client.session.get") as mock_get:
+                mock_get.return_value.json.return_value = {
+                    "titleweb": "Title",
+                    "themes": {"theme": "War"},
+                }
+                add_favorite_themes()
+        rebuild_theme_histogram()
+        self.assertEqual(Favorites.query.one().theme, "War")
+        self.assertEqual(self.theme_counts(), {"War": 1})
+
+    def test_homepage_uses_top_theme(self):
+        """Checks if the homepage suggests books from the most common non-empty theme without any theme lookups."""
+        db.session.add_all(
+            [
+                FavoriteThemes(user_id=self.user.id, theme="None", count=5),
+                FavoriteThemes(user_id=self.user.id, theme="Horror", count=1),
+                FavoriteThemes(user_id=self.user.id, theme="Fantasy", count=3),
+            ]
+        )
+        db.session.commit()
+
+        with patch("app.get_single_book_theme") as mock_theme:
+            with patch("app.book_suggestions_async") as mock_suggestions:
+                mock_suggestions.return_value = (["Title"], ["URL"], ["1"])
+                response = self.client.get("/homepage")
+        self.assertEqual(response.status_code, 200)
+        mock_suggestions.assert_called_once_with("Fantasy", 1)
+        mock_theme.assert_not_called()
+
+
+class DuplicateConstraintTests(AppTestCase):
+    """Houses a couple of tests for the unique constraints that reject duplicate favorites and recommendations."""
+
+    def test_duplicate_favorite(self):
+        """Checks if favoriting the same book twice stores it once and leaves the theme count alone."""
+        with patch("app.get_single_book_theme", return_value="War"):
+            self.client.get("/add_favorite?route=favorites&isbn=1")
+            self.client.get("/add_favorite?route=favorites&isbn=1")
+        with self.client.session_transaction() as session:
+            messages = [message for category, message in session["_flashes"]]
+        self.assertIn(
+            "THIS BOOK HAS BEEN FAVORITED ALREADY. PLEASE TRY AGAIN.", messages
+        )
+        self.assertEqual(Favorites.query.count(), 1)
+        self.assertEqual(FavoriteThemes.query.one().count, 1)
+
+    def test_duplicate_recommendation(self):
+        """Checks if recommending the same book to the same user twice stores it once."""
+        db.session.add(
+            Users(username="friend", email="friend@example.com", password="x")
+        )
+        db.session.commit()
+        for attempt in range(2):
+            self.client.get("/add_recommendations?isbn=1&receiver_username=friend")
+        self.assertEqual(Recommendations.query.count(), 1)
+
+
+class IsbnLengthTests(AppTestCase):
+    """Houses a couple of tests for ISBNs longer than the ISBN columns hold."""
+
+    def flashes(self):
+        with self.client.session_transaction() as session:
+            return [message for category, message in session.pop("_flashes", [])]
+
+    def test_isbns_normalized_before_writing(self):
+        """Checks if hyphenated ISBNs are stored without their hyphens and ISBNs that are still too long are refused."""
+        with patch("app.get_single_book_theme", return_value="War"):
+            self.client.get("/add_favorite?route=favorites&isbn=978-0-306-40615-7")
+            self.client.get("/add_favorite?route=favorites&isbn=97803064061570")
+        self.assertEqual(
+            [favorite.bookISBN for favorite in Favorites.query],
+            ["9780306406157"],
+        )
+        self.assertIn("THIS IS NOT A VALID ISBN. PLEASE TRY AGAIN.", self.flashes())
+
+        response = self.client.post(
+            "/api/v1/recommendations",
+            json={"usernames": ["friend"], "isbns": ["97803064061570"]},
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_migration_reports_long_isbns(self):
+        """Checks if the migration strips hyphens from long ISBNs and refuses to drop rows whose ISBNs are still too long."""
+        Favorites.__table__.drop(bind=db.engine)
+        db.session.execute(
+            db.text(
+                'CREATE TABLE favorites (id INTEGER PRIMARY KEY, email VARCHAR(120), "bookISBN" VARCHAR(15), theme VARCHAR(100))'
+            )
+        )
+        db.session.execute(
+            db.text(
+                'INSERT INTO favorites (email, "bookISBN") VALUES '
+                "('reader@example.com', '978-0-306-40615-7'), ('reader@example.com', '978030640615700')"
+            )
+        )
+        db.session.commit()
+
+        strip_long_isbns()
+        with self.assertRaises(RuntimeError) as failure:
+            use_user_foreign_keys()
+        self.assertIn("favorites id 2: '978030640615700'", str(failure.exception))
+
+        db.session.execute(db.text("DELETE FROM favorites WHERE id = 2"))
+        db.session.commit()
+        use_user_foreign_keys()
+        favorite = Favorites.query.one()
+        self.assertEqual(
+            (favorite.user_id, favorite.bookISBN), (self.user.id, "9780306406157")
+        )
+
+    def test_migration_shortens_catalog(self):
+        """Checks if a catalog with wider ISBN columns is recreated with ISBN_LENGTH-wide ones, and a matching one is left alone."""
+        BookThemes.__table__.drop(bind=db.engine)
+        Books.__table__.drop(bind=db.engine)
+        db.session.execute(
+            db.text(
+                "CREATE TABLE books (isbn VARCHAR(20) PRIMARY KEY, title VARCHAR(300))"
+            )
+        )
+        db.session.commit()
+        with patch("builtins.print"):
+            shorten_catalog_isbns()
+        upsert_books([{"isbn": "9780306406157", "titleweb": "Title", "@uri": "URL"}])
+        shorten_catalog_isbns()
+        self.assertEqual(Books.query.one().isbn, "9780306406157")
+        isbn_column = inspect(db.engine).get_columns("books")[0]
+        self.assertEqual(isbn_column["type"].length, ISBN_LENGTH)
+
+
+class UserForeignKeyTests(AppTestCase):
+    """Houses a test for rows that reference users by ID."""
+
+    def test_rename_keeps_rows(self):
+        """Checks if a user's favorites and sent recommendations follow them through a profile rename."""
+        friend = Users(username="friend", email="friend@example.com", password="x")
+        db.session.add(friend)
+        db.session.commit()
+        db.session.add(Favorites(user_id=self.user.id, bookISBN="1", theme="War"))
+        db.session.add(
+            Recommendations(sender_id=self.user.id, receiver_id=friend.id, bookISBN="1")
+        )
+        db.session.commit()
+
+        self.client.post(
+            "/profile", data={"username": "renamed", "email": "renamed@example.com"}
+        )
+        self.assertEqual(Favorites.query.filter_by(user_id=self.user.id).count(), 1)
+
+        self.login(friend)
+        with patch(
+            "app.basic_book_info_many_async", return_value=[BookRecord("1", "Title")]
+        ):
+            response = self.client.get("/recommendations")
+        self.assertIn(b"renamed", response.data)
+
+
+class PaginationTests(AppTestCase):
+    """Houses a couple of tests for the paginated favorites and recommendations pages."""
+
+    def setUp(self):
+        super().setUp()
+        friend = Users(username="friend", email="friend@example.com", password="x")
+        db.session.add(friend)
+        db.session.commit()
+        for isbn in ["1", "2", "3", "4", "5"]:
+            db.session.add(Favorites(user_id=self.user.id, bookISBN=isbn, theme="War"))
+            db.session.add(
+                Recommendations(
+                    sender_id=friend.id, receiver_id=self.user.id, bookISBN=isbn
+                )
+            )
+        db.session.commit()
+        lookups = patch(
+            "app.basic_book_info_many_async",
+            side_effect=lambda isbns: [
+                BookRecord(isbn, "Title " + isbn) for isbn in isbns
+            ],
+        )
+        self.lookup = lookups.start()
+        self.addCleanup(lookups.stop)
+        per_page = patch("app.BOOKS_PER_PAGE", 2)
+        per_page.start()
+        self.addCleanup(per_page.stop)
+
+    def test_first_page_only(self):
+        """Checks if the favorites page only looks up and renders its first page of books, and links to the next."""
+        response = self.client.get("/favorites")
+        self.lookup.assert_called_once_with(["1", "2"])
+        self.assertIn(b"Title 2", response.data)
+        self.assertNotIn(b"Title 3", response.data)
+        self.assertIn(b"/favorites?after=", response.data)
+        self.assertIn(b'loading="lazy"', response.data)
+
+    def test_json_pages(self):
+        """Checks if following the JSON endpoint's cursors walks through every remaining book exactly once."""
+        for route in ["favorites", "recommendations"]:
+            first_page = self.client.get("/%s/page" % route).get_json()
+            after, isbns = first_page["next"], []
+            while after is not None:
+                page = self.client.get("/%s/page?after=%d" % (route, after)).get_json()
+                isbns += [book["isbn"] for book in page["books"]]
+                after = page["next"]
+            self.assertEqual(isbns, ["3", "4", "5"])
+        self.assertEqual(page["books"][0]["sender"], "friend")
+
+
+class CatalogTests(AppTestCase):
+    """Houses a couple of tests for the local book catalog mirror."""
+
+    def setUp(self):
+        super().setUp()
+        title_cache.clear()
+        not_found_cache.clear()
+        theme_pools.clear()
+        title_index.clear()
+        upsert_books(
+            [
+                {
+                    "isbn": "9780000000001",
+                    "titleweb": "The Hobbit",
+                    "@uri": "https://example.com/hobbit",
+                    "author": "Tolkien, J.R.R.",
+                    "flapcopy": "<p>A <b>hobbit</b> goes on an adventure.</p>",
+                    "authorbio": "<p>Professor</p>",
+                    "pages": "310",
+                    "themes": {"theme": ["Fantasy", "Adventure", "Fantasy"]},
+                },
+                {"isbn": "9780000000002", "titleweb": "Missing Cover"},
+            ]
+        )
+
+    def test_upsert_books(self):
+        """Checks if ingested records are cleaned and stored, and incomplete records are skipped."""
+        book = Books.query.get("9780000000001")
+        self.assertEqual(book.flapcopy, "A hobbit goes on an adventure.")
+        self.assertEqual(book.themes, "Fantasy, Adventure, Fantasy")
+        self.assertEqual(book.pages, 310)
+        self.assertIsNone(Books.query.get("9780000000002"))
+
+        revised = {
+            "isbn": "9780000000001",
+            "titleweb": "The Hobbit (Revised)",
+            "@uri": "u",
+        }
+        upsert_books([revised])
+        self.assertEqual(Books.query.get("9780000000001").title, "The Hobbit (Revised)")
+
+    def test_lookups_read_catalog_first(self):
+        """Checks if mirrored books are served without any requests to Penguin."""
+        with patch("penguin.client.session.get") as mock_get:
+            book = all_book_info("9780000000001")
+            self.assertEqual(
+                (book.title, book.author), ("The Hobbit", " J.R.R. Tolkien")
+            )
+            self.assertEqual(basic_book_info_many(["9780000000001"]), [book])
+            self.assertEqual(title_search("hobbit"), "9780000000001")
+            self.assertEqual(book_suggestions("Adventure", 1)[2], ["9780000000001"])
+            mock_get.assert_not_called()
+
+    def test_title_selection_lists_ranked_results(self):
+        """Checks if the title search page lists ranked results from the local index."""
+        with patch("penguin.client.session.get") as mock_get:
+            response = self.client.post(
+                "/handle_title_selection", data={"title": "hob"}
+            )
+            mock_get.assert_not_called()
+        self.assertIn(b"1. Title: The Hobbit", response.data)
+
+
+class CacheWarmupTests(AppTestCase):
+    """Houses a couple of tests for prefetching the most referenced books into the title cache."""
+
+    def setUp(self):
+        super().setUp()
+        title_cache.clear()
+        not_found_cache.clear()
+        friend = Users(username="friend", email="friend@example.com", password="x")
+        db.session.add(friend)
+        db.session.commit()
+        db.session.add_all(
+            [
+                Favorites(user_id=self.user.id, bookISBN="1", theme="War"),
+                Favorites(user_id=friend.id, bookISBN="2", theme="War"),
+                Recommendations(
+                    sender_id=friend.id, receiver_id=self.user.id, bookISBN="2"
+                ),
+                Review(user_id=self.user.id, isbn="2", comment="Good", rating="5"),
+                Review(user_id=self.user.id, isbn="3", comment="Fine", rating="3"),
+                Review(user_id=friend.id, isbn="3", comment="Okay", rating="3"),
+            ]
+        )
+        db.session.commit()
+
+    def test_popular_isbns(self):
+        """Checks if ISBNs are ranked by how often they are referenced across favorites, recommendations, and reviews."""
+        self.assertEqual(popular_isbns(10), ["2", "3", "1"])
+        self.assertEqual(popular_isbns(2), ["2", "3"])
+
+    def test_warm_title_cache(self):
+        """Checks if warming fetches only the books missing from the catalog and leaves every one of them cached."""
+        upsert_books([{"isbn": "3", "titleweb": "Mirrored", "@uri": "URL"}])
+        mock_response = MagicMock()
+        mock_response.json.return_value = {"titleweb": "Fetched"}
+        with patch(
+            "penguin.client.session.get", return_value=mock_response
+        ) as mock_get:
+            self.assertEqual(warm_title_cache(popular_isbns(10), rate=1000), 3)
+            self.assertEqual(mock_get.call_count, 2)
+        for isbn in ["1", "2", "3"]:
+            self.assertIsNotNone(title_cache.get(isbn))
+        with self.assertRaises(ValueError):
+            warm_title_cache(["1"], rate=0)
+
+    def test_warm_rate_checked_only_when_warming(self):
+        """Checks if a rate of zero only stops the app from starting when cache warm-up is switched on."""
+        with patch("app.CACHE_WARM_RATE", 0), patch("app.theme_pools") as pools:
+            with patch("app.CACHE_WARM_COUNT", 5):
+                self.assertRaises(ValueError, start_background_jobs, app)
+            pools.start.assert_not_called()
+            with patch("app.CACHE_WARM_COUNT", 0), patch(
+                "app.start_background_refresh"
+            ):
+                start_background_jobs(app)
+            pools.start.assert_called_once_with(app)
+
+
+class AsyncViewTests(AppTestCase):
+    """Houses a couple of tests for the async views that fan lookups out to Penguin."""
+
+    def setUp(self):
+        super().setUp()
+        title_cache.clear()
+        not_found_cache.clear()
+
+    def mock_penguin(self, requested):
+        """Returns an async session whose requests are answered locally and recorded in requested."""
+
+        def handler(request):
+            isbn = request.url.path.rsplit("/", 1)[-1]
+            requested.append(isbn)
+            record = {
+                "isbn": isbn,
+                "titleweb": "Title " + isbn,
+                "@uri": "URL",
+                "author": "Author",
+                "flapcopy": "",
+                "authorbio": "",
+                "pages": 1,
+                "themes": None,
+            }
+            return httpx.Response(200, json=record)
+
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    def test_favorites_fetch_concurrently(self):
+        """Checks if the favorites page fetches every uncached, unmirrored book over the async client exactly once."""
+        upsert_books([{"isbn": "3", "titleweb": "Mirrored", "@uri": "URL"}])
+        for isbn in ["1", "2", "3"]:
+            db.session.add(Favorites(user_id=self.user.id, bookISBN=isbn, theme="War"))
+        db.session.commit()
+
+        requested = []
+        with patch("penguin.client.async_http", self.mock_penguin(requested)):
+            response = self.client.get("/favorites")
+        self.assertEqual(sorted(requested), ["1", "2"])
+        for title in [b"Title 1", b"Title 2", b"Mirrored"]:
+            self.assertIn(title, response.data)
+
+    def test_book_page_saves_review(self):
+        """Checks if posting a review from the async book page stores it on the request's database session."""
+        requested = []
+        with patch("penguin.client.async_http", self.mock_penguin(requested)):
+            response = self.client.post(
+                "/get_book_info?isbn=1",
+                data={"isbn": "1", "comment": "Great read", "rating": "5"},
+            )
+        self.assertEqual(requested, ["1"])
+        self.assertIn(b"Title 1", response.data)
+        self.assertIn(b"Great read", response.data)
+        self.assertEqual(Review.query.filter_by(isbn="1").count(), 1)
+
+
+class ReviewStatsTests(AppTestCase):
+    """Houses a couple of tests for the per-ISBN review aggregates and paginated review listing."""
+
+    book_info = BookRecord("1", "Title", "URL", "Author", "", "")
+
+    def post_review(self, comment, rating):
+        with patch("app.all_book_info_async", return_value=self.book_info):
+            return self.client.post(
+                "/get_book_info",
+                data={"isbn": "1", "comment": comment, "rating": str(rating)},
+            )
+
+    def test_aggregates_follow_reviews(self):
+        """Checks if posting reviews keeps the count, rating sum, and histogram up to date, and if a recount agrees."""
+        for comment, rating in [("Good", 4), ("Great", 5), ("Fine", 4)]:
+            response = self.post_review(comment, rating)
+        review_stats = ReviewStats.query.get("1")
+        self.assertEqual((review_stats.count, review_stats.rating_sum), (3, 13))
+        self.assertEqual(review_stats.histogram, {1: 0, 2: 0, 3: 0, 4: 2, 5: 1})
+        self.assertIn(b"Average rating: 4.3/5", response.data)
+
+        rebuild_review_stats()
+        self.assertEqual(ReviewStats.query.get("1").histogram[4], 2)
+
+    def test_racing_first_reviews(self):
+        """Checks if a first review that loses the race to insert a book's aggregates is added to the row the other one inserted."""
+        update = Query.update
+
+        def racing_update(query, *args, **kwargs):
+            # The other review's row is inserted just after this one's UPDATE finds nothing.
+            if not db.session.execute(ReviewStats.__table__.select()).all():
+                db.session.execute(
+                    ReviewStats.__table__.insert().values(
+                        isbn="1", count=1, rating_sum=4, rating_4=1
+                    )
+                )
+                return 0
+            return update(query, *args, **kwargs)
+
+        with patch.object(Query, "update", racing_update):
+            response = self.post_review("Great", 5)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Review.query.count(), 1)
+        review_stats = ReviewStats.query.get("1")
+        self.assertEqual((review_stats.count, review_stats.rating_sum), (2, 9))
+        self.assertEqual(review_stats.histogram, {1: 0, 2: 0, 3: 0, 4: 1, 5: 1})
+
+    def test_reviews_are_paginated(self):
+        """Checks if reviews are listed newest first one page at a time, with a cursor leading to older ones."""
+        with patch("app.REVIEWS_PER_PAGE", 2):
+            for comment in ["First", "Second", "Third"]:
+                response = self.post_review(comment, 3)
+            self.assertIn(b"Third", response.data)
+            self.assertIn(b"Second", response.data)
+            self.assertNotIn(b"First", response.data)
+
+            second_id = Review.query.filter_by(comment="Second").one().id
+            self.assertIn(b"before=%d" % second_id, response.data)
+            with patch("app.all_book_info_async", return_value=self.book_info):
+                response = self.client.get(
+                    "/get_book_info?isbn=1&before=%d" % second_id
+                )
+        self.assertIn(b"First", response.data)
+        self.assertNotIn(b"Older reviews", response.data)
+
+
+class BookDetailsFragmentTests(AppTestCase):
+    """Houses a couple of tests for the cached book details fragment."""
+
+    book_info = BookRecord("1", "Title", "URL", "Author", "Summary", "Bio")
+
+    def test_rendered_once_per_book(self):
+        """Checks if the book page reuses the cached details fragment while its reviews stay per request."""
+        with patch("app.all_book_info_async", return_value=self.book_info) as lookup:
+            self.client.get("/get_book_info?isbn=1")
+            self.client.post(
+                "/get_book_info", data={"isbn": "1", "comment": "Good", "rating": "4"}
+            )
+            response = self.client.get("/get_book_info?isbn=1")
+            self.assertEqual(lookup.call_count, 1)
+        self.assertIn(b"<b>Title</b>", response.data)
+        self.assertIn(b"Summary", response.data)
+        self.assertIn(b"Good", response.data)
+
+    def test_public_revalidation(self):
+        """Checks if the fragment is served to signed-out clients with public caching headers and answered with a 304 on revalidation."""
+        self.client.get("/logout")
+        with patch("app.all_book_info_async", return_value=self.book_info):
+            response = self.client.get("/book_details/9780306406157")
+            self.assertIn("public", response.headers["Cache-Control"])
+            self.assertIn(b"Bio", response.data)
+            response = self.client.get(
+                "/book_details/9780306406157",
+                headers={"If-None-Match": response.headers["ETag"]},
+            )
+        self.assertEqual(response.status_code, 304)
+
+    def test_missing_book_not_cached(self):
+        """Checks if a book that couldn't be looked up is answered with a 503 and looked up again on the next request."""
+        with patch(
+            "app.all_book_info_async", return_value=BookRecord.missing("9780306406157")
+        ) as lookup:
+            response = self.client.get("/book_details/9780306406157")
+            self.client.get("/book_details/9780306406157")
+            self.assertEqual(lookup.call_count, 2)
+        self.assertEqual(response.status_code, 503)
+
+    def test_unknown_book_not_refetched(self):
+        """Checks if a book Penguin has no title for is answered with a 404 and isn't refetched while it's remembered."""
+        requests_made = []
+
+        def handler(request):
+            requests_made.append(request)
+            return httpx.Response(404)
+
+        session = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with patch("penguin.client.breaker", CircuitBreaker()):
+            with patch("penguin.client.async_http", session):
+                for attempt in range(3):
+                    response = self.client.get("/book_details/9780306406157")
+                    self.assertEqual(response.status_code, 404)
+        self.assertEqual(len(requests_made), 1)
+
+    def test_made_up_isbns_not_looked_up(self):
+        """Checks if anything but a well-formed ISBN-13 is answered with a 404 without going to Penguin."""
+        with patch("app.all_book_info_async") as lookup:
+            for isbn in ["1", "9780306406158", "978030640615x", "97803064061570"]:
+                self.assertEqual(
+                    self.client.get("/book_details/" + isbn).status_code, 404
+                )
+            lookup.assert_not_called()
+
+
+class InstrumentationTests(AppTestCase):
+    """Houses a couple of tests for the per-request timings and metrics."""
+
+    def setUp(self):
+        super().setUp()
+        title_cache.clear()
+        not_found_cache.clear()
+        metrics.clear()
+
+    def test_book_page_timings(self):
+        """Checks if a book page reports its Penguin, SQL, and render time, logs it, and counts it in /metrics."""
+
+        def handler(request):
+            return httpx.Response(200, json={"isbn": "1", "titleweb": "Title"})
+
+        session = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with patch("penguin.client.async_http", session):
+            with self.assertLogs("bookbite.requests") as logs:
+                response = self.client.get("/get_book_info?isbn=1")
+        for kind in ["penguin", "db", "render", "total"]:
+            self.assertIn(kind + ";dur=", response.headers["Server-Timing"])
+        self.assertIn('"route": "main.get_book_info"', logs.output[0])
+
+        exposition = self.client.get("/metrics").data.decode()
+        self.assertIn(
+            'bookbite_request_seconds_count{route="main.get_book_info"} 1', exposition
+        )
+        self.assertIn(
+            'bookbite_upstream_seconds_count{function="fetch_title_record_async"} 1',
+            exposition,
+        )
+
+    def test_pooled_lookups_timed(self):
+        """Checks if lookups fanned out on the lookup pool are counted in the calling request's timings."""
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        try:
+            with patch("penguin.client.breaker", CircuitBreaker()):
+                with patch("penguin.client.session.get") as mock_get:
+                    mock_get.return_value.json.return_value = {"titleweb": "Title"}
+                    basic_book_info_many(["1", "2"])
+        finally:
+            current_timings.reset(token)
+        self.assertEqual(timings.totals["penguin"][1], 2)
+
+    def test_cache_counters(self):
+        """Checks if the title cache's counters and size are served at /metrics."""
+        title_cache.set("1", BookRecord("1", "Title"))
+        title_cache.get("1")
+        title_cache.get("2")
+        exposition = self.client.get("/metrics").data.decode()
+        self.assertIn("# TYPE bookbite_cache_entries gauge", exposition)
+        self.assertIn('bookbite_cache_entries{cache="titles"} 1', exposition)
+        self.assertIn(
+            'bookbite_cache_events_total{cache="titles",event="hits"} 1', exposition
+        )
+        self.assertIn(
+            'bookbite_cache_events_total{cache="titles",event="misses"} 1', exposition
+        )
+        self.assertIn('bookbite_cache_maxsize{cache="book_details"}', exposition)
+
+    def test_flight_counters(self):
+        """Checks if the lookup flights' call and coalesced counts are served at /metrics."""
+        lookup_flights.clear()
+        lookup_flights.do("1", lambda: "Title")
+        exposition = self.client.get("/metrics").data.decode()
+        self.assertIn("bookbite_lookup_calls_total 1", exposition)
+        self.assertIn("bookbite_lookup_coalesced_total 0", exposition)
+        self.assertIn("bookbite_lookups_in_flight 0", exposition)
+
+    def test_histogram_buckets(self):
+        """Checks if histogram buckets are cumulative and counters are listed with their labels."""
+        registry = Metrics(buckets=(0.1, 1))
+        registry.describe("latency_seconds", "histogram", "Latency.")
+        for seconds in [0.05, 0.5, 5]:
+            registry.observe("latency_seconds", seconds, {"route": "a"})
+        registry.inc("calls_total", {"route": "a"})
+        exposition = registry.render()
+        self.assertIn("# TYPE latency_seconds histogram", exposition)
+        self.assertIn('latency_seconds_bucket{route="a",le="0.1"} 1', exposition)
+        self.assertIn('latency_seconds_bucket{route="a",le="1"} 2', exposition)
+        self.assertIn('latency_seconds_bucket{route="a",le="+Inf"} 3', exposition)
+        self.assertIn('calls_total{route="a"} 1', exposition)
+
+
+class RouteBudgetTests(AppTestCase):
+    """Houses a couple of tests holding the heaviest routes to a query and Penguin call budget once the caches are warm."""
+
+    # Path: (SQL statements, Penguin calls) allowed per request.
+    budgets = {
+        "/homepage": (1, 0),
+        "/favorites": (2, 0),
+        "/recommendations": (2, 0),
+        "/get_book_info?isbn=1": (2, 0),
+        "/api/v1/favorites": (2, 0),
+        "/api/v1/recommendations": (2, 0),
+        "/api/v1/books/1": (1, 0),
+    }
+
+    def setUp(self):
+        super().setUp()
+        title_cache.clear()
+        not_found_cache.clear()
+        theme_pools.clear()
+        friend = Users(username="friend", email="friend@example.com", password="x")
+        db.session.add(friend)
+        db.session.commit()
+        for isbn in ["1", "2", "3", "4", "5"]:
+            db.session.add(Favorites(user_id=self.user.id, bookISBN=isbn, theme="War"))
+            db.session.add(
+                Recommendations(
+                    sender_id=friend.id, receiver_id=self.user.id, bookISBN=isbn
+                )
+            )
+        db.session.add(FavoriteThemes(user_id=self.user.id, theme="War", count=5))
+        db.session.commit()
+        theme_pools.pools["War"] = [("Title", "URL", "6")]
+
+    def test_warm_routes_within_budget(self):
+        """Checks if each route stays within its budget once a first request has filled the caches."""
+
+        def handler(request):
+            isbn = request.url.path.rsplit("/", 1)[-1]
+            return httpx.Response(200, json={"isbn": isbn, "titleweb": "Title " + isbn})
+
+        session = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        # A fresh breaker, in case earlier tests left the shared client's circuit open.
+        with patch("penguin.client.async_http", session), patch(
+            "penguin.client.breaker", CircuitBreaker()
+        ):
+            for path, (queries, penguin_calls) in self.budgets.items():
+                with self.subTest(path=path):
+                    self.client.get(path)
+                    response = self.assertWithinBudget(
+                        path, {"db": queries, "penguin": penguin_calls}
+                    )
+                    self.assertEqual(response.status_code, 200)
+
+    def test_report_flags_repeated_statements(self):
+        """Checks if an over-budget report lists each statement once with its count and flags the repeated ones."""
+        trace = RequestTrace(
+            "GET",
+            "/favorites",
+            "main.favorites",
+            200,
+            [("db", "SELECT *\n  FROM books WHERE isbn = ?")] * 3
+            + [("db", "SELECT * FROM users"), ("penguin", "fetch_title_record")],
+        )
+        budget = {"db": 2, "penguin": 0}
+        self.assertEqual(trace.over_budget(budget), ["db", "penguin"])
+        report = trace.report(budget)
+        self.assertIn("GET /favorites (main.favorites, status 200)", report)
+        self.assertIn("db: 4 (budget 2)  <-- over", report)
+        self.assertIn("3x SELECT * FROM books WHERE isbn = ?  (repeated: N+1?)", report)
+        self.assertIn("1x SELECT * FROM users\n", report)
+
+        with self.assertRaises(AssertionError) as failure:
+            self.assertWithinBudget("/favorites", {"db": 0})
+        self.assertIn("went over its budget", str(failure.exception))
+
+
+class ApiTests(AppTestCase):
+    """Houses a couple of tests for the versioned JSON API."""
+
+    book_info = BookRecord("1", "Title", "URL", "Tolkien, J.R.R.", "", "", 310)
+
+    def get_book(self, **headers):
+        with patch("app.all_book_info_async", return_value=self.book_info):
+            return self.client.get("/api/v1/books/1", headers=headers)
+
+    def test_book_revalidation(self):
+        """Checks if a book's ETag is answered with an empty 304 until a new review changes the response."""
+        response = self.get_book()
+        etag = response.headers["ETag"]
+        self.assertEqual(response.get_json()["author"], "J.R.R. Tolkien")
+        self.assertEqual(response.get_json()["reviews"]["count"], 0)
+
+        response = self.get_book(**{"If-None-Match": etag})
+        self.assertEqual((response.status_code, response.data), (304, b""))
+
+        db.session.add(Review(user_id=self.user.id, isbn="1", comment="Ok", rating="3"))
+        db.session.add(ReviewStats(isbn="1", count=1, rating_sum=3, rating_3=1))
+        db.session.commit()
+        response = self.get_book(**{"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["reviews"]["histogram"], [0, 0, 1, 0, 0])
+        reviews = self.client.get("/api/v1/books/1/reviews").get_json()
+        self.assertEqual(reviews["reviews"][0]["username"], "reader")
+
+    def test_invalid_counts(self):
+        """Checks if a suggestion count or search limit below 1 is refused rather than answered with placeholder or wrong results."""
+        with patch("app.book_suggestions_async") as mock_suggestions, patch(
+            "app.search_titles"
+        ) as mock_search:
+            for path in [
+                "/api/v1/suggestions?theme=War&count=0",
+                "/api/v1/suggestions?theme=War&count=-3",
+                "/api/v1/search?q=ring&limit=0",
+                "/api/v1/search?q=ring&limit=-1",
+            ]:
+                self.assertEqual(self.client.get(path).status_code, 400)
+            mock_suggestions.assert_not_called()
+            mock_search.assert_not_called()
+
+    def test_placeholders_refused(self):
+        """Checks if a book or suggestions that can't be found are answered with an error rather than placeholder data, and unknown themes are refused."""
+        with patch("app.all_book_info_async", return_value=BookRecord.missing("1")):
+            self.assertEqual(self.client.get("/api/v1/books/1").status_code, 503)
+            remember_missing("1")
+            self.assertEqual(self.client.get("/api/v1/books/1").status_code, 404)
+
+        theme_pools.clear()
+        with patch.object(theme_pools, "load_or_build", return_value=[]):
+            response = self.client.get("/api/v1/suggestions?theme=War")
+        self.assertEqual(response.status_code, 503)
+        for theme in ["", "Dragons", "war"]:
+            response = self.client.get("/api/v1/suggestions?theme=" + theme)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(theme_pools.pools, {})
+
+    def test_requires_login(self):
+        """Checks if API requests from signed-out clients are refused rather than redirected to the login page."""
+        self.client.get("/logout")
+        self.assertEqual(self.client.get("/api/v1/favorites").status_code, 401)
+
+
+class BulkRecommendationTests(AppTestCase):
+    """Houses a couple of tests for recommending several books to several users at once."""
+
+    def setUp(self):
+        super().setUp()
+        self.friends = [
+            Users(username=name, email=name + "@example.com", password="x")
+            for name in ["ann", "bob"]
+        ]
+        db.session.add_all(self.friends)
+        db.session.commit()
+        db.session.add(
+            Recommendations(
+                sender_id=self.user.id,
+                receiver_id=self.friends[0].id,
+                bookISBN="9780306406157",
+            )
+        )
+        db.session.commit()
+
+    def test_bulk_recommend(self):
+        """Checks if every new (receiver, book) pair is added with a fixed number of queries, skipping duplicates and unknown users, with ISBN-10s stored as ISBN-13s."""
+        body = {
+            "usernames": ["ann", "bob", "ghost", "reader", "bob"],
+            "isbns": ["9780306406157", "0-439-02348-3", "978-0-306-40615-7"],
+        }
+        # Loading the signed-in user, finding the receivers, finding existing pairs, and one batched insert.
+        response = self.assertWithinBudget(
+            "/api/v1/recommendations", {"db": 4}, method="post", json=body
+        )
+        self.assertEqual(
+            response.get_json(),
+            {
+                "recommended": 3,
+                "already_recommended": 1,
+                "unknown_usernames": ["ghost", "reader"],
+            },
+        )
+        pairs = {
+            (recommendation.receiver.username, recommendation.bookISBN)
+            for recommendation in Recommendations.query
+        }
+        self.assertEqual(
+            pairs,
+            {
+                ("ann", "9780306406157"),
+                ("ann", "9780439023481"),
+                ("bob", "9780306406157"),
+                ("bob", "9780439023481"),
+            },
+        )
+
+    def test_invalid_requests(self):
+        """Checks if malformed or oversized bulk recommendations are refused without storing anything."""
+        for body, status in [
+            ({"usernames": ["ann"]}, 400),
+            ({"usernames": "ann", "isbns": ["0439023483"]}, 400),
+            ({"usernames": ["ann", ""], "isbns": ["0439023483"]}, 400),
+            ({"usernames": ["ann"], "isbns": ["12345"]}, 400),
+            ({"usernames": ["ann", "bob"], "isbns": ["0439023483", "0306406152"]}, 413),
+        ]:
+            with patch("app.MAX_BULK_RECOMMENDATIONS", 3):
+                response = self.client.post("/api/v1/recommendations", json=body)
+            self.assertEqual(response.status_code, status)
+        self.assertEqual(Recommendations.query.count(), 1)
+
+
+class BookListImportExportTests(AppTestCase):
+    """Houses a couple of tests for importing favorites and exporting a user's lists as CSV and JSON Lines."""
+
+    def setUp(self):
+        super().setUp()
+        friend = Users(username="=friend", email="friend@example.com", password="x")
+        db.session.add(friend)
+        db.session.commit()
+        db.session.add(
+            Favorites(user_id=self.user.id, bookISBN="9780000000001", theme="War")
+        )
+        db.session.add(FavoriteThemes(user_id=self.user.id, theme="War", count=1))
+        db.session.add(
+            Recommendations(
+                sender_id=friend.id, receiver_id=self.user.id, bookISBN="9780000000002"
+            )
+        )
+        db.session.add(
+            Review(
+                user_id=self.user.id, isbn="9780000000001", comment="Fun", rating="4"
+            )
+        )
+        db.session.commit()
+
+    def import_file(self, name, content, cached_isbns=()):
+        cached = lambda isbns: {
+            isbn: BookRecord(isbn, themes=["War"])
+            for isbn in isbns
+            if isbn in cached_isbns
+        }
+        books = lambda isbns: [BookRecord(isbn, themes=["Humor"]) for isbn in isbns]
+        with patch("app.lookup_title_records", side_effect=cached), patch(
+            "app.basic_book_info_many", side_effect=books
+        ), patch("app.theme_fill_pool") as theme_fill_pool, patch(
+            "app.IMPORT_BATCH_SIZE", 2
+        ):
+            response = self.client.post(
+                "/api/v1/favorites/import",
+                data={"file": (io.BytesIO(content.encode("utf-8")), name)},
+                content_type="multipart/form-data",
+            )
+            # Themes that weren't cached are filled in on another thread once the response is sent. The tests'
+            # in-memory database has a single connection, so the fills only start after the request is over.
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                for fill in theme_fill_pool.submit.call_args_list:
+                    executor.submit(*fill.args).result()
+        return response
+
+    def test_import_favorites(self):
+        """Checks if an import adds each new book once, in batches, and counts the duplicates and invalid entries."""
+        response = self.import_file(
+            "goodreads_library_export.csv",
+            "Title,ISBN,ISBN13\n"
+            'A,"=""0439023483""","=""9780439023481"""\n'
+            'B,"=""""","=""9780000000001"""\n'
+            "C,0-306-40615-2,\n"
+            "D,,\n"
+            "\n"
+            "E,,9780439023481\n",
+            cached_isbns=["9780306406157"],
+        )
+        self.assertEqual(
+            response.get_json(), {"added": 2, "duplicates": 2, "invalid": 1}
+        )
+        self.assertEqual(
+            [favorite.bookISBN for favorite in Favorites.query.order_by(Favorites.id)],
+            ["9780000000001", "9780439023481", "9780306406157"],
+        )
+        theme_counts = {
+            theme_count.theme: theme_count.count
+            for theme_count in FavoriteThemes.query.filter_by(user_id=self.user.id)
+        }
+        self.assertEqual(theme_counts, {"War": 2, "Humor": 1})
+        self.assertEqual(
+            Favorites.query.filter_by(bookISBN="9780439023481").one().theme, "Humor"
+        )
+
+        response = self.import_file(
+            "books.jsonl", '{"isbn": "9780306406157"}\n"9781234567897"\nnot json\n'
+        )
+        self.assertEqual(
+            response.get_json(), {"added": 1, "duplicates": 1, "invalid": 1}
+        )
+        self.assertEqual(self.import_file("books.txt", "").status_code, 400)
+
+    def test_import_within_budget(self):
+        """Checks if an import batch runs a fixed number of queries and leaves every Penguin lookup to the background."""
+        content = "isbn\n9780439023481\n9780306406157\n9781234567897\n"
+        title_cache.clear()
+        with patch("app.theme_fill_pool") as theme_fill_pool:
+            # Loading the signed-in user, finding existing favorites, reading the catalog, one batched insert,
+            # and updating the theme histogram.
+            response = self.assertWithinBudget(
+                "/api/v1/favorites/import",
+                {"db": 5, "penguin": 0},
+                method="post",
+                data={"file": (io.BytesIO(content.encode("utf-8")), "books.csv")},
+                content_type="multipart/form-data",
+            )
+        self.assertEqual(response.get_json()["added"], 3)
+        theme_fill_pool.submit.assert_called_once()
+
+    def test_export_lists(self):
+        """Checks if each list is exported as CSV with a header row, or as JSON Lines, with spreadsheet formulas neutralized."""
+        with patch("book_lists.CHUNK_SIZE", 1):
+            response = self.client.get("/api/v1/favorites/export")
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, "text/csv")
+        self.assertEqual(response.data, b"isbn,theme\r\n9780000000001,War\r\n")
+
+        response = self.client.get("/api/v1/recommendations/export")
+        self.assertIn(b"9780000000002,'=friend", response.data)
+
+        response = self.client.get("/api/v1/reviews/export?format=jsonl")
+        self.assertEqual(
+            response.data,
+            b'{"isbn": "9780000000001", "rating": 4, "comment": "Fun"}\n',
+        )
+        self.assertEqual(
+            self.client.get("/api/v1/reviews/export?format=xml").status_code, 400
+        )
+
+    def test_normalize_isbn(self):
+        """Checks if ISBN-10s are converted to ISBN-13s and anything that isn't an ISBN is rejected."""
+        self.assertEqual(normalize_isbn("0-8044-2957-X"), "9780804429573")
+        self.assertEqual(normalize_isbn('="978-0-306-40615-7"'), "9780306406157")
+        for value in ["", "12345", "abcdefghij", None, True, ["9780306406157"]]:
+            self.assertIsNone(normalize_isbn(value))
+        lines = io.BytesIO(b"\xef\xbb\xbf0306406152\n9780306406157\n")
+        self.assertEqual(
+            list(read_isbns(lines, "csv")), ["9780306406157", "9780306406157"]
+        )
+
+
+class SearchIndexTests(unittest.TestCase):
+    """Houses a couple of tests for the local title search index."""
+
+    def setUp(self):
+        self.index = TitleIndex()
+        self.index.build(
+            [
+                ("1", "The Hobbit", "Tolkien, J.R.R.", "cover1"),
+                ("2", "The Fellowship of the Ring", "Tolkien, J.R.R.", "cover2"),
+                ("3", "Ring of Fire", "Cash, Johnny", "cover3"),
+                ("4", "Les Misérables", "Hugo, Victor", "cover4"),
+            ]
+        )
+
+    def test_tokenize(self):
+        """Checks if text is lowercased, split into words, and stripped of accents."""
+        self.assertEqual(tokenize("Les Misérables!"), ["les", "miserables"])
+
+    def test_ranking(self):
+        """Checks if title matches outrank author matches and results are returned in ranked order."""
+        results = self.index.search("ring tolkien")
+        self.assertEqual([isbn for title, cover, isbn in results], ["2", "3", "1"])
+
+    def test_prefix_matching(self):
+        """Checks if partial words match the start of indexed words, accents included."""
+        self.assertEqual(
+            self.index.search("miser"), [("Les Misérables", "cover4", "4")]
+        )
+        self.assertEqual(self.index.search("fellow ri", limit=1)[0][2], "2")
+        self.assertEqual(self.index.search("zebra"), [])
+
 
 if __name__ == "__main__":
     unittest.main()
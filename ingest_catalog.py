@@ -0,0 +1,94 @@
+# Mirrors Penguin title records into the local Books catalog so that book lookups stay off the network.
+# Usage: python ingest_catalog.py [--theme THEME ...] [--all] [--page-size N] [--max-pages N]
+import argparse
+from datetime import datetime
+from app import create_app
+from models import db, Books, BookThemes, BOOK_THEMES
+from penguin import fetch_title_page, catalog_row, theme_list
+
+
+def upsert_books(records):
+    """Inserts or updates a page of title records in the catalog with one lookup query and bulk writes. Returns how many books were stored."""
+    updated_at = datetime.utcnow()
+    rows = {}
+    book_themes = {}
+    for record in records:
+        try:
+            row = catalog_row(record)
+        except (KeyError, TypeError, ValueError):
+            # Records missing their title, cover, or ISBN can't be displayed, so they are skipped.
+            continue
+        row["updated_at"] = updated_at
+        rows[row["isbn"]] = row
+        book_themes[row["isbn"]] = list(dict.fromkeys(theme_list(record.get("themes"))))
+
+    if not rows:
+        return 0
+
+    existing_isbns = {
+        isbn
+        for (isbn,) in db.session.query(Books.isbn).filter(Books.isbn.in_(rows.keys()))
+    }
+    db.session.bulk_insert_mappings(
+        Books, [row for isbn, row in rows.items() if isbn not in existing_isbns]
+    )
+    db.session.bulk_update_mappings(
+        Books, [row for isbn, row in rows.items() if isbn in existing_isbns]
+    )
+
+    BookThemes.query.filter(BookThemes.isbn.in_(rows.keys())).delete(
+        synchronize_session=False
+    )
+    db.session.bulk_insert_mappings(
+        BookThemes,
+        [
+            {"isbn": isbn, "theme": theme, "position": position}
+            for isbn, themes in book_themes.items()
+            for position, theme in enumerate(themes)
+        ],
+    )
+    db.session.commit()
+    return len(rows)
+
+
+def ingest(theme=None, page_size=100, max_pages=50):
+    """Pages through Penguin's titles endpoint (optionally for a single theme) and upserts every page into the catalog."""
+    total = 0
+    for page in range(max_pages):
+        records = fetch_title_page(page * page_size, page_size, theme=theme)
+        total += upsert_books(records)
+        if len(records) < page_size:
+            break
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Mirror Penguin title records into the local book catalog."
+    )
+    parser.add_argument(
+        "--theme",
+        action="append",
+        help="a theme to ingest (may be repeated); defaults to every suggestion theme",
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="also page through every title regardless of theme",
+    )
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--max-pages", type=int, default=50)
+    args = parser.parse_args()
+
+    themes = args.theme or BOOK_THEMES
+    with create_app().app_context():
+        for theme in themes:
+            count = ingest(theme, args.page_size, args.max_pages)
+            print("%s: %d books" % (theme, count))
+        if args.all:
+            count = ingest(None, args.page_size, args.max_pages)
+            print("All titles: %d books" % count)
+
+
+if __name__ == "__main__":
+    main()
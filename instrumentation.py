@@ -0,0 +1,465 @@
+# Lightweight per-request instrumentation. Time spent in Penguin calls, SQL statements, and template rendering
+# is added up for each request and reported in its Server-Timing header and a structured (JSON) log line, and
+# aggregated per route and per upstream function into Prometheus-style metrics served at /metrics.
+# Metrics are kept per worker process. Tests can also capture every SQL statement and Penguin call a request
+# made (see capture_requests()), to hold routes to a query budget.
+import asyncio
+import functools
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import flask
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds (in seconds) of the latency histograms' buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+request_log = logging.getLogger("bookbite.requests")
+
+
+def label_text(labels):
+    """Returns a label set in Prometheus' {name="value",...} form."""
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+
+
+class Metrics:
+    """A thread-safe registry of counters and latency histograms, each keyed by name and label set."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.descriptions = {}
+        self.counters = {}
+        self.histograms = {}
+        # Functions returning (name, labels, value) samples of counters kept elsewhere, read on every render.
+        self.collectors = []
+
+    def describe(self, name, kind, description):
+        """Sets the type and help text listed for a metric."""
+        self.descriptions[name] = (kind, description)
+
+    def inc(self, name, labels=None, amount=1):
+        """Adds to a counter."""
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add_collector(self, collect):
+        """Registers a function returning (name, labels, value) samples, which is called each time the metrics are rendered."""
+        self.collectors.append(collect)
+
+    def observe(self, name, seconds, labels=None):
+        """Records one measurement in a histogram."""
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        samples = [
+            ((name, tuple(sorted(labels.items()))), value)
+            for collect in self.collectors
+            for name, labels, value in collect()
+        ]
+        with self.lock:
+            counters = sorted(list(self.counters.items()) + samples)
+            histograms = sorted(
+                (key, (list(buckets), total, count))
+                for key, (buckets, total, count) in self.histograms.items()
+            )
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described and name in self.descriptions:
+                kind, description = self.descriptions[name]
+                lines.append("# HELP %s %s" % (name, description))
+                lines.append("# TYPE %s %s" % (name, kind))
+                described.add(name)
+
+        for (name, labels), value in counters:
+            describe(name)
+            lines.append("%s%s %s" % (name, label_text(labels), value))
+        for (name, labels), (buckets, total, count) in histograms:
+            describe(name)
+            for bound, bucket_count in zip(self.buckets, buckets):
+                bucket_labels = labels + (("le", bound),)
+                lines.append(
+                    "%s_bucket%s %d" % (name, label_text(bucket_labels), bucket_count)
+                )
+            lines.append(
+                "%s_bucket%s %d" % (name, label_text(labels + (("le", "+Inf"),)), count)
+            )
+            lines.append("%s_sum%s %f" % (name, label_text(labels), total))
+            lines.append("%s_count%s %d" % (name, label_text(labels), count))
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        """Forgets every measurement (collected samples are read from their source)."""
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+metrics = Metrics()
+metrics.describe(
+    "bookbite_requests_total", "counter", "Requests served, by route and status."
+)
+metrics.describe(
+    "bookbite_request_seconds", "histogram", "Time taken to serve a request, by route."
+)
+metrics.describe(
+    "bookbite_upstream_seconds",
+    "histogram",
+    "Time spent in calls to Penguin, by penguin.py function.",
+)
+metrics.describe(
+    "bookbite_upstream_errors_total",
+    "counter",
+    "Calls to Penguin that raised, by penguin.py function.",
+)
+metrics.describe(
+    "bookbite_db_seconds",
+    "histogram",
+    "Time spent in SQL statements, by statement type.",
+)
+metrics.describe(
+    "bookbite_render_seconds",
+    "histogram",
+    "Time spent rendering templates, by template.",
+)
+metrics.describe(
+    "bookbite_cache_events_total",
+    "counter",
+    "Cache hits, misses, evictions, and other events, by cache and event.",
+)
+metrics.describe("bookbite_cache_entries", "gauge", "Entries held, by cache.")
+metrics.describe("bookbite_cache_maxsize", "gauge", "Entries each cache may hold.")
+metrics.describe(
+    "bookbite_lookup_calls_total",
+    "counter",
+    "Title, page, and suggestion pool lookups made through penguin.lookup_flights.",
+)
+metrics.describe(
+    "bookbite_lookup_coalesced_total",
+    "counter",
+    "Lookups that shared another caller's in-flight fetch instead of making their own.",
+)
+metrics.describe(
+    "bookbite_lookups_in_flight", "gauge", "Distinct lookups currently being fetched."
+)
+
+
+def cache_collector(name, stats):
+    """Returns a collector reporting the counters and size from a cache's stats function (see TTLCache.stats) under a cache label."""
+
+    def collect():
+        counts = dict(stats())
+        labels = {"cache": name}
+        samples = [
+            ("bookbite_cache_entries", labels, counts.pop("size")),
+            ("bookbite_cache_maxsize", labels, counts.pop("maxsize")),
+        ]
+        return samples + [
+            ("bookbite_cache_events_total", dict(labels, event=event), count)
+            for event, count in counts.items()
+        ]
+
+    return collect
+
+
+class RequestTimings:
+    """Adds up how long one request spent on each kind of work, and how many times it did it."""
+
+    def __init__(self, trace=False):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.totals = {}
+        # Start times of the templates being rendered, innermost last.
+        self.renders = []
+        # With trace set, each piece of work is also listed as (kind, detail), in order.
+        self.events = [] if trace else None
+
+    def add(self, kind, seconds, detail=None):
+        """Counts one piece of work of a kind that took seconds."""
+        with self.lock:
+            total = self.totals.setdefault(kind, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+            if self.events is not None:
+                self.events.append((kind, detail))
+
+    def summary(self):
+        """Returns the total milliseconds and count for each kind of work, and the request's duration so far."""
+        with self.lock:
+            summary = {
+                kind + "_ms": round(seconds * 1000, 1)
+                for kind, (seconds, count) in self.totals.items()
+            }
+            summary.update(
+                {
+                    kind + "_count": count
+                    for kind, (seconds, count) in self.totals.items()
+                }
+            )
+        summary["total_ms"] = round((time.perf_counter() - self.started) * 1000, 1)
+        return summary
+
+    def server_timing(self):
+        """Returns the request's timings as a Server-Timing header value. Concurrent calls are summed."""
+        with self.lock:
+            entries = [
+                '%s;dur=%.1f;desc="%d calls"' % (kind, seconds * 1000, count)
+                for kind, (seconds, count) in sorted(self.totals.items())
+            ]
+        entries.append("total;dur=%.1f" % ((time.perf_counter() - self.started) * 1000))
+        return ", ".join(entries)
+
+
+# The timings of the request being served. Async views, sync_to_async() calls, and lookups fanned out on
+# penguin.lookup_pool (see penguin.submit_lookup) see the same object, since they run with a copy of the
+# request's context; background work (such as stale-record refreshes) isn't attributed to any request.
+current_timings = ContextVar("current_timings", default=None)
+
+
+def record(kind, seconds, metric, labels, detail=None):
+    """Adds a measurement to the current request's timings (if any) and to a histogram."""
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(kind, seconds, detail)
+    metrics.observe(metric, seconds, labels)
+
+
+class RequestTrace:
+    """Every SQL statement ("db"), Penguin call ("penguin"), and template ("render") of one finished request, in order."""
+
+    def __init__(self, method, path, route, status, events):
+        self.method = method
+        self.path = path
+        self.route = route
+        self.status = status
+        self.events = events
+
+    def count(self, kind):
+        """Returns how many times the request did a kind of work."""
+        return sum(1 for event_kind, detail in self.events if event_kind == kind)
+
+    def over_budget(self, budget):
+        """Returns the kinds of work the request did more often than budget (a {kind: limit} dict) allows."""
+        return [kind for kind, limit in budget.items() if self.count(kind) > limit]
+
+    def report(self, budget):
+        """Returns a readable account of the request's work against a budget. Statements run more than once are flagged, since a loop of them usually means an N+1 query."""
+        lines = [
+            "%s %s (%s, status %s) went over its budget:"
+            % (self.method, self.path, self.route, self.status)
+        ]
+        for kind, limit in budget.items():
+            count = self.count(kind)
+            lines.append(
+                "  %s: %d (budget %d)%s"
+                % (kind, count, limit, "  <-- over" if count > limit else "")
+            )
+            details = Counter(
+                detail for event_kind, detail in self.events if event_kind == kind
+            )
+            for detail, times in details.most_common():
+                detail = re.sub(r"\s+", " ", str(detail)).strip()
+                if len(detail) > 120:
+                    detail = detail[:117] + "..."
+                lines.append(
+                    "    %3dx %s%s"
+                    % (times, detail, "  (repeated: N+1?)" if times > 1 else "")
+                )
+        return "\n".join(lines)
+
+
+# Lists receiving a RequestTrace for every request that finishes while capture_requests() is active.
+active_captures = []
+captures_lock = threading.Lock()
+
+
+@contextmanager
+def capture_requests():
+    """Collects a RequestTrace of every request that finishes inside the block into the list it yields. Meant for tests."""
+    traces = []
+    with captures_lock:
+        active_captures.append(traces)
+    try:
+        yield traces
+    finally:
+        with captures_lock:
+            active_captures.remove(traces)
+
+
+def timed_upstream(function):
+    """Decorates a penguin.py function (sync or async) that calls Penguin, timing every call."""
+    labels = {"function": function.__name__}
+
+    def finish(started, failed):
+        record(
+            "penguin",
+            time.perf_counter() - started,
+            "bookbite_upstream_seconds",
+            labels,
+            function.__name__,
+        )
+        if failed:
+            metrics.inc("bookbite_upstream_errors_total", labels)
+
+    if asyncio.iscoroutinefunction(function):
+
+        @functools.wraps(function)
+        async def timed_async(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = await function(*args, **kwargs)
+            except Exception:
+                finish(started, True)
+                raise
+            finish(started, False)
+            return result
+
+        return timed_async
+
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            finish(started, True)
+            raise
+        finish(started, False)
+        return result
+
+    return timed
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def finish_statement(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["statement_started"].pop()
+    statement_type = statement.lstrip().split(None, 1)[0].upper() if statement else ""
+    record(
+        "db",
+        time.perf_counter() - started,
+        "bookbite_db_seconds",
+        {"statement": statement_type},
+        statement,
+    )
+
+
+def start_render(sender, template, context, **extra):
+    timings = current_timings.get()
+    if timings is not None:
+        timings.renders.append(time.perf_counter())
+
+
+def finish_render(sender, template, context, **extra):
+    timings = current_timings.get()
+    if timings is not None and timings.renders:
+        record(
+            "render",
+            time.perf_counter() - timings.renders.pop(),
+            "bookbite_render_seconds",
+            {"template": template.name},
+            template.name,
+        )
+
+
+def start_request():
+    flask.g.timings_token = current_timings.set(
+        RequestTimings(trace=bool(active_captures))
+    )
+
+
+def finish_request(response):
+    """Adds the Server-Timing header, logs the request's timings, and records its route's metrics."""
+    timings = current_timings.get()
+    if timings is None:
+        return response
+    route = flask.request.endpoint or "unmatched"
+    response.headers["Server-Timing"] = timings.server_timing()
+    summary = timings.summary()
+    metrics.inc(
+        "bookbite_requests_total", {"route": route, "status": response.status_code}
+    )
+    metrics.observe(
+        "bookbite_request_seconds", summary["total_ms"] / 1000, {"route": route}
+    )
+    if flask.current_app.config.get("REQUEST_LOG"):
+        request_log.info(
+            json.dumps(
+                dict(
+                    summary,
+                    method=flask.request.method,
+                    path=flask.request.path,
+                    route=route,
+                    status=response.status_code,
+                )
+            )
+        )
+    if timings.events is not None:
+        trace = RequestTrace(
+            flask.request.method,
+            flask.request.full_path.rstrip("?"),
+            route,
+            response.status_code,
+            list(timings.events),
+        )
+        with captures_lock:
+            for traces in active_captures:
+                traces.append(trace)
+    return response
+
+
+def reset_request(exception=None):
+    # gthread workers reuse their threads, so the request's timings mustn't outlive it.
+    token = flask.g.pop("timings_token", None)
+    if token is not None:
+        current_timings.reset(token)
+
+
+def show_metrics():
+    """Returns every metric in the Prometheus text exposition format."""
+    return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def instrument_app(app):
+    """Times every request to the app, reporting the timings in responses and logs and serving /metrics."""
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(reset_request)
+    before_render_template.connect(start_render, app)
+    template_rendered.connect(finish_render, app)
+    app.add_url_rule("/metrics", "metrics", show_metrics)
+    if app.config.get("REQUEST_LOG") and not request_log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        request_log.addHandler(handler)
+        request_log.setLevel(logging.INFO)
@@ -0,0 +1,323 @@
+# Brings an existing database up to date with the tables and columns defined in models.py.
+# db.create_all() only creates missing tables, so changes to existing tables are applied here.
+# Older tables are reflected from the database rather than read through the models, since the
+# models always describe the latest schema. Every migration is safe to run more than once.
+# Usage: python migrations.py
+from sqlalchemy import (
+    Integer,
+    MetaData,
+    Table,
+    bindparam,
+    case,
+    cast,
+    delete,
+    func,
+    inspect,
+    select,
+    text,
+)
+from app import create_app
+from models import (
+    db,
+    Books,
+    BookThemes,
+    Users,
+    Favorites,
+    FavoriteThemes,
+    Recommendations,
+    Review,
+    ReviewStats,
+    REVIEW_RATINGS,
+    ISBN_LENGTH,
+)
+from penguin import basic_book_info_many
+
+# Favorites are backfilled this many at a time, each batch's books looked up in parallel.
+BACKFILL_BATCH_SIZE = 200
+
+
+def column_names(table_name):
+    """Returns the names of the columns currently present on a table."""
+    return [column["name"] for column in inspect(db.engine).get_columns(table_name)]
+
+
+def reflect(table_name):
+    """Returns a table exactly as it currently exists in the database."""
+    return Table(table_name, MetaData(), autoload_with=db.engine)
+
+
+def add_favorite_themes():
+    """Adds the primary theme column to Favorites and backfills it."""
+    if "theme" not in column_names(Favorites.__tablename__):
+        db.session.execute(
+            text(
+                "ALTER TABLE %s ADD COLUMN theme VARCHAR(100)" % Favorites.__tablename__
+            )
+        )
+        db.session.commit()
+
+    # Themes that couldn't be looked up are left NULL, so running this again retries them.
+    favorites = reflect(Favorites.__tablename__)
+    rows = db.session.execute(
+        select(favorites.c.id, favorites.c.bookISBN).where(favorites.c.theme.is_(None))
+    ).all()
+    update = (
+        favorites.update()
+        .where(favorites.c.id == bindparam("favorite_id"))
+        .values(theme=bindparam("new_theme"))
+    )
+    for start in range(0, len(rows), BACKFILL_BATCH_SIZE):
+        batch = rows[start : start + BACKFILL_BATCH_SIZE]
+        books = basic_book_info_many([isbn for favorite_id, isbn in batch])
+        themes = [
+            {"favorite_id": favorite_id, "new_theme": book.primary_theme}
+            for (favorite_id, isbn), book in zip(batch, books)
+            if book.primary_theme is not None
+        ]
+        if themes:
+            db.session.execute(update, themes)
+        db.session.commit()
+
+
+def remove_duplicates(table, *column_names):
+    """Deletes every row that repeats an earlier row's values for the given columns, keeping the oldest."""
+    columns = [table.c[name] for name in column_names]
+    kept_ids = select(func.min(table.c.id)).group_by(*columns)
+    db.session.execute(delete(table).where(table.c.id.notin_(kept_ids)))
+    db.session.commit()
+
+
+def remove_duplicate_rows():
+    """Removes duplicate favorites and recommendations from tables still keyed by email and username, so unique indexes can be added."""
+    if "email" in column_names(Favorites.__tablename__):
+        remove_duplicates(reflect(Favorites.__tablename__), "email", "bookISBN")
+    if "senderUsername" in column_names(Recommendations.__tablename__):
+        remove_duplicates(
+            reflect(Recommendations.__tablename__),
+            "senderUsername",
+            "receiverUsername",
+            "bookISBN",
+        )
+
+
+# The tables use_user_foreign_keys rebuilds, with a column only their old layout has and their ISBN column.
+OLD_ISBN_COLUMNS = [
+    (Favorites, "email", "bookISBN"),
+    (Recommendations, "senderUsername", "bookISBN"),
+    (Review, "username", "isbn"),
+]
+
+
+def old_isbn_columns():
+    """Returns the ISBN column of each table that still has its old layout."""
+    return [
+        reflect(model.__tablename__).c[isbn_column]
+        for model, old_column, isbn_column in OLD_ISBN_COLUMNS
+        if old_column in column_names(model.__tablename__)
+    ]
+
+
+def strip_long_isbns():
+    """Removes the spaces and hyphens from ISBNs too long for the shortened ISBN columns, before duplicates are removed."""
+    for column in old_isbn_columns():
+        db.session.execute(
+            column.table.update()
+            .where(func.length(column) > ISBN_LENGTH)
+            .values({column.name: func.replace(func.replace(column, "-", ""), " ", "")})
+        )
+    db.session.commit()
+
+
+def rebuild_table(model, copy_rows):
+    """Replaces a table with a fresh one matching its model. The old table is renamed, its rows copied over by copy_rows(old_table), and then dropped."""
+    table_name = model.__tablename__
+    old_table_name = table_name + "_old"
+
+    # Index names must be unique across the database, so the old table's indexes are dropped first.
+    for index in inspect(db.engine).get_indexes(table_name):
+        db.session.execute(text("DROP INDEX %s" % index["name"]))
+    db.session.execute(
+        text("ALTER TABLE %s RENAME TO %s" % (table_name, old_table_name))
+    )
+    db.session.commit()
+
+    model.__table__.create(bind=db.engine)
+    old_table = reflect(old_table_name)
+    copy_rows(old_table)
+    db.session.commit()
+    old_table.drop(bind=db.engine)
+
+
+def use_user_foreign_keys():
+    """Moves Favorites, Recommendations, and Review from email/username strings to integer user IDs and shortens their ISBN columns.
+    Rows whose user no longer exists (orphaned by an earlier profile rename) are dropped. If any ISBN is still too long
+    after strip_long_isbns(), nothing is changed and the offending rows are listed so they can be fixed by hand.
+    """
+    long_isbns = [
+        (column.table.name, row_id, isbn)
+        for column in old_isbn_columns()
+        for row_id, isbn in db.session.execute(
+            select(column.table.c.id, column).where(func.length(column) > ISBN_LENGTH)
+        )
+    ]
+    if long_isbns:
+        raise RuntimeError(
+            "These rows have ISBNs longer than %d characters, which the new ISBN columns can't hold. "
+            "Correct or delete them, then run the migrations again:\n%s"
+            % (
+                ISBN_LENGTH,
+                "\n".join("  %s id %s: %r" % long_isbn for long_isbn in long_isbns),
+            )
+        )
+
+    users = Users.__table__
+
+    # Usernames were never guaranteed to be unique, so each one maps to its oldest account.
+    user_ids = (
+        select(func.min(users.c.id).label("id"), users.c.username)
+        .group_by(users.c.username)
+        .subquery()
+    )
+    senders = user_ids.alias("senders")
+    receivers = user_ids.alias("receivers")
+
+    def copy_favorites(old):
+        db.session.execute(
+            Favorites.__table__.insert().from_select(
+                ["user_id", "bookISBN", "theme"],
+                select(users.c.id, old.c.bookISBN, old.c.theme)
+                .join(users, users.c.email == old.c.email)
+                .order_by(old.c.id),
+            )
+        )
+
+    def copy_recommendations(old):
+        db.session.execute(
+            Recommendations.__table__.insert().from_select(
+                ["sender_id", "receiver_id", "bookISBN"],
+                select(senders.c.id, receivers.c.id, old.c.bookISBN)
+                .join(senders, senders.c.username == old.c.senderUsername)
+                .join(receivers, receivers.c.username == old.c.receiverUsername)
+                .order_by(old.c.id),
+            )
+        )
+
+    def copy_reviews(old):
+        db.session.execute(
+            Review.__table__.insert().from_select(
+                ["user_id", "isbn", "comment", "rating"],
+                select(user_ids.c.id, old.c.isbn, old.c.comment, old.c.rating)
+                .join(user_ids, user_ids.c.username == old.c.username)
+                .order_by(old.c.id),
+            )
+        )
+
+    if "user_id" not in column_names(Favorites.__tablename__):
+        rebuild_table(Favorites, copy_favorites)
+    if "sender_id" not in column_names(Recommendations.__tablename__):
+        rebuild_table(Recommendations, copy_recommendations)
+    if "user_id" not in column_names(Review.__tablename__):
+        rebuild_table(Review, copy_reviews)
+
+
+def rebuild_theme_histogram():
+    """Recounts every user's favorite themes from the Favorites table."""
+    if "user_id" not in column_names(FavoriteThemes.__tablename__):
+        FavoriteThemes.__table__.drop(bind=db.engine)
+        FavoriteThemes.__table__.create(bind=db.engine)
+
+    FavoriteThemes.query.delete()
+    theme_counts = (
+        db.session.query(Favorites.user_id, Favorites.theme, func.count(Favorites.id))
+        .filter(Favorites.theme.isnot(None))
+        .group_by(Favorites.user_id, Favorites.theme)
+        .all()
+    )
+    for user_id, theme, count in theme_counts:
+        db.session.add(FavoriteThemes(user_id=user_id, theme=theme, count=count))
+    db.session.commit()
+
+
+# Indexes that have since been replaced by a wider index on the same table.
+OBSOLETE_INDEXES = {Review.__tablename__: ["ix_review_isbn"]}
+
+
+def add_lookup_indexes():
+    """Creates any indexes and unique constraints missing from the hot lookup tables and drops the ones they replaced."""
+    for model in [Users, Favorites, FavoriteThemes, Recommendations, Review]:
+        existing_indexes = {
+            index["name"]
+            for index in inspect(db.engine).get_indexes(model.__tablename__)
+        }
+        for index_name in OBSOLETE_INDEXES.get(model.__tablename__, []):
+            if index_name in existing_indexes:
+                db.session.execute(text("DROP INDEX %s" % index_name))
+                db.session.commit()
+        for index in model.__table__.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=db.engine)
+
+
+def shorten_catalog_isbns():
+    """Recreates the Books and BookThemes catalog tables if their ISBN columns are wider than ISBN_LENGTH.
+    The catalog only mirrors Penguin, so its rows are dropped rather than copied; run ingest_catalog.py again afterwards.
+    """
+    columns = inspect(db.engine).get_columns(Books.__tablename__)
+    isbn_type = next(column["type"] for column in columns if column["name"] == "isbn")
+    if getattr(isbn_type, "length", None) in (None, ISBN_LENGTH):
+        return
+    BookThemes.__table__.drop(bind=db.engine, checkfirst=True)
+    Books.__table__.drop(bind=db.engine)
+    Books.__table__.create(bind=db.engine)
+    BookThemes.__table__.create(bind=db.engine)
+    print("The book catalog was emptied; run python ingest_catalog.py to refill it.")
+
+
+def rebuild_review_stats():
+    """Recounts every book's review aggregates from the Review table."""
+    ReviewStats.query.delete()
+    rating = cast(Review.rating, Integer)
+    review_counts = (
+        db.session.query(
+            Review.isbn,
+            func.count(Review.id),
+            func.sum(rating),
+            *[
+                func.sum(case((rating == value, 1), else_=0))
+                for value in REVIEW_RATINGS
+            ],
+        )
+        .group_by(Review.isbn)
+        .all()
+    )
+    for isbn, count, rating_sum, *histogram in review_counts:
+        review_stats = ReviewStats(isbn=isbn, count=count, rating_sum=rating_sum)
+        for value, rating_count in zip(REVIEW_RATINGS, histogram):
+            setattr(review_stats, "rating_%d" % value, rating_count)
+        db.session.add(review_stats)
+    db.session.commit()
+
+
+MIGRATIONS = [
+    add_favorite_themes,
+    strip_long_isbns,
+    remove_duplicate_rows,
+    use_user_foreign_keys,
+    rebuild_theme_histogram,
+    rebuild_review_stats,
+    add_lookup_indexes,
+    shorten_catalog_isbns,
+]
+
+
+def run_migrations():
+    """Creates any missing tables, then applies every migration in order."""
+    db.create_all()
+    for migration in MIGRATIONS:
+        print("Applying %s..." % migration.__name__)
+        migration()
+
+
+if __name__ == "__main__":
+    with create_app().app_context():
+        run_migrations()
@@ -7,6 +7,53 @@ from wtforms.validators import InputRequired, Length, ValidationError, Optional
 
 db = SQLAlchemy()
 
+# ISBN-13s are always 13 characters long, which is all that's stored for a book reference.
+ISBN_LENGTH = 13
+
+
+def strip_isbn(value):
+    """Returns an ISBN without the spaces and hyphens it is often written with."""
+    if value is None:
+        return None
+    return "".join(str(value).split()).replace("-", "")
+
+
+def clean_isbn(value):
+    """Returns an ISBN without spaces and hyphens, or None if nothing is left or it's too long to store."""
+    isbn = strip_isbn(value)
+    if not isbn or len(isbn) > ISBN_LENGTH:
+        return None
+    return isbn
+
+
+# Every theme a user can pick from when asking for suggestions.
+BOOK_THEMES = [
+    "Adventure",
+    "Animals",
+    "Betrayal",
+    "Classics",
+    "Coming of Age",
+    "Determination",
+    "Fairy Tales & Fables",
+    "Family & Relationships",
+    "Fantasy",
+    "Friendship",
+    "Geography",
+    "Good vs. Evil",
+    "Halloween",
+    "Horror",
+    "Humor",
+    "Love & Romance",
+    "Media",
+    "Patriotism",
+    "Science & Nature",
+    "Science Fiction",
+    "Self-Discovery",
+    "Supernatural",
+    "Survival",
+    "War",
+]
+
 # =====================================================================
 # SECTION 1: SIGN-UP/LOGIN FORMS
 # =====================================================================
@@ -79,7 +126,9 @@ class BookInfoFormAdd(FlaskForm):
     original_route = StringField(render_kw={"readonly": True})
 
     isbn = StringField(
-        validators=[Length(min=1, max=15)], render_kw={"readonly": True},
+        validators=[Length(min=1, max=ISBN_LENGTH)],
+        filters=[strip_isbn],
+        render_kw={"readonly": True},
     )
     submit_explore = SubmitField(label="Explore")
     submit_add = SubmitField(label="Favorite")
@@ -89,7 +138,9 @@ class BookInfoFormSendRecs(FlaskForm):
     """Establishes the basic fields required for a form used to pull certain information about a displayed book or send a specific user a recommendation."""
 
     isbn = StringField(
-        validators=[Length(min=1, max=15)], render_kw={"readonly": True},
+        validators=[Length(min=1, max=ISBN_LENGTH)],
+        filters=[strip_isbn],
+        render_kw={"readonly": True},
     )
     receiver_username = StringField(
         validators=[Length(min=1, max=80), Optional()],
@@ -104,7 +155,9 @@ class BookInfoFormDeleteRecs(FlaskForm):
     """Establishes the basic fields required for a form used to pull certain information about a displayed book or delete a recommendation from other users."""
 
     isbn = StringField(
-        validators=[Length(min=1, max=15)], render_kw={"readonly": True},
+        validators=[Length(min=1, max=ISBN_LENGTH)],
+        filters=[strip_isbn],
+        render_kw={"readonly": True},
     )
     receiver_username = StringField(
         validators=[Length(min=1, max=80), Optional()],
@@ -118,36 +171,8 @@ class BookInfoFormDeleteRecs(FlaskForm):
 class BookThemeForm(FlaskForm):
     """Establishes the basic fields required for a form used to select a theme out of a list of options."""
 
-    # Note: Theme options must be added here For simplicity sake, dummyValue = dummyName.
-    theme = SelectField(
-        "theme",
-        choices=[
-            ("Adventure", "Adventure"),
-            ("Animals", "Animals"),
-            ("Betrayal", "Betrayal"),
-            ("Classics", "Classics"),
-            ("Coming of Age", "Coming of Age"),
-            ("Determination", "Determination"),
-            ("Fairy Tales & Fables", "Fairy Tales & Fables"),
-            ("Family & Relationships", "Family & Relationships"),
-            ("Fantasy", "Fantasy"),
-            ("Friendship", "Friendship"),
-            ("Geography", "Geography"),
-            ("Good vs. Evil", "Good vs. Evil"),
-            ("Halloween", "Halloween"),
-            ("Horror", "Horror"),
-            ("Humor", "Humor"),
-            ("Love & Romance", "Love & Romance"),
-            ("Media", "Media"),
-            ("Patriotism", "Patriotism"),
-            ("Science & Nature", "Science & Nature"),
-            ("Science Fiction", "Science Fiction"),
-            ("Self-Discovery", "Self-Discovery"),
-            ("Supernatural", "Supernatural"),
-            ("Survival", "Survival"),
-            ("War", "War"),
-        ],
-    )
+    # Note: Theme options must be added to BOOK_THEMES above.
+    theme = SelectField("theme", choices=[(theme, theme) for theme in BOOK_THEMES])
     submit = SubmitField("Submit")
 
 
@@ -165,7 +190,9 @@ class ReviewForm(FlaskForm):
     """Fields required for a review form"""
 
     isbn = StringField(
-        validators=[Length(min=1, max=15)], render_kw={"readonly": True},
+        validators=[Length(min=1, max=ISBN_LENGTH)],
+        filters=[strip_isbn],
+        render_kw={"readonly": True},
     )
     comment = StringField(
         validators=[Length(min=1, max=200), Optional()],
@@ -203,25 +230,67 @@ class Users(db.Model, UserMixin):
     email = db.Column(db.String(100), nullable=False, unique=True)
     password = db.Column(db.String(200), nullable=False)
 
+    __table_args__ = (db.Index("ix_users_username", "username"),)
+
 
 class Favorites(db.Model):
-    """Defines a "Favorites" table in the database with two basic attributes outside of ID: the user's email and the ISBN of the favorited book."""
+    """Defines a "Favorites" table in the database with three basic attributes outside of ID: the user who favorited the book, the book's ISBN, and that book's primary theme."""
 
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(100), nullable=False)
-    bookISBN = db.Column(db.String(100), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    bookISBN = db.Column(db.String(ISBN_LENGTH), nullable=False)
+    theme = db.Column(db.String(100), nullable=True)
+
+    # Pages of a user's favorites are keyed by ID, so they're served by the second index.
+    __table_args__ = (
+        db.Index("uq_favorites_user_isbn", "user_id", "bookISBN", unique=True),
+        db.Index("ix_favorites_user_id_id", "user_id", "id"),
+    )
 
     def __repr__(self):
         return "<Favorites %r>" % self.bookISBN
 
 
+class FavoriteThemes(db.Model):
+    """Defines a "FavoriteThemes" table in the database that counts how many of a user's favorited books fall under each primary theme."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    theme = db.Column(db.String(100), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "theme"),
+        db.Index("ix_favorite_themes_user_count", "user_id", "count"),
+    )
+
+    def __repr__(self):
+        return "<FavoriteThemes %r: %r>" % (self.theme, self.count)
+
+
 class Recommendations(db.Model):
-    """Defines a "Recommendations" table in the database with three basic attributes outside of ID: the sender's name, receiver's name, and ISBN of the recommended book."""
+    """Defines a "Recommendations" table in the database with three basic attributes outside of ID: the sending user, the receiving user, and ISBN of the recommended book."""
 
     id = db.Column(db.Integer, primary_key=True)
-    senderUsername = db.Column(db.String(80), nullable=False)
-    receiverUsername = db.Column(db.String(80), nullable=False)
-    bookISBN = db.Column(db.String(100), nullable=False)
+    sender_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    receiver_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    bookISBN = db.Column(db.String(ISBN_LENGTH), nullable=False)
+
+    sender = db.relationship("Users", foreign_keys=[sender_id])
+    receiver = db.relationship("Users", foreign_keys=[receiver_id])
+
+    __table_args__ = (
+        db.Index(
+            "uq_recommendations_sender_receiver_isbn",
+            "sender_id",
+            "receiver_id",
+            "bookISBN",
+            unique=True,
+        ),
+        db.Index("ix_recommendations_receiver_isbn", "receiver_id", "bookISBN"),
+        # Serves pages of a user's received recommendations, which are keyed by ID.
+        db.Index("ix_recommendations_receiver_id_id", "receiver_id", "id"),
+    )
 
     def __repr__(self):
         return "<Favorites %r>" % self.bookISBN
@@ -231,11 +300,21 @@ class Review(db.Model):
     """ "Creating Review table"""
 
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(30), nullable=False)
-    isbn = db.Column(db.String(20), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    isbn = db.Column(db.String(ISBN_LENGTH), nullable=False)
     comment = db.Column(db.String(200), nullable=False)
     rating = db.Column(db.String(15), nullable=False)
 
+    user = db.relationship("Users")
+
+    # Also serves newest-first pages of a book's reviews, which are keyed by ID.
+    __table_args__ = (db.Index("ix_review_isbn_id", "isbn", "id"),)
+
+    @property
+    def username(self):
+        """The reviewer's current username."""
+        return self.user.username
+
     def __repr__(self):
         """ "Creating Review table"""
         return f"<User {self.username}>"
@@ -243,3 +322,68 @@ class Review(db.Model):
     def get_username(self):
         """ "Creating Review table"""
         return self.username
+
+
+REVIEW_RATINGS = [1, 2, 3, 4, 5]
+
+
+class ReviewStats(db.Model):
+    """Defines a "ReviewStats" table in the database that keeps the number of reviews, the sum of their ratings, and a count per rating for each reviewed ISBN."""
+
+    isbn = db.Column(db.String(ISBN_LENGTH), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    rating_1 = db.Column(db.Integer, nullable=False, default=0)
+    rating_2 = db.Column(db.Integer, nullable=False, default=0)
+    rating_3 = db.Column(db.Integer, nullable=False, default=0)
+    rating_4 = db.Column(db.Integer, nullable=False, default=0)
+    rating_5 = db.Column(db.Integer, nullable=False, default=0)
+
+    @property
+    def average_rating(self):
+        """The mean rating across every review, or None if there are no reviews."""
+        if not self.count:
+            return None
+        return self.rating_sum / self.count
+
+    @property
+    def histogram(self):
+        """How many reviews gave each rating, keyed by rating."""
+        return {
+            rating: getattr(self, "rating_%d" % rating) for rating in REVIEW_RATINGS
+        }
+
+    def __repr__(self):
+        return "<ReviewStats %r: %r>" % (self.isbn, self.count)
+
+
+class Books(db.Model):
+    """Defines a "Books" table in the database that mirrors title records from the Penguin API, with flapcopy and author bio already stripped of HTML."""
+
+    isbn = db.Column(db.String(ISBN_LENGTH), primary_key=True)
+    title = db.Column(db.String(300), nullable=False)
+    cover = db.Column(db.String(300), nullable=False)
+    author = db.Column(db.String(200), nullable=False)
+    themes = db.Column(db.String(500), nullable=True)
+    pages = db.Column(db.Integer, nullable=True)
+    flapcopy = db.Column(db.Text, nullable=False, default="")
+    author_bio = db.Column(db.Text, nullable=False, default="")
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return "<Books %r>" % self.isbn
+
+
+class BookThemes(db.Model):
+    """Defines a "BookThemes" table in the database linking each mirrored book to every theme it falls under."""
+
+    isbn = db.Column(
+        db.String(ISBN_LENGTH), db.ForeignKey("books.isbn"), primary_key=True
+    )
+    theme = db.Column(db.String(100), primary_key=True)
+    position = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.Index("ix_book_themes_theme", "theme"),)
+
+    def __repr__(self):
+        return "<BookThemes %r: %r>" % (self.isbn, self.theme)
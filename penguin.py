@@ -1,10 +1,247 @@
+import asyncio
+import contextvars
+import os
 import random
+import threading
+import time
+import httpx
 import requests
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup  # Please run sudo pip3 install beautifulsoup4 to run this
+from flask import has_app_context
+from sqlalchemy import func, select, union_all
+from cache import TTLCache, SQLiteStore, SingleFlight, backend_from_url
+from models import db, Books, BookThemes, Favorites, Recommendations, Review
+from models import BOOK_THEMES, ISBN_LENGTH
+from search_index import TitleIndex
+from instrumentation import cache_collector, metrics, timed_upstream
+
+TITLES_URL = os.getenv(
+    "PENGUIN_BASE_URL", "https://reststop.randomhouse.com/resources/titles"
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Penguin while the circuit breaker considers it unhealthy."""
+
+
+class TitleNotFoundError(LookupError):
+    """Raised when Penguin answers that it has no title at a path (a 404)."""
+
+
+class CircuitBreaker:
+    """Stops calls to an upstream service after repeated failures, then lets a single trial call through once reset_timeout seconds have passed."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self):
+        """Returns "closed", "open", or "half-open"."""
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """Checks if a call may be made right now."""
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        """Closes the circuit after a successful call."""
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        """Counts a failed call, opening (or re-opening) the circuit once the threshold is reached."""
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+
+class PenguinClient:
+    """Makes requests to the Penguin titles API over a pooled keep-alive session, with timeouts, bounded retries, and a circuit breaker."""
+
+    def __init__(
+        self,
+        base_url=TITLES_URL,
+        connect_timeout=3.05,
+        read_timeout=10,
+        retries=2,
+        backoff=0.3,
+        pool_size=16,
+        breaker=None,
+    ):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+
+        # Only idempotent GETs are made, so failed connections and 5xx responses are safe to retry.
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=["GET"],
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept"] = "application/json"
+
+        # Async views each run on a short-lived event loop of their own, so async lookups are handed to one
+        # long-lived loop thread, where a single AsyncClient keeps its connections open between requests.
+        self.loop = None
+        self.loop_lock = threading.Lock()
+        self.async_http = None
+
+    def get_json(self, path="", params=None):
+        """Returns the decoded JSON response for a path under the titles endpoint. Raises CircuitOpenError while Penguin is unhealthy."""
+        if not self.breaker.allow():
+            raise CircuitOpenError("Penguin API is temporarily unavailable")
+        try:
+            response = self.session.get(
+                self.base_url + path, params=params, timeout=self.timeout
+            )
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        return self.read_json(response)
+
+    def read_json(self, response):
+        """Returns a response's decoded JSON, telling the circuit breaker how the call went. Only 5xx responses count as failures; a 404 raises TitleNotFoundError."""
+        try:
+            response.raise_for_status()
+        except (requests.HTTPError, httpx.HTTPStatusError) as error:
+            # Any other status means Penguin is up and answering, so it mustn't open (or re-open) the circuit.
+            if error.response.status_code >= 500:
+                self.breaker.record_failure()
+                raise
+            self.breaker.record_success()
+            if error.response.status_code == 404:
+                raise TitleNotFoundError(str(error.response.url)) from error
+            raise
+        self.breaker.record_success()
+        return response.json()
+
+    def async_session(self):
+        """Opens an httpx.AsyncClient configured like the blocking session, for async views to fan lookups out over. Use it as an async context manager."""
+        # httpx only retries failed connections; 5xx responses are left to the circuit breaker.
+        transport = httpx.AsyncHTTPTransport(
+            retries=self.retries,
+            limits=httpx.Limits(
+                max_connections=self.pool_size, max_keepalive_connections=self.pool_size
+            ),
+        )
+        return httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+            headers={"Accept": "application/json"},
+        )
+
+    def run_async(self, coroutine):
+        """Runs a coroutine on the client's own event loop thread (starting it on first use) and returns a future the calling event loop can await. The coroutine sees the caller's context variables."""
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        return asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        )
+
+    def shared_async_session(self):
+        """Returns the AsyncClient every async lookup shares, opening it with async_session() on first use. Only call it from a coroutine passed to run_async()."""
+        if self.async_http is None:
+            self.async_http = self.async_session()
+        return self.async_http
+
+    async def get_json_async(self, http, path="", params=None):
+        """Awaits the decoded JSON response for a path under the titles endpoint using an open async session. Raises CircuitOpenError while Penguin is unhealthy."""
+        if not self.breaker.allow():
+            raise CircuitOpenError("Penguin API is temporarily unavailable")
+        try:
+            response = await http.get(self.base_url + path, params=params)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        return self.read_json(response)
+
+
+client = PenguinClient(
+    connect_timeout=float(os.getenv("PENGUIN_CONNECT_TIMEOUT", 3.05)),
+    read_timeout=float(os.getenv("PENGUIN_READ_TIMEOUT", 10)),
+    retries=int(os.getenv("PENGUIN_RETRIES", 2)),
+    pool_size=int(os.getenv("PENGUIN_POOL_CONNECTIONS", 16)),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv("PENGUIN_FAILURE_THRESHOLD", 5)),
+        reset_timeout=int(os.getenv("PENGUIN_RESET_TIMEOUT", 30)),
+    ),
+)
+
+
+class TagStripper(HTMLParser):
+    """Collects the text of an HTML fragment as it is parsed, skipping tags, comments, and the contents of script and style elements."""
+
+    SKIPPED_TAGS = {"script", "style"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+    def unknown_decl(self, data):
+        # CDATA sections are kept as text, matching BeautifulSoup.
+        if data.startswith("CDATA["):
+            self.parts.append(data[len("CDATA[") :])
 
 
 def tag_remove(text):
-    """Uses BeautifulSoup to remove all HTML tags."""
+    """Removes all HTML tags in a single streaming pass, without building a document tree."""
+    stripper = TagStripper()
+    stripper.feed(text)
+    stripper.close()
+    return "".join(stripper.parts)
+
+
+def tag_remove_soup(text):
+    """Uses BeautifulSoup to remove all HTML tags. Kept as a reference for tag_remove()."""
     soup = BeautifulSoup(text, "html.parser")
     result = soup.get_text()
     return result
@@ -20,164 +257,742 @@ def get_themes(themes):
     return "None"
 
 
-def book_suggestions(theme, display_number):
-    """Finds and returns the titles and cover image URLs of randomly selected books falling under a certain theme."""
+def theme_list(themes):
+    """Returns the themes in a title record's "themes" attribute as a list, whether it holds several themes, one, or none."""
+    if themes is None:
+        return []
+    if isinstance(themes["theme"], str):
+        return [themes["theme"]]
+    return list(themes["theme"])
+
+
+def catalog_row(record):
+    """Converts a Penguin title record into the columns stored in the local Books catalog. Raises ValueError for an ISBN too long to store."""
+    isbn = str(record["isbn"])
+    if len(isbn) > ISBN_LENGTH:
+        raise ValueError("ISBN too long for the catalog: " + isbn)
+    return {
+        "isbn": isbn,
+        "title": record["titleweb"],
+        "cover": record["@uri"],
+        "author": record.get("author") or "",
+        "themes": ", ".join(theme_list(record.get("themes"))),
+        "pages": int(record["pages"]) if record.get("pages") else None,
+        "flapcopy": tag_remove(record.get("flapcopy") or ""),
+        "author_bio": tag_remove(record.get("authorbio") or ""),
+    }
+
+
+class BookRecord:
+    """The parts of a Penguin title record that the app displays. Derived fields are computed on first use, and __slots__ keeps each cached record small."""
+
+    __slots__ = (
+        "isbn",
+        "title",
+        "cover",
+        "author_name",
+        "flapcopy",
+        "author_bio",
+        "pages",
+        "themes",
+        "_author",
+        "_theme_text",
+    )
+
+    # False only for the placeholder of a book that couldn't be found (see missing()).
+    found = True
+
+    # Shown in place of anything a title record is missing.
+    MISSING_TITLE = "Book Missing Information"
+    MISSING_COVER = "../static/sample_book_cover.jpg"
+    MISSING_AUTHOR = "Anonymous"
+    MISSING_FLAPCOPY = (
+        "This is what an example of a newly-discovered but broken book looks like."
+    )
+    MISSING_AUTHOR_BIO = "This is an author who, for many years, has eluded the public eye. His origins are currently unknown."
+
+    def __init__(
+        self,
+        isbn,
+        title=MISSING_TITLE,
+        cover=MISSING_COVER,
+        author_name=MISSING_AUTHOR,
+        flapcopy=MISSING_FLAPCOPY,
+        author_bio=MISSING_AUTHOR_BIO,
+        pages=None,
+        themes=(),
+    ):
+        self.isbn = str(isbn)
+        self.title = title
+        self.cover = cover
+        self.author_name = author_name
+        self.flapcopy = flapcopy
+        self.author_bio = author_bio
+        self.pages = pages
+        self.themes = tuple(themes)
+        self._author = None
+        self._theme_text = None
+
+    def __eq__(self, other):
+        return isinstance(other, BookRecord) and self.to_json() == other.to_json()
+
+    def __hash__(self):
+        # Equal records always share an ISBN.
+        return hash(self.isbn)
+
+    def __repr__(self):
+        return "<BookRecord %r>" % self.isbn
+
+    @classmethod
+    def from_penguin(cls, record, isbn=None):
+        """Builds a book from a Penguin title record, stripping the HTML from its flapcopy and author bio."""
+        return cls(
+            record.get("isbn") or isbn,
+            title=record.get("titleweb") or cls.MISSING_TITLE,
+            cover=record.get("@uri") or cls.MISSING_COVER,
+            author_name=record.get("author") or cls.MISSING_AUTHOR,
+            flapcopy=(
+                tag_remove(record["flapcopy"])
+                if record.get("flapcopy") is not None
+                else cls.MISSING_FLAPCOPY
+            ),
+            author_bio=(
+                tag_remove(record["authorbio"])
+                if record.get("authorbio") is not None
+                else cls.MISSING_AUTHOR_BIO
+            ),
+            pages=int(record["pages"]) if record.get("pages") else None,
+            themes=theme_list(record.get("themes")),
+        )
+
+    @classmethod
+    def from_catalog(cls, book):
+        """Builds a book from a row of the local Books catalog, whose text was already cleaned when it was ingested."""
+        return cls(
+            book.isbn,
+            title=book.title,
+            cover=book.cover,
+            author_name=book.author or cls.MISSING_AUTHOR,
+            flapcopy=book.flapcopy,
+            author_bio=book.author_bio,
+            pages=book.pages,
+            themes=book.themes.split(", ") if book.themes else (),
+        )
+
+    @classmethod
+    def missing(cls, isbn):
+        """Returns the placeholder shown for a book that couldn't be found."""
+        return MissingBookRecord(isbn)
+
+    @property
+    def author(self):
+        """The author's name in reading order ("First Last" rather than Penguin's "Last, First")."""
+        if self._author is None:
+            self._author = " ".join(reversed(self.author_name.split(",")))
+        return self._author
+
+    @property
+    def theme_text(self):
+        """The book's themes as shown on its book page (see get_themes())."""
+        if self._theme_text is None:
+            self._theme_text = get_themes(
+                {"theme": self.themes} if self.themes else None
+            )
+        return self._theme_text
+
+    @property
+    def primary_theme(self):
+        """The book's first theme, or "None" if it has none."""
+        return self.themes[0] if self.themes else "None"
+
+    def to_json(self):
+        """Returns the book as a compact JSON-serializable list."""
+        return [
+            self.isbn,
+            self.title,
+            self.cover,
+            self.author_name,
+            self.flapcopy,
+            self.author_bio,
+            self.pages,
+            list(self.themes),
+        ]
+
+    @classmethod
+    def from_json(cls, data):
+        """Rebuilds a book from the list returned by to_json()."""
+        return cls(*data)
+
+
+class MissingBookRecord(BookRecord):
+    """The placeholder shown for a book that couldn't be found. Its primary theme is None rather than "None", since it isn't known whether the book has one."""
+
+    __slots__ = ()
+
+    found = False
+
+    @property
+    def primary_theme(self):
+        """Always None: the book's themes are unknown."""
+        return None
+
+
+# Cached records and suggestion pools can be shared between worker processes through a second-tier store.
+# PENGUIN_CACHE_URL selects it (memory://, sqlite:///path, or redis://host:port/db); PENGUIN_CACHE_PATH is
+# shorthand for a SQLite file. Without either, each worker keeps its own cache.
+if os.getenv("PENGUIN_CACHE_URL"):
+    shared_store = backend_from_url(os.getenv("PENGUIN_CACHE_URL"))
+elif os.getenv("PENGUIN_CACHE_PATH"):
+    shared_store = SQLiteStore(os.getenv("PENGUIN_CACHE_PATH"))
+else:
+    shared_store = None
+
+# Every single-book lookup reads through this cache, so one ISBN is fetched at most once per TTL window.
+# For PENGUIN_CACHE_STALE_TTL seconds after that, an expired record is still served while it's refreshed.
+title_cache = TTLCache(
+    maxsize=int(os.getenv("PENGUIN_CACHE_SIZE", 2048)),
+    ttl=int(os.getenv("PENGUIN_CACHE_TTL", 3600)),
+    store=shared_store,
+    encode=BookRecord.to_json,
+    decode=BookRecord.from_json,
+    stale_ttl=int(os.getenv("PENGUIN_CACHE_STALE_TTL", 3600)),
+)
+
+# ISBNs Penguin has answered 404 for are remembered for PENGUIN_NOT_FOUND_TTL seconds, so repeated views of an
+# unknown book don't refetch it.
+not_found_cache = TTLCache(
+    maxsize=int(os.getenv("PENGUIN_NOT_FOUND_CACHE_SIZE", 4096)),
+    ttl=int(os.getenv("PENGUIN_NOT_FOUND_TTL", 300)),
+    store=shared_store,
+)
+
+
+def not_found_key(isbn):
+    """Returns an ISBN's key in not_found_cache, kept apart from title_cache's keys in a shared store."""
+    return "not_found:" + isbn
+
+
+def known_missing(isbns):
+    """Returns the set of the given ISBNs that Penguin recently answered it has no title for."""
+    return {isbn for isbn in isbns if not_found_cache.get(not_found_key(isbn))}
+
+
+def remember_missing(isbn):
+    """Records that Penguin has no title for an ISBN."""
+    not_found_cache.set(not_found_key(isbn), True)
+
+
+def get_catalog_records(isbns):
+    """Returns a BookRecord for each of the given ISBNs found in the local catalog, keyed by ISBN."""
+    # The catalog can only be queried from inside the app (never from the lookup pool's threads).
+    if not isbns or not has_app_context():
+        return {}
+    books = Books.query.filter(Books.isbn.in_(isbns)).all()
+    return {book.isbn: BookRecord.from_catalog(book) for book in books}
+
+
+# Concurrent lookups of the same ISBN, suggestion pool, or titles page within this worker share one in-flight fetch.
+lookup_flights = SingleFlight()
+
+
+@timed_upstream
+def fetch_title_page(start, max_results, theme=None, search=None):
+    """Returns one page of title records from Penguin's titles endpoint, optionally filtered by theme or search terms."""
+    # "start", "max", and "expandlevel" are required parameters.
+    query_params = {"start": start, "max": max_results, "expandlevel": 1}
+    if theme is not None:
+        query_params["theme"] = str(theme)
+    if search is not None:
+        query_params["search"] = str(search)
+
+    # Concurrent requests for the same page share one call.
+    key = ("titles", start, max_results, theme, search)
+    response_json = lookup_flights.do(key, lambda: client.get_json(params=query_params))
+    titles = response_json["title"]
+
+    # A page holding a single title comes back as an object rather than a list.
+    if isinstance(titles, dict):
+        return [titles]
+    return titles
+
+
+# Shared, bounded pool used to fan out independent ISBN lookups (see basic_book_info_many).
+lookup_pool = ThreadPoolExecutor(max_workers=int(os.getenv("PENGUIN_MAX_WORKERS", 8)))
+
+
+def submit_lookup(fn, *args):
+    """Submits fn(*args) to the lookup pool. It runs in a copy of the caller's context, so its Penguin calls are timed as part of the caller's request."""
+    # Each task gets its own copy, since one context can't be entered by two threads at once.
+    return lookup_pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+# Stale records are refetched on this small pool, so a request never waits on the refresh of a record it was already served.
+refresh_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("PENGUIN_REFRESH_WORKERS", 2))
+)
+refreshing = set()
+refreshing_lock = threading.Lock()
+
+
+@timed_upstream
+def fetch_title_record(isbn):
+    """Fetches an ISBN's BookRecord from Penguin and caches it. With a shared store, only one worker fetches a missing record while the rest wait for its result."""
+
+    def fetch():
+        try:
+            return BookRecord.from_penguin(client.get_json("/" + isbn), isbn)
+        except TitleNotFoundError:
+            remember_missing(isbn)
+            raise
+
+    return lookup_flights.do(isbn, lambda: title_cache.fill(isbn, fetch))
+
+
+def refresh_title_record(isbn):
+    """Refetches a stale record in the background. If Penguin fails, the stale copy is simply served until it runs out."""
     try:
-        # "start", "max", and "expandlevel" are required parameters.
-        BASE_URL = "https://reststop.randomhouse.com/resources/titles"
-        query_params = {"start": 0, "max": 40, "expandlevel": 1, "theme": str(theme)}
+        fetch_title_record(isbn)
+    except Exception:
+        pass
+    finally:
+        with refreshing_lock:
+            refreshing.discard(isbn)
+
+
+def schedule_refresh(isbn):
+    """Queues a stale ISBN to be refetched, unless it's already queued or being refetched."""
+    with refreshing_lock:
+        if isbn in refreshing:
+            return
+        refreshing.add(isbn)
+    refresh_pool.submit(refresh_title_record, isbn)
+
+
+def lookup_title_records(isbns):
+    """Returns a BookRecord for each of the given ISBNs held in the cache or the local catalog, keyed by ISBN, without going upstream."""
+    records = {}
+    for isbn in isbns:
+        record, fresh = title_cache.lookup(isbn)
+        if record is not None:
+            records[isbn] = record
+            if not fresh:
+                schedule_refresh(isbn)
+    # Everything that wasn't cached is loaded from the catalog with a single query.
+    missing = [isbn for isbn in isbns if isbn not in records]
+    for isbn, record in get_catalog_records(missing).items():
+        title_cache.set(isbn, record)
+        records[isbn] = record
+    return records
+
+
+def get_title_record(isbn):
+    """Returns the BookRecord for an ISBN, reading the cache and then the local catalog before going upstream."""
+    isbn = str(isbn)
+    record = lookup_title_records([isbn]).get(isbn)
+    if record is None:
+        if known_missing([isbn]):
+            raise TitleNotFoundError(isbn)
+        try:
+            # Concurrent lookups in this worker share one fetch.
+            record = fetch_title_record(isbn)
+        except TitleNotFoundError:
+            raise
+        except Exception:
+            # While Penguin is failing, a copy that expired within PENGUIN_CACHE_STALE_TTL is better than nothing.
+            record = title_cache.get_stale(isbn)
+            if record is None:
+                raise
+    return record
 
-        response = requests.get(
-            BASE_URL, params=query_params, headers={"Accept": "application/json"}
+
+@timed_upstream
+async def fetch_title_record_async(http, isbn):
+    """Awaits a single ISBN's BookRecord from Penguin over an open async session, falling back to a cached copy still within its stale window if the call fails."""
+
+    async def fetch():
+        try:
+            return BookRecord.from_penguin(
+                await client.get_json_async(http, "/" + isbn), isbn
+            )
+        except TitleNotFoundError:
+            remember_missing(isbn)
+            raise
+
+    try:
+        record = await lookup_flights.do_async(
+            isbn, lambda: title_cache.fill_async(isbn, fetch)
         )
+    except TitleNotFoundError:
+        raise
+    except Exception:
+        record = title_cache.get_stale(isbn)
+        if record is None:
+            raise
+    return record
+
+
+async def fetch_title_records_async(isbns):
+    """Awaits several ISBNs' BookRecords from Penguin concurrently over the client's shared async session, returning each record or the exception that stopped it. Runs on the client's loop thread (see PenguinClient.run_async)."""
+    http = client.shared_async_session()
+    return await asyncio.gather(
+        *(fetch_title_record_async(http, isbn) for isbn in isbns),
+        return_exceptions=True,
+    )
+
+
+async def get_title_records_async(isbns):
+    """Returns the BookRecords for several ISBNs keyed by ISBN, fetching every one that isn't cached or in the local catalog concurrently. ISBNs that can't be fetched, or that Penguin recently answered it has no title for, are left out."""
+    isbns = list(dict.fromkeys(str(isbn) for isbn in isbns))
+
+    def lookup():
+        records = lookup_title_records(isbns)
+        unknown = known_missing(isbn for isbn in isbns if isbn not in records)
+        return records, unknown
+
+    # The catalog query runs back on the request's own thread, where its database session lives.
+    records, unknown = await sync_to_async(lookup, thread_sensitive=True)()
+    missing = [isbn for isbn in isbns if isbn not in records and isbn not in unknown]
+    if missing:
+        fetched = await client.run_async(fetch_title_records_async(missing))
+        for isbn, record in zip(missing, fetched):
+            if not isinstance(record, Exception):
+                records[isbn] = record
+    return records
+
+
+def popular_isbns(limit):
+    """Returns up to limit ISBNs, ordered by how often they appear across favorites, recommendations, and reviews."""
+    references = union_all(
+        select(Favorites.bookISBN.label("isbn")),
+        select(Recommendations.bookISBN),
+        select(Review.isbn),
+    ).subquery()
+    rows = (
+        db.session.query(references.c.isbn)
+        .group_by(references.c.isbn)
+        .order_by(func.count().desc(), references.c.isbn)
+        .limit(limit)
+    )
+    return [isbn for (isbn,) in rows]
+
+
+def warm_title_cache(isbns, rate=10):
+    """Loads the given ISBNs into the title cache, fetching the ones that aren't in the local catalog from Penguin at no more than rate per second. Returns how many are now cached."""
+    if rate <= 0:
+        raise ValueError("rate must be a positive number of requests per second")
+    isbns = list(dict.fromkeys(str(isbn) for isbn in isbns))
+    records = lookup_title_records(isbns)
+    missing = [isbn for isbn in isbns if isbn not in records]
+    # Fetches run concurrently on the lookup pool, but are started no faster than the rate limit.
+    fetches = []
+    for index, isbn in enumerate(missing):
+        if index:
+            time.sleep(1 / rate)
+        fetches.append(submit_lookup(fetch_title_record, isbn))
+    fetched = sum(1 for fetch in fetches if fetch.exception() is None)
+    return len(records) + fetched
+
+
+# With PENGUIN_WARM_COUNT set, each worker warms its cache with that many of the most referenced books on startup.
+CACHE_WARM_COUNT = int(os.getenv("PENGUIN_WARM_COUNT", 0))
+CACHE_WARM_RATE = float(os.getenv("PENGUIN_WARM_RATE", 10))
+
+
+def start_cache_warmup(app, count, rate):
+    """Warms the title cache with the count most referenced books on a daemon thread, so startup isn't held up."""
+
+    def warm():
+        with app.app_context():
+            try:
+                warm_title_cache(popular_isbns(count), rate)
+            except Exception:
+                pass
+
+    thread = threading.Thread(target=warm, daemon=True)
+    thread.start()
+    return thread
+
+
+def cache_stats():
+    """Returns the title-record cache's hit/miss/eviction counters."""
+    return title_cache.stats()
+
+
+# The title cache's counters are served at /metrics, to size the cache against real traffic.
+metrics.add_collector(cache_collector("titles", cache_stats))
+
+
+def flight_stats():
+    """Returns how many lookups were made and how many were coalesced into another caller's in-flight fetch."""
+    return lookup_flights.stats()
+
+
+def flight_samples():
+    """Returns the lookup flights' counters as metric samples for /metrics."""
+    stats = flight_stats()
+    return [
+        ("bookbite_lookup_calls_total", {}, stats["calls"]),
+        ("bookbite_lookup_coalesced_total", {}, stats["coalesced"]),
+        ("bookbite_lookups_in_flight", {}, stats["in_flight"]),
+    ]
+
+
+metrics.add_collector(flight_samples)
+
+
+def start_background_refresh(app, interval, refresh):
+    """Runs a refresh function inside the app context on a daemon thread, immediately and then once per interval."""
+
+    def refresh_forever():
+        while True:
+            with app.app_context():
+                try:
+                    refresh()
+                except Exception:
+                    pass
+            time.sleep(interval)
 
-        # Whatever information you'd like to pull out goes down below.
-        book_titles = []
-        book_urls = []
-        book_ISBNs = []
-        already_selected_books = []
+    thread = threading.Thread(target=refresh_forever, daemon=True)
+    thread.start()
+    return thread
 
-        # Chooses a random set of 6 books under a chosen theme. Already selected books are not chosen twice.
-        for index in range(display_number):
-            response_json = response.json()
-            book_selection = int(random.randint(0, 39))
-            while book_selection in already_selected_books:
-                book_selection = int(random.randint(0, 39))
 
-            book_title = response_json["title"][book_selection]["titleweb"]
-            book_url = BASE_URL + "/" + response_json["title"][book_selection]["isbn"]
-            bookISBN = response_json["title"][book_selection]["isbn"]
+class ThemePools:
+    """Holds an in-memory pool of candidate books for each theme, rebuilt on a schedule by a background thread. Pools can be shared between workers through a cache store."""
 
-            book_titles.append(book_title)
-            book_urls.append(book_url)
-            book_ISBNs.append(bookISBN)
-            already_selected_books.append(book_selection)
+    def __init__(self, themes, pool_size=120, refresh_interval=3600, store=None):
+        self.themes = themes
+        self.pool_size = pool_size
+        self.refresh_interval = refresh_interval
+        self.store = store
+        self.pools = {}
+        self.thread = None
 
+    def build(self, theme):
+        """Collects up to pool_size (title, URL, ISBN) candidates for a theme, from the local catalog if it has any, otherwise from Penguin."""
+        if has_app_context():
+            books = (
+                Books.query.join(BookThemes)
+                .filter(BookThemes.theme == str(theme))
+                .order_by(func.random())
+                .limit(self.pool_size)
+                .all()
+            )
+            if books:
+                return [
+                    (book.title, TITLES_URL + "/" + book.isbn, book.isbn)
+                    for book in books
+                ]
+
+        candidates = {}
+        page_size = 40
+        start = 0
+        while len(candidates) < self.pool_size:
+            titles = fetch_title_page(start, page_size, theme=theme)
+            for title in titles:
+                isbn = str(title["isbn"])
+                candidates.setdefault(
+                    isbn, (title["titleweb"], TITLES_URL + "/" + isbn, isbn)
+                )
+            if len(titles) < page_size:
+                break
+            start += page_size
+        return list(candidates.values())[: self.pool_size]
+
+    def load(self, theme):
+        """Returns the pool another worker shared for a theme, or None if there isn't one."""
+        if self.store is None:
+            return None
+        try:
+            stored = self.store.get("pool:" + theme)
+        except Exception:
+            return None
+        if stored is None:
+            return None
+        return [tuple(candidate) for candidate in stored[0]]
+
+    def publish(self, theme, pool):
+        """Shares a theme's pool with the other workers."""
+        if self.store is not None:
+            try:
+                self.store.set("pool:" + theme, pool, self.refresh_interval * 2)
+            except Exception:
+                pass
+
+    def claim(self, theme):
+        """Checks if this worker should rebuild a theme's pool in the current refresh interval. Only one worker sharing a store gets each theme's claim."""
+        if self.store is None:
+            return True
+        try:
+            # The lock is left to expire on its own, so no other worker claims the theme until the next interval.
+            return (
+                self.store.acquire_lock(
+                    "pool-refresh:" + theme, self.refresh_interval * 0.9
+                )
+                is not None
+            )
+        except Exception:
+            return True
+
+    def get(self, theme):
+        """Returns the candidate pool for a theme, loading or building it first if this worker doesn't have it yet."""
+        theme = str(theme)
+        pool = self.pools.get(theme)
+        if pool is None:
+            # Concurrent requests for a theme without a pool share one load or build.
+            pool = lookup_flights.do("pool:" + theme, lambda: self.load_or_build(theme))
+            # An empty pool isn't kept, so the next request tries again rather than waiting for the next refresh.
+            if pool:
+                self.pools[theme] = pool
+        return pool
+
+    def load_or_build(self, theme):
+        """Returns the pool another worker shared for a theme, or builds and shares one if there isn't one."""
+        pool = self.load(theme)
+        if not pool:
+            pool = self.build(theme)
+            if pool:
+                self.publish(theme, pool)
+        return pool
+
+    def refresh(self):
+        """Rebuilds the pool of every theme, or copies the pools another worker rebuilt. A theme that fails to rebuild keeps its previous pool."""
+        extra_themes = [theme for theme in self.pools if theme not in self.themes]
+        for theme in list(self.themes) + extra_themes:
+            try:
+                if self.claim(theme):
+                    pool = self.build(theme)
+                    if pool:
+                        self.publish(theme, pool)
+                else:
+                    pool = self.load(theme)
+                if pool:
+                    self.pools[theme] = pool
+            except Exception:
+                continue
+
+    def start(self, app):
+        """Starts a daemon thread that refreshes every pool immediately and then once per refresh interval."""
+        if self.thread is None:
+            self.thread = start_background_refresh(
+                app, self.refresh_interval, self.refresh
+            )
+
+    def clear(self):
+        """Discards every pool."""
+        self.pools = {}
+
+
+theme_pools = ThemePools(
+    BOOK_THEMES,
+    pool_size=int(os.getenv("PENGUIN_POOL_SIZE", 120)),
+    refresh_interval=int(os.getenv("PENGUIN_POOL_REFRESH", 3600)),
+    store=shared_store,
+)
+
+
+def book_suggestions(theme, display_number, placeholder=True):
+    """Finds and returns the titles and cover image URLs of randomly selected books falling under a certain theme. If none can be found, a sample book is returned instead, or with placeholder False, LookupError is raised."""
+    try:
+        # Books are sampled without replacement from the theme's in-memory candidate pool.
+        pool = theme_pools.get(theme)
+        if not pool:
+            raise LookupError("No books found under theme " + str(theme))
+        selected_books = random.sample(pool, min(display_number, len(pool)))
+        book_titles = [book_title for book_title, book_url, bookISBN in selected_books]
+        book_urls = [book_url for book_title, book_url, bookISBN in selected_books]
+        book_ISBNs = [bookISBN for book_title, book_url, bookISBN in selected_books]
         return book_titles, book_urls, book_ISBNs
 
-    except:
+    except Exception as error:
+        if not placeholder:
+            raise LookupError("No books found under theme " + str(theme)) from error
         sample_title = ["Sample Title"]
         sample_book_url = ["../static/sample_book_cover.jpg"]
         sample_book_ISBN = [9781400079148]
         return (sample_title, sample_book_url, sample_book_ISBN)
 
 
-def title_search(title):
-    """Finds and returns the ISBN of the top search result given a book title."""
+async def book_suggestions_async(theme, display_number, placeholder=True):
+    """Awaits book_suggestions, building a missing theme pool on the request's own thread so the event loop isn't blocked."""
+    if str(theme) in theme_pools.pools:
+        return book_suggestions(theme, display_number, placeholder)
+    return await sync_to_async(book_suggestions, thread_sensitive=True)(
+        theme, display_number, placeholder
+    )
 
-    # "start", "max", and "expandlevel" are required parameters.
-    BASE_URL = "https://reststop.randomhouse.com/resources/titles"
-    query_params = {"start": 0, "max": 25, "expandlevel": 1, "search": str(title)}
 
-    response = requests.get(
-        BASE_URL, params=query_params, headers={"Accept": "application/json"}
-    )
-    response_json = response.json()
-    book_index = int(random.randint(0, len(response_json["title"]) - 1))
+# Title searches are answered from this index of the local catalog, which is rebuilt periodically.
+title_index = TitleIndex()
+TITLE_INDEX_REFRESH = int(os.getenv("PENGUIN_INDEX_REFRESH", 600))
+
+
+def rebuild_title_index():
+    """Rebuilds the title search index from every book in the local catalog."""
+    books = db.session.query(Books.isbn, Books.title, Books.author, Books.cover).all()
+    title_index.build(books)
+
 
-    book_ISBN = response_json["title"][book_index]["isbn"]
+def search_titles(query, limit=10):
+    """Finds and returns up to limit (title, cover URL, ISBN) results for a title or author query, ranked by relevance."""
+    if title_index.built_at is None and has_app_context():
+        rebuild_title_index()
+    if len(title_index) > 0:
+        return title_index.search(query, limit)
+
+    # Without a local catalog, Penguin's own search results are used in the order they are returned.
+    titles = fetch_title_page(0, limit, search=query)
+    return [
+        (title.get("titleweb", ""), TITLES_URL + "/" + str(title["isbn"]), title["isbn"])
+        for title in titles
+    ]
+
+
+def title_search(title):
+    """Finds and returns the ISBN of the top search result given a book title."""
+    book_title, book_url, book_ISBN = search_titles(title, 1)[0]
     return book_ISBN
 
 
 def basic_book_info(isbn):
-    """Grabs the title and book cover URL of a single book using the provided ISBN number."""
-    isbn = str(isbn)
+    """Grabs the BookRecord (used for its title and book cover URL) of a single book using the provided ISBN number."""
     try:
-        BASE_URL = "https://reststop.randomhouse.com/resources/titles/"
-        book_titles = []
-        book_urls = []
-        url = BASE_URL + isbn
-        response = requests.get(url, headers={"Accept": "application/json"})
-        response_json = response.json()
-
-        book_title = response_json["titleweb"]
-        book_cover = response_json["@uri"]
-
-        book_titles.append(book_title)
-        book_urls.append(book_cover)
-        return (book_title, book_cover)
+        return get_title_record(isbn)
     except:
-        sample_title = ["Book Missing Information"]
-        sample_book_url = ["../static/sample_book_cover.jpg"]
-        return sample_title, sample_book_url
+        return BookRecord.missing(isbn)
+
+
+def basic_book_info_many(isbns):
+    """Grabs the BookRecords of several books in parallel. Results are returned in the same order as the ISBNs provided."""
+    isbns = [str(isbn) for isbn in isbns]
+    # Each distinct ISBN is only looked up once, even if it appears several times in the list.
+    unique_isbns = list(dict.fromkeys(isbns))
+    # Uncached books found in the local catalog are loaded with a single query before anything goes upstream.
+    uncached_isbns = [isbn for isbn in unique_isbns if isbn not in title_cache]
+    for isbn, record in get_catalog_records(uncached_isbns).items():
+        title_cache.set(isbn, record)
+    lookups = {isbn: submit_lookup(basic_book_info, isbn) for isbn in unique_isbns}
+    return [lookups[isbn].result() for isbn in isbns]
+
+
+async def basic_book_info_many_async(isbns):
+    """Awaits the BookRecords of several books, fetched concurrently. Results are returned in the same order as the ISBNs provided."""
+    isbns = [str(isbn) for isbn in isbns]
+    records = await get_title_records_async(isbns)
+    return [records.get(isbn) or BookRecord.missing(isbn) for isbn in isbns]
 
 
 def all_book_info(isbn):
-    """Grabs all relevant information about a single book using the provided ISBN number."""
-    isbn = str(isbn)
-    try:
-        BASE_URL = "https://reststop.randomhouse.com/resources/titles/"
-        url = BASE_URL + isbn
-        response = requests.get(url, headers={"Accept": "application/json"})
-        response_json = response.json()
-
-        # The name of the author is found below.
-        name = response_json["author"]
-        author = " ".join(reversed(name.split(",")))
-
-        # flapcopy is the summary for the book. HTML tags are removed from this attribute.
-        flapcopy_html = response_json["flapcopy"]
-        flapcopy = tag_remove(flapcopy_html)
-
-        # Provides brief info about the author. HTML tags are removed from this attribute.
-        author_bio_html = response_json["authorbio"]
-        author_bio = tag_remove(author_bio_html)
-
-        # Grabs various other useful pieces of information about the book.
-        book_isbn = response_json["isbn"]
-        page_num = response_json["pages"]
-        book_theme = get_themes(response_json["themes"])
-        book_cover = response_json["@uri"]
-        book_title = response_json["titleweb"]
-        return (
-            author,
-            flapcopy,
-            author_bio,
-            book_isbn,
-            page_num,
-            book_theme,
-            book_cover,
-            book_title,
-        )
-    except:
-        author = "Anonymous"
-        flapcopy = (
-            "This is what an example of a newly-discovered but broken book looks like."
-        )
-        author_bio = "This is an author who, for many years, has eluded the public eye. His origins are currently unknown."
-        book_isbn = 123456789123
-        page_num = 35
-        book_theme = "None"
-        book_cover = "../static/sample_book_cover.jpg"
-        book_title = "Book Missing Information"
-        return (
-            author,
-            flapcopy,
-            author_bio,
-            book_isbn,
-            page_num,
-            book_theme,
-            book_cover,
-            book_title,
-        )
+    """Grabs the BookRecord holding all relevant information about a single book using the provided ISBN number."""
+    return basic_book_info(isbn)
 
 
-def get_single_book_theme(isbn):
-    """Grabs the primary theme of a single book using the provided ISBN number."""
-    isbn = str(isbn)
-    try:
-        BASE_URL = "https://reststop.randomhouse.com/resources/titles/"
-        url = BASE_URL + isbn
-        response = requests.get(url, headers={"Accept": "application/json"})
-        response_json = response.json()
+async def all_book_info_async(isbn):
+    """Awaits the BookRecord holding all relevant information about a single book using the provided ISBN number."""
+    records = await get_title_records_async([isbn])
+    return records.get(str(isbn)) or BookRecord.missing(isbn)
 
-        try:
-            book_theme = response_json["themes"]["theme"]
-            single_theme = book_theme[0]
-            return single_theme
-        except:
-            book_theme = response_json["themes"]["theme"]
-            return book_theme
-    except:
-        book_theme = "None"
-        return book_theme
+
+def get_single_book_theme(isbn):
+    """Grabs the primary theme of a single book using the provided ISBN number. Returns None if the book couldn't be found, and "None" if it has no theme."""
+    return basic_book_info(isbn).primary_theme
@@ -0,0 +1,119 @@
+import math
+import re
+import time
+import unicodedata
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+# Title matches count for more than author matches when ranking.
+TITLE_WEIGHT = 2
+AUTHOR_WEIGHT = 1
+
+# A query term that only matches the start of a word scores less than an exact match.
+PREFIX_WEIGHT = 0.5
+MAX_PREFIX_EXPANSIONS = 50
+
+# Standard BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    """Splits text into lowercase words with accents removed."""
+    text = unicodedata.normalize("NFKD", str(text or ""))
+    text = "".join(
+        character for character in text if not unicodedata.combining(character)
+    )
+    return re.findall(r"\w+", text.lower())
+
+
+class IndexSnapshot:
+    """An immutable set of postings that a TitleIndex swaps in all at once when it is rebuilt."""
+
+    def __init__(self, documents):
+        self.documents = {}
+        self.lengths = {}
+        self.postings = defaultdict(dict)
+        for isbn, title, author, cover in documents:
+            self.documents[isbn] = (title, cover)
+            term_counts = Counter()
+            for token in tokenize(title):
+                term_counts[token] += TITLE_WEIGHT
+            for token in tokenize(author):
+                term_counts[token] += AUTHOR_WEIGHT
+            self.lengths[isbn] = sum(term_counts.values())
+            for token, count in term_counts.items():
+                self.postings[token][isbn] = count
+
+        self.vocabulary = sorted(self.postings)
+        self.average_length = (
+            sum(self.lengths.values()) / len(self.lengths) if self.lengths else 0
+        )
+
+    def expand(self, token):
+        """Returns every indexed term that starts with a query token, paired with how much a match on it is worth."""
+        terms = []
+        position = bisect_left(self.vocabulary, token)
+        while (
+            position < len(self.vocabulary)
+            and self.vocabulary[position].startswith(token)
+            and len(terms) < MAX_PREFIX_EXPANSIONS
+        ):
+            term = self.vocabulary[position]
+            terms.append((term, 1.0 if term == token else PREFIX_WEIGHT))
+            position += 1
+        return terms
+
+
+class TitleIndex:
+    """An in-process inverted index over book titles and authors with prefix matching and BM25 ranking."""
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self.snapshot.documents)
+
+    def build(self, documents):
+        """Replaces the index with the given (ISBN, title, author, cover URL) documents."""
+        self.snapshot = IndexSnapshot(documents)
+        self.built_at = time.time()
+
+    def clear(self):
+        """Empties the index and marks it as never having been built."""
+        self.snapshot = IndexSnapshot([])
+        self.built_at = None
+
+    def search(self, query, limit=10):
+        """Returns up to limit (title, cover URL, ISBN) results ranked by relevance to the query."""
+        snapshot = self.snapshot
+        document_count = len(snapshot.documents)
+        scores = defaultdict(float)
+
+        for token in set(tokenize(query)):
+            # A document is scored on its best-matching expansion of each query token.
+            token_scores = defaultdict(float)
+            for term, weight in snapshot.expand(token):
+                postings = snapshot.postings[term]
+                idf = math.log(
+                    1 + (document_count - len(postings) + 0.5) / (len(postings) + 0.5)
+                )
+                for isbn, frequency in postings.items():
+                    length_ratio = snapshot.lengths[isbn] / snapshot.average_length
+                    score = (
+                        weight
+                        * idf
+                        * frequency
+                        * (K1 + 1)
+                        / (frequency + K1 * (1 - B + B * length_ratio))
+                    )
+                    token_scores[isbn] = max(token_scores[isbn], score)
+            for isbn, score in token_scores.items():
+                scores[isbn] += score
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        results = []
+        for isbn, score in ranked[:limit]:
+            title, cover = snapshot.documents[isbn]
+            results.append((title, cover, isbn))
+        return results
@@ -0,0 +1,39 @@
+// Appends later pages of books to a list page without reloading it.
+// The "more" link points at the next server-rendered page, so it still works without JavaScript.
+// Each book is copied from the page's <template id="book-template">, filling in its [data-field]
+// elements, cover image, and hidden ISBN input from the JSON endpoint's results.
+document.addEventListener("DOMContentLoaded", function () {
+  var more = document.getElementById("more-books");
+  if (!more) {
+    return;
+  }
+  var grid = document.getElementById("book-grid");
+  var template = document.getElementById("book-template");
+
+  more.addEventListener("click", function (event) {
+    event.preventDefault();
+    fetch(more.dataset.pageUrl + "?after=" + more.dataset.after, {
+      credentials: "same-origin",
+    })
+      .then(function (response) {
+        return response.json();
+      })
+      .then(function (page) {
+        page.books.forEach(function (book) {
+          var item = template.content.cloneNode(true);
+          item.querySelectorAll("[data-field]").forEach(function (element) {
+            element.textContent = book[element.dataset.field];
+          });
+          item.querySelector("img").src = book.cover;
+          item.querySelector("input[name=isbn]").value = book.isbn;
+          grid.appendChild(item);
+        });
+        if (page.next === null) {
+          more.remove();
+        } else {
+          more.dataset.after = page.next;
+          more.href = more.href.replace(/after=\d+/, "after=" + page.next);
+        }
+      });
+  });
+});
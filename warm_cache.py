@@ -0,0 +1,40 @@
+# Prefetches the books users refer to most (in favorites, recommendations, and reviews) into the title cache,
+# so the first page views after a deploy are cache hits. Run it with PENGUIN_CACHE_URL or PENGUIN_CACHE_PATH
+# set, so the records land in the store the web workers share.
+# Usage: python warm_cache.py [--count N] [--rate N]
+import argparse
+from app import create_app
+from penguin import popular_isbns, warm_title_cache
+
+
+def positive_rate(value):
+    """Parses the --rate argument, which must be above zero."""
+    rate = float(value)
+    if rate <= 0:
+        raise argparse.ArgumentTypeError("the rate must be above zero")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Prefetch the most referenced books into the title cache."
+    )
+    parser.add_argument(
+        "--count", type=int, default=500, help="how many books to prefetch"
+    )
+    parser.add_argument(
+        "--rate",
+        type=positive_rate,
+        default=10,
+        help="the most Penguin requests to start per second",
+    )
+    args = parser.parse_args()
+
+    with create_app().app_context():
+        isbns = popular_isbns(args.count)
+        count = warm_title_cache(isbns, args.rate)
+        print("Warmed %d of %d books" % (count, len(isbns)))
+
+
+if __name__ == "__main__":
+    main()
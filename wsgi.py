@@ -0,0 +1,6 @@
+# Production entry point. Each worker process builds its own app and background refresh threads.
+# Usage: gunicorn "wsgi:app" (see the Procfile)
+from app import create_app, start_background_jobs
+
+app = create_app()
+start_background_jobs(app)